@@ -0,0 +1,205 @@
+'''
+Adaptive gzip compression for streaming a dump to its destinations.
+
+The dump is compressed block by block, each block as its own gzip member
+(gzip and gunzip read concatenated members as one stream), while a writer
+thread sends the compressed blocks on. After every block the compression
+speed and ratio of the current level and the speed of the writer are
+measured, and the next block uses the level with the best predicted end to
+end throughput: a slow upload is worth more compression, a fast one less.
+When the upload only starts once the file is written (as with --fanout),
+its rate from earlier runs is given as upload_rate and its time is added
+to the prediction.
+'''
+import Queue
+import threading
+import time
+import zlib
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_BUFFER = 4
+DEFAULT_LEVEL = 6
+MIN_LEVEL = 1
+MAX_LEVEL = 9
+SMOOTHING = 0.3
+
+
+def ewma(old, new):
+    if old is None:
+        return new
+    return old + SMOOTHING * (new - old)
+
+
+def compress_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class BlockWriter(threading.Thread):
+    '''
+    writes compressed blocks to every sink, timing how long it takes.
+    '''
+
+    def __init__(self, sinks, buffer):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sinks = sinks
+        self.queue = Queue.Queue(maxsize=buffer)
+        self.rate = None
+        self.busy = 0.0
+        self.error = None
+
+    def run(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                return
+            if self.error is not None:
+                continue
+            started = time.time()
+            try:
+                for sink in self.sinks:
+                    sink.write(block)
+            except Exception, e:
+                self.error = e
+                continue
+            elapsed = max(time.time() - started, 1e-6)
+            self.busy += elapsed
+            self.rate = ewma(self.rate, len(block) / elapsed)
+
+
+class TimedWriter(object):
+    '''
+    wraps a storage writer, counting the bytes written and the seconds
+    spent writing and storing them.
+    '''
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def write(self, data):
+        started = time.time()
+        self.writer.write(data)
+        self.seconds += time.time() - started
+        self.bytes += len(data)
+
+    def close(self):
+        started = time.time()
+        self.writer.close()
+        self.seconds += time.time() - started
+
+    def abort(self):
+        self.writer.abort()
+
+
+class AdaptiveCompressor(object):
+
+    def __init__(self, sinks, block_size=DEFAULT_BLOCK_SIZE, buffer=DEFAULT_BUFFER,
+                 level=DEFAULT_LEVEL, min_level=MIN_LEVEL, max_level=MAX_LEVEL, upload_rate=None):
+        self.sinks = sinks
+        self.block_size = block_size
+        self.buffer = buffer
+        self.level = level
+        self.min_level = min_level
+        self.max_level = max_level
+        # bytes per second of an upload that follows the compression
+        self.upload_rate = upload_rate
+        # measured input bytes per second and output/input ratio per level
+        self.speed = {}
+        self.ratio = {}
+        self.levels = {}
+
+    def predict(self, level, writer_rate):
+        '''
+        input bytes per second the pipeline would manage at level.
+        '''
+        if level not in self.speed:
+            return None
+        ratio = max(self.ratio[level], 1e-6)
+        rate = self.speed[level]
+        if writer_rate:
+            rate = min(rate, writer_rate / ratio)
+        if self.upload_rate:
+            rate = 1.0 / (1.0 / rate + ratio / self.upload_rate)
+        return rate
+
+    def next_level(self, writer):
+        '''
+        the level for the next block. A full writer queue means the writer
+        is the bottleneck, so a higher level is tried, and an empty one means
+        the compressor is, so a lower one is; otherwise the best predicted
+        neighbouring level wins. With an upload_rate the upload is the
+        bottleneck when sending a block would take longer than compressing it.
+        '''
+        level = self.level
+        candidates = [i for i in (level - 1, level, level + 1) if self.min_level <= i <= self.max_level]
+        current = self.predict(level, writer.rate)
+        backlog = writer.queue.qsize()
+        if self.upload_rate:
+            if self.ratio[level] / self.upload_rate > 1.0 / self.speed[level]:
+                direction = level + 1
+            else:
+                direction = level - 1
+        elif backlog >= self.buffer - 1:
+            direction = level + 1
+        elif backlog == 0:
+            direction = level - 1
+        else:
+            direction = None
+        if direction in candidates:
+            # blocks differ, so anything within the noise goes the way the
+            # queue points
+            rate = self.predict(direction, writer.rate)
+            if rate is None or rate >= current * 0.95:
+                return direction
+        best, best_rate = level, current
+        for candidate in candidates:
+            rate = self.predict(candidate, writer.rate)
+            if rate is not None and rate > best_rate * 1.05:
+                best, best_rate = candidate, rate
+        return best
+
+    def run(self, infile):
+        '''
+        compress everything read from infile into the sinks. Returns the
+        statistics for the run report.
+        '''
+        started = time.time()
+        writer = BlockWriter(self.sinks, self.buffer)
+        writer.start()
+        bytes_in = bytes_out = 0
+        compress_seconds = 0.0
+        try:
+            while writer.error is None:
+                data = infile.read(self.block_size)
+                if not data:
+                    break
+                block_started = time.time()
+                block = compress_block(data, self.level)
+                elapsed = max(time.time() - block_started, 1e-6)
+                compress_seconds += elapsed
+                self.speed[self.level] = ewma(self.speed.get(self.level), len(data) / elapsed)
+                self.ratio[self.level] = ewma(self.ratio.get(self.level), float(len(block)) / len(data))
+                self.levels[self.level] = self.levels.get(self.level, 0) + 1
+                bytes_in += len(data)
+                bytes_out += len(block)
+                writer.queue.put(block)
+                self.level = self.next_level(writer)
+            if not bytes_in:
+                # an empty gzip member, so the output is still valid gzip
+                writer.queue.put(compress_block('', self.level))
+        finally:
+            writer.queue.put(None)
+            writer.join()
+        if writer.error is not None:
+            raise writer.error
+        return {
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'seconds': round(time.time() - started, 3),
+            'compress_seconds': round(compress_seconds, 3),
+            'write_seconds': round(writer.busy, 3),
+            'levels': dict((str(level), blocks) for level, blocks in sorted(self.levels.items())),
+        }
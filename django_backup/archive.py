@@ -0,0 +1,337 @@
+'''
+Parallel archiving of media directories.
+
+``tar`` walks and reads one file at a time, so on network filesystems with
+many small files it spends most of the run waiting on metadata and open
+calls. The archiver splits the work:
+
+* DirectoryScanner lists directories with a pool of threads, each taking
+  the next directory from a shared queue. It uses scandir when available
+  (Python 3, or the scandir package) and os.listdir and lstat otherwise.
+* Archiver writes the entries to an uncompressed tar stream, in name
+  order. A pool of reader threads reads small files ahead of the writer,
+  up to ``prefetch_bytes``. Larger files are read by the writer itself.
+
+The tar stream goes to a file object, normally a gzip process's stdin, so
+compression runs on another core. Names are stored relative to the
+directory they were found in, so extracting the archive into MEDIA_ROOT
+restores it. The directories are merged that way, so a name found in more
+than one of them fails the scan, apart from directories. A directory given
+to scan that can't be listed fails it too; the errors below it are
+collected in ``errors`` and the scan goes on. Files are archived as they
+are when read: a file whose size changed since it was scanned is stored at
+its new size, or, when too large to prefetch, padded or cut to the scanned
+size like tar does. Files that disappear are skipped.
+'''
+import Queue
+import os
+import stat
+import tarfile
+import threading
+from collections import deque, namedtuple
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None
+
+DEFAULT_WORKERS = 8
+DEFAULT_PREFETCH_BYTES = 64 * 1024 * 1024
+PREFETCH_FILE_SIZE = 1024 * 1024
+
+ArchiveEntry = namedtuple('ArchiveEntry', 'arcname path stat linkname')
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class DirectoryScanner(object):
+    '''
+    lists the entries below some directories with workers threads.
+    '''
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self.errors = []
+
+    def list_directory(self, path, prefix):
+        '''
+        (entries, subdirectories) of path, as ArchiveEntry and (path,
+        arcname) tuples.
+        '''
+        entries = []
+        subdirectories = []
+        if scandir is not None:
+            found = []
+            for item in scandir(path):
+                try:
+                    found.append((item.name, item.path, item.stat(follow_symlinks=False)))
+                except OSError:
+                    # removed since the directory was read
+                    continue
+        else:
+            found = []
+            for name in os.listdir(path):
+                child = os.path.join(path, name)
+                try:
+                    found.append((name, child, os.lstat(child)))
+                except OSError:
+                    continue
+        for name, child, st in found:
+            arcname = prefix + '/' + name if prefix else name
+            linkname = None
+            if stat.S_ISLNK(st.st_mode):
+                try:
+                    linkname = os.readlink(child)
+                except OSError:
+                    continue
+            elif stat.S_ISDIR(st.st_mode):
+                subdirectories.append((child, arcname))
+            elif not stat.S_ISREG(st.st_mode):
+                # sockets, fifos and devices don't belong in a media backup
+                continue
+            entries.append(ArchiveEntry(arcname, child, st, linkname))
+        return entries, subdirectories
+
+    def scan(self, directories):
+        '''
+        the entries below directories, sorted by name. Raises ArchiveError
+        when one of directories can't be listed, or two of them hold the
+        same name.
+        '''
+        entries = []
+        failed = []
+        tasks = Queue.Queue()
+        lock = threading.Lock()
+        finished = threading.Event()
+        pending = [0]
+
+        def work():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                path, prefix = task
+                try:
+                    found, subdirectories = self.list_directory(path, prefix)
+                except Exception, e:
+                    # still counted as done below, or the scan never ends
+                    found, subdirectories = [], []
+                    (self.errors if prefix else failed).append('%s: %s' % (path, e))
+                with lock:
+                    entries.extend(found)
+                    # queue the subdirectories before this one is done, so
+                    # pending only reaches 0 at the end
+                    pending[0] += len(subdirectories) - 1
+                    for subdirectory in subdirectories:
+                        tasks.put(subdirectory)
+                    if pending[0] == 0:
+                        finished.set()
+
+        for directory in directories:
+            pending[0] += 1
+            tasks.put((directory, ''))
+        if not pending[0]:
+            return entries
+        threads = [threading.Thread(target=work) for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while not finished.wait(1):
+                pass
+        finally:
+            for thread in threads:
+                tasks.put(None)
+        if failed:
+            raise ArchiveError('could not read %s' % ', '.join(failed))
+        entries.sort()
+        return merge_duplicates(entries)
+
+
+def merge_duplicates(entries):
+    '''
+    entries, sorted by name, with the directories found in more than one
+    of the scanned directories kept once. Raises ArchiveError for any other
+    name found more than once, as extracting would overwrite one with the
+    other.
+    '''
+    merged = []
+    duplicates = []
+    for entry in entries:
+        if merged and merged[-1].arcname == entry.arcname:
+            if not (stat.S_ISDIR(entry.stat.st_mode) and stat.S_ISDIR(merged[-1].stat.st_mode)):
+                duplicates.append(entry.arcname)
+            continue
+        merged.append(entry)
+    if duplicates:
+        raise ArchiveError('%d names are in more than one directory: %s' % (
+            len(duplicates), ', '.join(sorted(set(duplicates))[:10])))
+    return merged
+
+
+class SizedReader(object):
+    '''
+    exactly size bytes of f: cut when it grew, zero padded when it shrank.
+    '''
+
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+        self.padded = 0
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        data = self.f.read(size)
+        if len(data) < size:
+            self.padded += size - len(data)
+            data += '\0' * (size - len(data))
+        self.remaining -= len(data)
+        return data
+
+
+def read_file(path, size):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        return f.read(size + 1)
+    finally:
+        f.close()
+
+
+class Archiver(object):
+    '''
+    writes ArchiveEntry lists as a tar stream to out, prefetching the
+    contents of small files with workers threads.
+    '''
+
+    def __init__(self, out, workers=DEFAULT_WORKERS, prefetch_bytes=DEFAULT_PREFETCH_BYTES):
+        self.out = out
+        self.workers = workers
+        self.prefetch_bytes = prefetch_bytes
+        self.names = {}
+        self.stats = {'files': 0, 'directories': 0, 'links': 0, 'bytes': 0, 'skipped': 0}
+        self.changed = []
+
+    def owner(self, uid, gid):
+        if (uid, gid) not in self.names:
+            try:
+                uname = pwd.getpwuid(uid).pw_name if pwd else ''
+            except KeyError:
+                uname = ''
+            try:
+                gname = grp.getgrgid(gid).gr_name if grp else ''
+            except KeyError:
+                gname = ''
+            self.names[(uid, gid)] = uname, gname
+        return self.names[(uid, gid)]
+
+    def tar_info(self, entry):
+        st = entry.stat
+        info = tarfile.TarInfo(entry.arcname)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.mtime = int(st.st_mtime)
+        info.uid = st.st_uid
+        info.gid = st.st_gid
+        info.uname, info.gname = self.owner(st.st_uid, st.st_gid)
+        if entry.linkname is not None:
+            info.type = tarfile.SYMTYPE
+            info.linkname = entry.linkname
+        elif stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        else:
+            info.size = st.st_size
+        return info
+
+    def write(self, entries):
+        tar = tarfile.open(fileobj=self.out, mode='w|', format=tarfile.GNU_FORMAT)
+        pool = ThreadPool(self.workers)
+        try:
+            self._write(tar, entries, pool)
+        except Exception:
+            # out is broken, don't let tarfile flush into it again
+            tar.fileobj.closed = True
+            raise
+        finally:
+            pool.terminate()
+        tar.close()
+        return self.stats
+
+    def _write(self, tar, entries, pool):
+        entries = iter(entries)
+        ahead = deque()
+        buffered = [0]
+
+        def fill():
+            while buffered[0] < self.prefetch_bytes and len(ahead) < self.workers * 64:
+                try:
+                    entry = next(entries)
+                except StopIteration:
+                    return
+                result = None
+                if entry.linkname is None and stat.S_ISREG(entry.stat.st_mode) and \
+                        entry.stat.st_size <= PREFETCH_FILE_SIZE:
+                    result = pool.apply_async(read_file, (entry.path, PREFETCH_FILE_SIZE))
+                    buffered[0] += entry.stat.st_size
+                ahead.append((entry, result))
+
+        fill()
+        while ahead:
+            entry, result = ahead.popleft()
+            info = self.tar_info(entry)
+            if result is not None:
+                buffered[0] -= entry.stat.st_size
+                data = result.get()
+                if data is None or len(data) > PREFETCH_FILE_SIZE:
+                    # gone, or grown past what is worth keeping in memory
+                    self.add_file(tar, entry, info)
+                else:
+                    if len(data) != info.size:
+                        self.changed.append(entry.arcname)
+                    info.size = len(data)
+                    tar.addfile(info, StringIO(data))
+                    self.count(info)
+            elif info.isreg():
+                self.add_file(tar, entry, info)
+            else:
+                tar.addfile(info)
+                self.count(info)
+            fill()
+
+    def add_file(self, tar, entry, info):
+        try:
+            f = open(entry.path, 'rb')
+        except IOError:
+            self.stats['skipped'] += 1
+            return
+        try:
+            reader = SizedReader(f, info.size)
+            tar.addfile(info, reader)
+            if reader.padded or f.read(1):
+                self.changed.append(entry.arcname)
+        finally:
+            f.close()
+        self.count(info)
+
+    def count(self, info):
+        if info.isdir():
+            self.stats['directories'] += 1
+        elif info.issym():
+            self.stats['links'] += 1
+        else:
+            self.stats['files'] += 1
+            self.stats['bytes'] += info.size
@@ -0,0 +1,365 @@
+'''
+Content-addressed media backups.
+
+Files are stored once by the sha256 of their content under ``blobs/``, and
+every backup is a ``dir_<ts>.cas`` manifest listing the path, hash, size,
+mode and mtime of each file. Renaming or moving an upload therefore costs a
+manifest line instead of another copy of the file. A local cache of device,
+inode, size and mtime saves hashing files that haven't changed or only
+moved. Jobs backing up different directories can share it.
+
+When several directories are backed up, every path in the manifest starts
+with the name of the directory it was found in, and a ``#roots`` line lists
+them; restore puts back the one named like MEDIA_ROOT.
+
+Blobs no longer listed in any manifest are removed by collect_garbage once
+retention has deleted old manifests.
+'''
+import cPickle as pickle
+import gzip
+import hashlib
+import json
+import os
+import stat
+import threading
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from django_backup.storage import LocalStorage
+
+MANIFEST_SUFFIX = '.cas'
+BLOB_DIR = 'blobs'
+CACHE_FILENAME = '.cas_hashcache'
+CACHE_VERSION = 2
+HASH_CHUNK_SIZE = 1024 * 1024
+DEFAULT_WORKERS = 8
+ROOTS_PREFIX = '#roots '
+
+
+class CASError(Exception):
+    pass
+
+
+def is_cas_backup(filename):
+    return filename.endswith(MANIFEST_SUFFIX)
+
+
+def blob_name(digest):
+    return '/'.join([BLOB_DIR, digest[:2], digest])
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def cache_key(st):
+    # inodes are only unique within a filesystem
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+class HashCache(object):
+    '''
+    {path: (dev, inode, size, mtime, hash)} of the files hashed by earlier
+    runs.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        try:
+            f = open(path, 'rb')
+            try:
+                data = pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, pickle.UnpicklingError, ValueError):
+            data = {}
+        if isinstance(data, dict) and data.get('version') == CACHE_VERSION:
+            self.entries = data['entries']
+        # a moved or renamed file keeps its device, inode, size and mtime
+        self.by_inode = dict((entry[:4], entry[4]) for entry in self.entries.itervalues())
+        self.seen = {}
+        self.scanned = []
+
+    def get(self, path, st):
+        key = cache_key(st)
+        entry = self.entries.get(path)
+        if entry is not None and entry[:4] == key:
+            return entry[4]
+        return self.by_inode.get(key)
+
+    def set(self, path, st, digest):
+        self.seen[path] = cache_key(st) + (digest,)
+
+    def save(self):
+        '''
+        keep the files seen this run, so deleted files drop out, and the
+        files outside the directories scanned, which other jobs sharing the
+        cache hashed.
+        '''
+        prefixes = tuple(os.path.join(os.path.normpath(directory), '') for directory in self.scanned)
+        entries = dict((path, entry) for path, entry in self.entries.iteritems()
+                       if not os.path.normpath(path).startswith(prefixes))
+        entries.update(self.seen)
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            pickle.dump({'version': CACHE_VERSION, 'entries': entries}, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+
+def root_names(directories):
+    '''
+    the names the directories get in a manifest: None for a single
+    directory, whose paths stay relative to it, their base names otherwise.
+    '''
+    if len(directories) < 2:
+        return None
+    names = [os.path.basename(os.path.normpath(directory)) for directory in directories]
+    for name in names:
+        if names.count(name) > 1:
+            raise CASError('several directories are called %s, their files would collide' % name)
+    return names
+
+
+def scan(directories, cache, workers=DEFAULT_WORKERS):
+    '''
+    walk the directories and return manifest entries
+    (hash, size, mode, mtime, relative path, absolute path), hashing only
+    the files the cache doesn't know. Paths are relative to their directory,
+    below its name when there are several, see root_names.
+    '''
+    roots = root_names(directories) or ['']
+    found = []
+    cache.scanned.extend(directories)
+    for directory, root in zip(directories, roots):
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                found.append((path, os.path.join(root, os.path.relpath(path, directory)), st))
+
+    def digest(item):
+        path, relpath, st = item
+        cached = cache.get(path, st)
+        if cached is None:
+            cached = hash_file(path)
+        return cached
+
+    pool = ThreadPool(workers)
+    try:
+        digests = pool.map(digest, found, chunksize=64)
+    finally:
+        pool.terminate()
+    entries = []
+    hashed = 0
+    for (path, relpath, st), hexdigest in zip(found, digests):
+        if cache.get(path, st) is None:
+            hashed += 1
+        cache.set(path, st, hexdigest)
+        entries.append((hexdigest, st.st_size, stat.S_IMODE(st.st_mode), int(st.st_mtime), relpath, path))
+    print 'scanned %d media files, hashed %d' % (len(entries), hashed)
+    return entries
+
+
+def write_manifest(entries, roots=None):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    if roots:
+        f.write(ROOTS_PREFIX + json.dumps(roots) + '\n')
+    for hexdigest, size, mode, mtime, relpath, path in entries:
+        f.write('%s %d %o %d %s\n' % (hexdigest, size, mode, mtime, json.dumps(relpath)))
+    f.close()
+    return buf.getvalue()
+
+
+def parse_manifest(data):
+    '''
+    (roots, entries) of a manifest, roots being None for a single directory.
+    '''
+    roots = None
+    entries = []
+    for line in gzip.GzipFile(fileobj=StringIO(data)).read().splitlines():
+        if line.startswith(ROOTS_PREFIX):
+            roots = json.loads(line[len(ROOTS_PREFIX):])
+            continue
+        hexdigest, size, mode, mtime, relpath = line.split(' ', 4)
+        entries.append((hexdigest, int(size), int(mode, 8), int(mtime), json.loads(relpath)))
+    return roots, entries
+
+
+class ContentStore(object):
+    '''
+    the blobs and manifests kept on one storage backend.
+    '''
+
+    def __init__(self, storage, workers=DEFAULT_WORKERS):
+        self.storage = storage
+        self.workers = workers
+        self.known_prefixes = {}
+
+    def map(self, func, items):
+        '''
+        func(storage, item) for every item on workers threads, each with the
+        storage returned by for_worker, so SFTP transfers get a session per
+        thread.
+        '''
+        local = threading.local()
+        lock = threading.Lock()
+        storages = []
+
+        def call(item):
+            if not hasattr(local, 'storage'):
+                with lock:
+                    local.storage = self.storage.for_worker(len(storages))
+                    storages.append(local.storage)
+            return func(local.storage, item)
+
+        pool = ThreadPool(self.workers)
+        try:
+            return pool.map(call, items, chunksize=16)
+        finally:
+            pool.terminate()
+            for storage in storages:
+                if storage is not self.storage:
+                    storage.close()
+
+    def load_manifest(self, name):
+        stream = self.storage.get_stream(name)
+        try:
+            return parse_manifest(stream.read())
+        finally:
+            stream.close()
+
+    def read_manifest(self, name):
+        return self.load_manifest(name)[1]
+
+    def manifests(self):
+        return sorted(i for i in self.storage.listdir() if is_cas_backup(i))
+
+    def has_blob(self, hexdigest):
+        prefix = hexdigest[:2]
+        if prefix not in self.known_prefixes:
+            try:
+                self.known_prefixes[prefix] = set(self.storage.listdir('%s/%s' % (BLOB_DIR, prefix)))
+            except (IOError, OSError):
+                self.known_prefixes[prefix] = set()
+        return hexdigest in self.known_prefixes[prefix]
+
+    def backup(self, entries, name, roots=None):
+        '''
+        store the blobs this store is missing and write the manifest.
+        Returns (blobs uploaded, bytes uploaded).
+        '''
+        self.storage.ensure()
+        missing = {}
+        for entry in entries:
+            hexdigest, path = entry[0], entry[5]
+            # checked on the storage even when the last manifest lists it: a
+            # blob lost since would otherwise stay missing for good
+            if hexdigest not in missing and not self.has_blob(hexdigest):
+                missing[hexdigest] = (path, entry[1])
+
+        def upload(storage, item):
+            hexdigest, (path, size) = item
+            storage.put_file(blob_name(hexdigest), path)
+            return size
+
+        uploaded = sum(self.map(upload, missing.items()))
+        writer = self.storage.open_writer(name)
+        writer.write(write_manifest(entries, roots))
+        writer.close()
+        return len(missing), uploaded
+
+    def restore(self, name, target, root=None):
+        '''
+        rebuild the files of a manifest below target, skipping files that
+        are already there with the same size and mtime. For a manifest of
+        several directories, only the one called root is restored.
+        Returns (files in the manifest, files restored).
+        '''
+        roots, entries = self.load_manifest(name)
+        if roots is not None:
+            if root not in roots:
+                raise CASError('%s has no directory called %s, only %s' % (name, root, ', '.join(roots)))
+            prefix = root + '/'
+            entries = [entry[:4] + (entry[4][len(prefix):],) for entry in entries
+                       if entry[4].startswith(prefix)]
+
+        def fetch(storage, entry):
+            hexdigest, size, mode, mtime, relpath = entry
+            path = os.path.join(target, relpath)
+            try:
+                st = os.stat(path)
+                if st.st_size == size and int(st.st_mtime) == mtime:
+                    return 0
+            except OSError:
+                pass
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                try:
+                    os.makedirs(parent)
+                except OSError:
+                    if not os.path.isdir(parent):
+                        raise
+            if isinstance(storage, LocalStorage):
+                # cheaper than streaming through python
+                source = open(storage.path(blob_name(hexdigest)), 'rb')
+            else:
+                source = storage.get_stream(blob_name(hexdigest))
+            tmp = path + '.restoring'
+            out = open(tmp, 'wb')
+            try:
+                while True:
+                    chunk = source.read(HASH_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+            finally:
+                out.close()
+                source.close()
+            os.chmod(tmp, mode)
+            os.utime(tmp, (mtime, mtime))
+            os.rename(tmp, path)
+            return 1
+
+        restored = sum(self.map(fetch, entries))
+        return len(entries), restored
+
+    def collect_garbage(self):
+        '''
+        delete the blobs no manifest refers to. Returns the number deleted.
+        '''
+        referenced = set()
+        for name in self.manifests():
+            referenced.update(entry[0] for entry in self.read_manifest(name))
+        try:
+            prefixes = self.storage.listdir(BLOB_DIR)
+        except (IOError, OSError):
+            return 0
+        garbage = []
+        for prefix in prefixes:
+            for hexdigest in self.storage.listdir('%s/%s' % (BLOB_DIR, prefix)):
+                if hexdigest not in referenced:
+                    garbage.append(blob_name(hexdigest))
+        for i in range(0, len(garbage), 1000):
+            self.storage.delete_batch(garbage[i:i + 1000])
+        self.known_prefixes = {}
+        return len(garbage)
@@ -0,0 +1,90 @@
+'''
+Reusable SFTP connections for long-running processes such as ``backupd``.
+
+The management commands open a fresh connection per operation and close it
+straight away. When the pool is enabled, ``get_connection`` hands out a
+shared connection instead, and ``close()`` leaves it open for the next run.
+'''
+import threading
+
+import pysftp as ssh
+
+
+class PooledConnection(object):
+    '''
+    proxy around a pysftp connection whose close() is a no-op.
+    '''
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def close(self):
+        pass
+
+    def is_alive(self):
+        transport = getattr(self._connection, '_transport', None)
+        return transport is not None and transport.is_active()
+
+
+class ConnectionPool(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, username, password, slot=0):
+        key = (host, username, slot)
+        with self.lock:
+            connection = self.connections.get(key)
+            if connection is None or not connection.is_alive():
+                if connection is not None:
+                    self.discard(key)
+                connection = PooledConnection(
+                    ssh.Connection(host=host, username=username, password=password))
+                self.connections[key] = connection
+            return connection
+
+    def discard(self, key):
+        connection = self.connections.pop(key, None)
+        if connection is not None:
+            try:
+                connection._connection.close()
+            except Exception:
+                pass
+
+    def close_all(self):
+        with self.lock:
+            for key in self.connections.keys():
+                self.discard(key)
+
+
+connection_pool = ConnectionPool()
+
+
+def get_connection(host, username, password, slot=0):
+    '''
+    get the ssh connection to the remote server, from the pool if enabled.
+    Threads that need a session each pass their own slot, the pool keeps a
+    connection per slot.
+    '''
+    if connection_pool.enabled:
+        return connection_pool.get(host, username, password, slot)
+    return ssh.Connection(host=host, username=username, password=password)
+
+
+def open_remote(connection, path, mode='rb'):
+    '''
+    open a file on the remote server for streaming. Older pysftp releases
+    have no open(), so fall back to the underlying paramiko client.
+    '''
+    if hasattr(connection, 'open'):
+        f = connection.open(path, mode)
+    else:
+        f = connection._sftp.open(path, mode)
+    if 'r' in mode and hasattr(f, 'prefetch'):
+        f.prefetch()
+    return f
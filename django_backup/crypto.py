@@ -0,0 +1,241 @@
+'''
+Streaming authenticated encryption of backup artifacts.
+
+Artifacts are cut into fixed-size chunks that are sealed with AES-256-GCM
+independently, so a pool of threads can encrypt (or decrypt) several chunks
+at once while the stream keeps flowing. The file layout is::
+
+    header: MAGIC | chunk size (4 bytes) | salt (32 bytes)
+    frame:  ciphertext length (4 bytes) | final flag (1 byte) | ciphertext
+
+Every file is sealed with its own key, derived with HKDF-SHA256 from the
+configured key and the random salt of its header, so the chunk index alone
+is a safe nonce: a nonce is never used twice under the same key, however
+many files are written with the configured key. The header, index and
+final flag are authenticated with each chunk, so frames cannot be
+reordered, swapped between files or cut off at the end, and nothing may
+follow the final frame.
+
+The configured key is hex or base64 encoded, or the 32 bytes themselves
+after a ``raw:`` prefix, so a passphrase is never mistaken for a key.
+
+Requires the ``cryptography`` package.
+'''
+import base64
+import os
+import struct
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError:
+    AESGCM = None
+
+MAGIC = 'DJBKENC2'
+HEADER = struct.Struct('>8sI32s')
+NONCE_PREFIX = '\0' * 4
+KEY_INFO = 'django_backup file key'
+FRAME = struct.Struct('>IB')
+CHUNK_INDEX = struct.Struct('>Q')
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_WORKERS = 4
+ENCRYPTED_SUFFIX = '.enc'
+KEY_SIZE = 32
+RAW_KEY_PREFIX = 'raw:'
+
+
+class EncryptionError(Exception):
+    pass
+
+
+def is_encrypted(filename):
+    return filename.endswith(ENCRYPTED_SUFFIX)
+
+
+def decode_key(value):
+    '''
+    accept a hex or base64 encoded 256 bit key, or a raw: prefixed one.
+    '''
+    if value.startswith(RAW_KEY_PREFIX):
+        key = value[len(RAW_KEY_PREFIX):]
+        if len(key) != KEY_SIZE:
+            raise EncryptionError('a raw: backup encryption key must be followed by exactly 32 bytes')
+        return key
+    value = value.strip()
+    if len(value) == KEY_SIZE * 2:
+        try:
+            return value.decode('hex')
+        except TypeError:
+            pass
+    try:
+        key = base64.b64decode(value)
+    except TypeError:
+        key = None
+    if key is None or len(key) != KEY_SIZE:
+        raise EncryptionError('the backup encryption key must be 32 bytes, hex or base64 encoded')
+    return key
+
+
+def load_key(settings):
+    '''
+    read the key from BACKUP_ENCRYPTION_KEY or BACKUP_ENCRYPTION_KEY_FILE.
+    '''
+    key = getattr(settings, 'BACKUP_ENCRYPTION_KEY', None)
+    key_file = getattr(settings, 'BACKUP_ENCRYPTION_KEY_FILE', None)
+    if not key and key_file:
+        f = open(key_file, 'rb')
+        try:
+            key = f.read()
+        finally:
+            f.close()
+    if not key:
+        raise EncryptionError('BACKUP_ENCRYPTION_KEY or BACKUP_ENCRYPTION_KEY_FILE must be set')
+    return decode_key(key)
+
+
+def _aead(key, salt):
+    '''
+    the cipher of a file, keyed with a key derived from key and its salt.
+    '''
+    if AESGCM is None:
+        raise EncryptionError('the cryptography package is required for encrypted backups')
+    key = HKDF(algorithm=hashes.SHA256(), length=KEY_SIZE, salt=salt, info=KEY_INFO,
+               backend=default_backend()).derive(key)
+    return AESGCM(key)
+
+
+def read_full(f, size):
+    '''
+    read exactly size bytes unless the stream ends first.
+    '''
+    chunks = []
+    while size:
+        chunk = f.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _nonce_and_aad(header, index, final):
+    counter = CHUNK_INDEX.pack(index)
+    return NONCE_PREFIX + counter, header + counter + chr(final)
+
+
+def _ordered(pool, tasks, workers, write):
+    '''
+    run (function, args) tasks on the pool keeping a bounded number in
+    flight, passing their results to write in order.
+    '''
+    pending = deque()
+    for func, args in tasks:
+        pending.append(pool.apply_async(func, args))
+        if len(pending) >= workers * 2:
+            write(pending.popleft().get())
+    while pending:
+        write(pending.popleft().get())
+
+
+def encrypt_stream(infile, outfile, key, chunk_size=DEFAULT_CHUNK_SIZE, workers=DEFAULT_WORKERS):
+    '''
+    encrypt everything read from infile into outfile. Returns the number of
+    plaintext bytes.
+    '''
+    salt = os.urandom(32)
+    aead = _aead(key, salt)
+    header = HEADER.pack(MAGIC, chunk_size, salt)
+    outfile.write(header)
+    total = [0]
+
+    def seal(index, chunk, final):
+        nonce, aad = _nonce_and_aad(header, index, final)
+        return FRAME.pack(len(chunk) + 16, final) + aead.encrypt(nonce, chunk, aad)
+
+    def chunks():
+        index = 0
+        chunk = read_full(infile, chunk_size)
+        while True:
+            following = read_full(infile, chunk_size) if len(chunk) == chunk_size else ''
+            final = int(not following)
+            total[0] += len(chunk)
+            yield seal, (index, chunk, final)
+            if final:
+                return
+            chunk = following
+            index += 1
+
+    pool = ThreadPool(workers)
+    try:
+        _ordered(pool, chunks(), workers, outfile.write)
+    finally:
+        pool.terminate()
+    return total[0]
+
+
+def decrypt_stream(infile, outfile, key, workers=DEFAULT_WORKERS):
+    '''
+    decrypt a stream written by encrypt_stream into outfile, failing if any
+    chunk was tampered with or the stream was truncated.
+    '''
+    header = read_full(infile, HEADER.size)
+    if len(header) != HEADER.size:
+        raise EncryptionError('not an encrypted backup: stream too short')
+    magic, chunk_size, salt = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise EncryptionError('not an encrypted backup: bad header')
+    aead = _aead(key, salt)
+    finished = [False]
+
+    def open_chunk(index, ciphertext, final):
+        nonce, aad = _nonce_and_aad(header, index, final)
+        try:
+            return aead.decrypt(nonce, ciphertext, aad)
+        except Exception:
+            raise EncryptionError('chunk %d failed authentication' % index)
+
+    def frames():
+        index = 0
+        while True:
+            frame = read_full(infile, FRAME.size)
+            if not frame:
+                break
+            if len(frame) != FRAME.size:
+                raise EncryptionError('truncated frame header')
+            length, final = FRAME.unpack(frame)
+            if length > chunk_size + 16:
+                raise EncryptionError('frame %d is larger than the chunk size' % index)
+            ciphertext = read_full(infile, length)
+            if len(ciphertext) != length:
+                raise EncryptionError('truncated frame %d' % index)
+            yield open_chunk, (index, ciphertext, final)
+            if final:
+                finished[0] = True
+                break
+            index += 1
+
+    pool = ThreadPool(workers)
+    try:
+        _ordered(pool, frames(), workers, outfile.write)
+    finally:
+        pool.terminate()
+    if not finished[0]:
+        raise EncryptionError('encrypted backup is truncated')
+    if infile.read(1):
+        raise EncryptionError('data after the final frame')
+
+
+def encrypt_file(infile, outfile, key, **kwargs):
+    fin = open(infile, 'rb')
+    try:
+        fout = open(outfile, 'wb')
+        try:
+            encrypt_stream(fin, fout, key, **kwargs)
+        finally:
+            fout.close()
+    finally:
+        fin.close()
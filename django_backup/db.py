@@ -0,0 +1,160 @@
+'''
+Command line clients for the database being backed up.
+
+Wraps ``mysql`` and ``psql`` so restores and checks can run scripts and
+queries in separate sessions without going through Django's connection.
+'''
+import os
+import subprocess
+
+MYSQL = 'django.db.backends.mysql'
+POSTGRESQL = 'django.db.backends.postgresql_psycopg2'
+
+
+class ClientError(Exception):
+    pass
+
+
+class DatabaseClient(object):
+
+    def __init__(self, engine, name, user=None, passwd=None, host=None, port=None):
+        if engine not in (MYSQL, POSTGRESQL):
+            raise ClientError('%s engine not implemented' % engine)
+        self.engine = engine
+        self.name = name
+        self.user = user
+        self.passwd = passwd
+        self.host = host
+        self.port = port
+
+    def __str__(self):
+        return '%s on %s' % (self.name, self.host or 'localhost')
+
+    @classmethod
+    def from_settings(cls, settings, name=None):
+        '''
+        the default database, or another database on the same server.
+        '''
+        try:
+            database = settings.DATABASES['default']
+            return cls(database['ENGINE'], name or database['NAME'], database['USER'],
+                       database['PASSWORD'], database['HOST'], database['PORT'])
+        except (AttributeError, NameError):
+            return cls(settings.DATABASE_ENGINE, name or settings.DATABASE_NAME, settings.DATABASE_USER,
+                       settings.DATABASE_PASSWORD, settings.DATABASE_HOST, settings.DATABASE_PORT)
+
+    def using(self, name):
+        '''
+        the same server and credentials, another database.
+        '''
+        return DatabaseClient(self.engine, name, self.user, self.passwd, self.host, self.port)
+
+    @property
+    def is_mysql(self):
+        return self.engine == MYSQL
+
+    def env(self):
+        env = dict(os.environ)
+        if self.passwd and not self.is_mysql:
+            env['PGPASSWORD'] = self.passwd
+        return env
+
+    def command(self, database=True):
+        if self.is_mysql:
+            args = ['mysql']
+            if self.user:
+                args.append('--user=%s' % self.user)
+            if self.passwd:
+                args.append('--password=%s' % self.passwd)
+            if self.host:
+                args.append('--host=%s' % self.host)
+            if self.port:
+                args.append('--port=%s' % self.port)
+            if database:
+                args.append(self.name)
+            return args
+        # psql carries on after a failed statement and exits 0 otherwise
+        args = ['psql', '-X', '-q', '-v', 'ON_ERROR_STOP=1']
+        if self.user:
+            args += ['-U', self.user]
+        if self.host:
+            args += ['-h', self.host]
+        if self.port:
+            args += ['-p', str(self.port)]
+        # psql connects to the server's maintenance database otherwise
+        args.append(self.name if database else 'postgres')
+        return args
+
+    def dump_command(self, path=None):
+        '''
+        mysqldump or pg_dump with the connection options, without the
+        database name.
+        '''
+        if self.is_mysql:
+            args = [path or 'mysqldump']
+            if self.user:
+                args.append('--user=%s' % self.user)
+            if self.passwd:
+                args.append('--password=%s' % self.passwd)
+            if self.host:
+                args.append('--host=%s' % self.host)
+            if self.port:
+                args.append('--port=%s' % self.port)
+            return args
+        args = [path or 'pg_dump']
+        if self.user:
+            args.append('--username=%s' % self.user)
+        if self.host:
+            args.append('--host=%s' % self.host)
+        if self.port:
+            args.append('--port=%s' % self.port)
+        return args
+
+    def open_script(self, stdout=None):
+        '''
+        a client process reading a script from its stdin.
+        '''
+        return subprocess.Popen(self.command(), stdin=subprocess.PIPE, stdout=stdout, env=self.env())
+
+    def run_file(self, path, log=None, single_transaction=True):
+        '''
+        run the script in path, appending the client's output to log. Both
+        clients stop at the first error; psql also runs the script in a
+        single transaction unless asked not to, so a failed script leaves
+        nothing behind.
+        '''
+        args = self.command()
+        if single_transaction and not self.is_mysql:
+            args.insert(1, '--single-transaction')
+        f = open(path, 'rb')
+        out = open(log, 'ab') if log else None
+        try:
+            code = subprocess.call(args, stdin=f, stdout=out, env=self.env())
+        finally:
+            f.close()
+            if out is not None:
+                out.close()
+        if code != 0:
+            raise ClientError('%s exited with %d running %s' % (args[0], code, path))
+
+    def query(self, sql, database=True):
+        '''
+        run sql and return the rows as lists of strings.
+        '''
+        if self.is_mysql:
+            args = self.command(database) + ['--batch', '--skip-column-names', '-e', sql]
+        else:
+            args = self.command(database) + ['-A', '-t', '-F', '\t', '-c', sql]
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env())
+        out, err = process.communicate()
+        if process.returncode != 0:
+            raise ClientError(err.strip() or '%s exited with %d' % (args[0], process.returncode))
+        return [line.split('\t') for line in out.splitlines() if line]
+
+    def execute(self, sql, database=True):
+        self.query(sql, database)
+
+    def quote_name(self, name):
+        if self.is_mysql:
+            return '`%s`' % name.replace('`', '``')
+        return '"%s"' % name.replace('"', '""')
@@ -0,0 +1,281 @@
+'''
+rsync style binary deltas of database dumps.
+
+Tonight's dump is mostly the same as last night's, which is already on the
+remote. We keep a small signature file (a weak rolling checksum and an md5
+per block) next to every uploaded dump. The next night the new dump is
+matched against that signature with the rolling checksum, and only the
+delta is uploaded: block references for the runs that match, and literal
+data for the rest.
+
+Plain gzip output changes completely after the first difference, so dumps
+meant for delta uploads are compressed with ``gzip --rsyncable``, which
+resets the compressor at content-defined points.
+
+A delta names the dump it applies to, which may itself be a delta, so
+restoring means resolving the chain back to a full dump.
+'''
+import hashlib
+import struct
+import zlib
+from cStringIO import StringIO
+
+SIGNATURE_MAGIC = 'DJBKSIG1'
+DELTA_MAGIC = 'DJBKDLT1'
+SIGNATURE_SUFFIX = '.sig'
+DELTA_SUFFIX = '.delta'
+DEFAULT_BLOCK_SIZE = 8 * 1024
+READ_SIZE = 4 * 1024 * 1024
+MOD_ADLER = 65521
+
+HEADER = struct.Struct('>8sIH')
+BLOCK = struct.Struct('>I16s')
+COPY = struct.Struct('>II')
+LENGTH = struct.Struct('>I')
+
+
+class DeltaError(Exception):
+    pass
+
+
+class DeltaTooLarge(DeltaError):
+    '''
+    the delta passed its literal data limit, the dump is better sent in full.
+    '''
+
+
+def is_delta(filename):
+    return filename.endswith(DELTA_SUFFIX)
+
+
+def logical_name(filename):
+    '''
+    the name of the dump a stored file holds, whether full or a delta.
+    '''
+    if is_delta(filename):
+        return filename[:-len(DELTA_SUFFIX)]
+    return filename
+
+
+def weak_checksum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+def _read(stream, size):
+    chunks = []
+    while size:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def write_signature(stream, out, block_size=DEFAULT_BLOCK_SIZE):
+    out.write(HEADER.pack(SIGNATURE_MAGIC, block_size, 0))
+    while True:
+        block = _read(stream, block_size)
+        if not block:
+            break
+        out.write(BLOCK.pack(weak_checksum(block), hashlib.md5(block).digest()))
+
+
+def read_signature(stream):
+    '''
+    return (block_size, {weak: {strong: block_index}}).
+    '''
+    magic, block_size, _ = HEADER.unpack(_read(stream, HEADER.size))
+    if magic != SIGNATURE_MAGIC:
+        raise DeltaError('not a signature file')
+    blocks = {}
+    index = 0
+    while True:
+        entry = _read(stream, BLOCK.size)
+        if not entry:
+            break
+        weak, strong = BLOCK.unpack(entry)
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+        index += 1
+    return block_size, blocks
+
+
+class DeltaWriter(object):
+    '''
+    serialises delta operations, merging consecutive block copies.
+    '''
+
+    def __init__(self, out, base_name, block_size):
+        self.out = out
+        self.copy = None
+        self.literal_bytes = 0
+        self.copied_bytes = 0
+        self.block_size = block_size
+        out.write(HEADER.pack(DELTA_MAGIC, block_size, len(base_name)))
+        out.write(base_name)
+
+    def copy_block(self, index):
+        self.copied_bytes += self.block_size
+        if self.copy is not None and self.copy[0] + self.copy[1] == index:
+            self.copy[1] += 1
+            return
+        self.flush_copy()
+        self.copy = [index, 1]
+
+    def flush_copy(self):
+        if self.copy is not None:
+            self.out.write('C' + COPY.pack(*self.copy))
+            self.copy = None
+
+    def literal(self, data):
+        if data:
+            self.flush_copy()
+            self.literal_bytes += len(data)
+            self.out.write('D' + LENGTH.pack(len(data)) + data)
+
+    def finish(self, digest):
+        self.flush_copy()
+        self.out.write('E' + digest)
+
+
+def write_delta(stream, signature, base_name, out, max_literal=None):
+    '''
+    write the delta turning the dump described by signature into the
+    contents of stream. Returns the DeltaWriter, for its statistics.
+
+    Raises DeltaTooLarge as soon as the literal data passes max_literal
+    bytes, instead of matching the rest of a dump that will be sent in full
+    anyway.
+    '''
+    block_size, blocks = signature
+    writer = DeltaWriter(out, base_name, block_size)
+    digest = hashlib.md5()
+    md5 = hashlib.md5
+    buf = ''
+    values = bytearray()
+    pos = 0             # start of the current window in buf
+    literal_start = 0   # start of the pending literal data in buf
+    eof = False
+    weak = None
+    while True:
+        if len(buf) - pos <= block_size and not eof:
+            writer.literal(buf[literal_start:pos])
+            if max_literal is not None and writer.literal_bytes > max_literal:
+                raise DeltaTooLarge('more than %d bytes of literal data' % max_literal)
+            more = stream.read(READ_SIZE)
+            digest.update(more)
+            eof = not more
+            buf = buf[pos:] + more
+            # byte values for the rolling checksum, without an ord() per byte
+            values = bytearray(buf)
+            pos = literal_start = 0
+            weak = None
+            continue
+        window = len(buf) - pos
+        if window < block_size:
+            # the tail is shorter than a block, it can only be literal
+            writer.literal(buf[literal_start:])
+            break
+        if weak is None:
+            weak = weak_checksum(buf[pos:pos + block_size])
+        candidates = blocks.get(weak)
+        if candidates:
+            index = candidates.get(md5(buf[pos:pos + block_size]).digest())
+            if index is not None:
+                writer.literal(buf[literal_start:pos])
+                writer.copy_block(index)
+                pos += block_size
+                literal_start = pos
+                weak = None
+                continue
+        if window == block_size:
+            writer.literal(buf[literal_start:])
+            break
+        # roll the adler32 window forward until its checksum is in the
+        # signature or it reaches the end of buf. This is where the time
+        # goes, so it stays in locals.
+        stop = len(buf) - block_size
+        a = weak & 0xffff
+        b = weak >> 16
+        while True:
+            out_byte = values[pos]
+            a = (a - out_byte + values[pos + block_size]) % MOD_ADLER
+            b = (b - block_size * out_byte + a - 1) % MOD_ADLER
+            pos += 1
+            weak = (b << 16) | a
+            if pos == stop or weak in blocks:
+                break
+    if max_literal is not None and writer.literal_bytes > max_literal:
+        raise DeltaTooLarge('more than %d bytes of literal data' % max_literal)
+    writer.finish(digest.digest())
+    return writer
+
+
+def read_delta_header(stream):
+    '''
+    return (block_size, base_name) of a delta.
+    '''
+    header = _read(stream, HEADER.size)
+    magic, block_size, name_length = HEADER.unpack(header)
+    if magic != DELTA_MAGIC:
+        raise DeltaError('not a delta file')
+    return block_size, _read(stream, name_length)
+
+
+def apply_delta(base, stream, out):
+    '''
+    rebuild a dump from the seekable base dump and a delta, checking the
+    result against the md5 recorded in the delta.
+    '''
+    block_size, base_name = read_delta_header(stream)
+    digest = hashlib.md5()
+    while True:
+        op = stream.read(1)
+        if op == 'C':
+            index, count = COPY.unpack(_read(stream, COPY.size))
+            base.seek(index * block_size)
+            remaining = count * block_size
+            while remaining:
+                data = base.read(min(remaining, READ_SIZE))
+                if not data:
+                    raise DeltaError('delta refers past the end of %s' % base_name)
+                digest.update(data)
+                out.write(data)
+                remaining -= len(data)
+        elif op == 'D':
+            length, = LENGTH.unpack(_read(stream, LENGTH.size))
+            data = _read(stream, length)
+            digest.update(data)
+            out.write(data)
+        elif op == 'E':
+            if _read(stream, 16) != digest.digest():
+                raise DeltaError('checksum mismatch rebuilding from %s' % base_name)
+            return
+        else:
+            raise DeltaError('truncated delta')
+
+
+def base_of(storage, name, stored_names):
+    '''
+    the stored name of the dump a delta applies to.
+    '''
+    header = storage.read_range(name, 0, HEADER.size + 1024)
+    block_size, base = read_delta_header(StringIO(header))
+    for candidate in (base, base + DELTA_SUFFIX):
+        if candidate in stored_names:
+            return candidate
+    raise DeltaError('%s needs %s, which is missing' % (name, base))
+
+
+def resolve_chain(storage, name, stored_names):
+    '''
+    return the stored files needed to rebuild name, from name back to the
+    full dump it is based on.
+    '''
+    chain = [name]
+    while is_delta(chain[-1]):
+        base = base_of(storage, chain[-1], stored_names)
+        if base in chain:
+            raise DeltaError('delta chain of %s loops' % name)
+        chain.append(base)
+    return chain
@@ -0,0 +1,187 @@
+'''
+Consistency checks for restore drills.
+
+``backup --checks`` records the row count and a checksum of every table in
+a ``backup_<ts>.checks`` file next to the dump. ``restore --drill`` loads
+the backup into a scratch database, computes the same figures there and
+compares them.
+
+The checksum is the sum of a 32 bit hash of every row, so it doesn't
+depend on the order the rows come back in:
+
+* MySQL: CRC32 of the columns joined by CONCAT_WS, with a string of
+  ISNULL flags so a NULL and an empty value differ
+* PostgreSQL: the first 32 bits of the md5 of the row's text form
+
+Tables are checked in parallel sessions, one query per table.
+
+The drill restores the media into a ``restore_drill`` directory under
+BACKUP_DRILL_MEDIA_ROOT, with a marker file in it. That directory is only
+ever emptied when the marker is there, so a misconfigured setting can't
+make a drill delete files it did not restore.
+
+The dump and the checks don't see the same snapshot. The change signals of
+django_backup.incremental are read before the dump and after the checks,
+and tables whose signal moved, or that have no signal, are marked as
+changed. The drill doesn't compare them, and fails when that leaves no
+table to compare.
+'''
+import json
+import os
+import shutil
+from multiprocessing.pool import ThreadPool
+
+from django_backup.incremental import table_signals
+
+CHECKS_SUFFIX = '.checks'
+DRILL_REPORT_FILENAME = '.restore_drills'
+DEFAULT_WORKERS = 4
+DRILL_MEDIA_DIRNAME = 'restore_drill'
+DRILL_MEDIA_MARKER = '.restore_drill'
+
+MYSQL_COLUMNS = '''SELECT c.table_name, c.column_name FROM information_schema.columns c
+JOIN information_schema.tables t ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+WHERE c.table_schema = DATABASE() AND t.table_type = 'BASE TABLE'
+ORDER BY c.table_name, c.ordinal_position'''
+POSTGRESQL_TABLES = '''SELECT n.nspname, c.relname FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind = 'r' AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+AND n.nspname NOT LIKE 'pg_toast%' '''
+
+
+class DrillError(Exception):
+    pass
+
+
+def is_checks(filename):
+    return filename.endswith(CHECKS_SUFFIX)
+
+
+def checks_name(time_suffix):
+    return 'backup_%s%s' % (time_suffix, CHECKS_SUFFIX)
+
+
+def get_drill_report_file(settings, backup_dir):
+    return getattr(settings, 'BACKUP_DRILL_REPORT_FILE', None) or os.path.join(backup_dir, DRILL_REPORT_FILENAME)
+
+
+def contains(parent, path):
+    '''
+    whether path is parent or below it, symlinks resolved.
+    '''
+    parent = os.path.realpath(parent)
+    path = os.path.realpath(path)
+    return path == parent or path.startswith(parent.rstrip(os.sep) + os.sep)
+
+
+def prepare_media_root(drill_root, media_root):
+    '''
+    an empty directory to restore the media of a drill into, below
+    drill_root. Refuses when it would overlap media_root, and only empties
+    a directory an earlier drill created.
+    '''
+    path = os.path.join(drill_root, DRILL_MEDIA_DIRNAME)
+    if contains(media_root, path) or contains(path, media_root):
+        raise DrillError('%s overlaps the MEDIA_ROOT in use %s' % (path, media_root))
+    marker = os.path.join(path, DRILL_MEDIA_MARKER)
+    if os.path.lexists(path):
+        if os.path.islink(path) or not os.path.isfile(marker):
+            raise DrillError('%s exists and was not created by a drill' % path)
+        shutil.rmtree(path)
+    os.makedirs(path)
+    open(marker, 'wb').close()
+    return path
+
+
+def checksum_queries(client, exclude=()):
+    '''
+    {table: sql} selecting the row count and checksum of every table.
+    '''
+    queries = {}
+    q = client.quote_name
+    if client.is_mysql:
+        columns = {}
+        for table, column in client.query(MYSQL_COLUMNS):
+            if table not in exclude:
+                columns.setdefault(table, []).append(q(column))
+        for table, names in columns.items():
+            nulls = 'CONCAT(%s)' % ', '.join('ISNULL(%s)' % name for name in names)
+            queries[table] = 'SELECT COUNT(*), COALESCE(SUM(CRC32(CONCAT_WS(\'#\', %s, %s))), 0) FROM %s' % (
+                ', '.join(names), nulls, q(table))
+        return queries
+    for namespace, name in client.query(POSTGRESQL_TABLES):
+        table = '%s.%s' % (namespace, name)
+        if table in exclude or name in exclude:
+            continue
+        queries[table] = ("SELECT count(*), coalesce(sum(('x' || substr(md5(t::text), 1, 8))::bit(32)::bigint), 0) "
+                          "FROM %s.%s t" % (q(namespace), q(name)))
+    return queries
+
+
+def table_checks(client, exclude=(), workers=DEFAULT_WORKERS):
+    '''
+    {table: [rows, checksum]} for the tables of the database.
+    '''
+    queries = checksum_queries(client, exclude)
+
+    def check(table):
+        rows, checksum = client.query(queries[table])[0]
+        return table, [int(rows), checksum]
+
+    pool = ThreadPool(max(1, min(workers, len(queries))))
+    try:
+        return dict(pool.map(check, sorted(queries), chunksize=1))
+    finally:
+        pool.terminate()
+
+
+def record_checks(client, before, exclude=(), workers=DEFAULT_WORKERS, checksum=True):
+    '''
+    the checks of the database, once the dump is done. before is the
+    table_signals() read before the dump; the tables whose signal moved
+    since are marked as changed.
+    '''
+    tables = table_checks(client, exclude, workers)
+    after = table_signals(client, exclude, checksum)
+    changed = sorted(table for table in tables
+                     if before.get(table) is None or before.get(table) != after.get(table))
+    return {'engine': client.engine, 'tables': tables, 'changed': changed}
+
+
+def write_checks(path, checks):
+    f = open(path, 'wb')
+    try:
+        json.dump(checks, f, sort_keys=True, indent=1)
+    finally:
+        f.close()
+
+
+def read_checks(storage, name):
+    stream = storage.get_stream(name)
+    try:
+        return json.loads(stream.read())
+    finally:
+        stream.close()
+
+
+def compared_tables(recorded):
+    '''
+    the recorded tables a drill compares, leaving out the tables that
+    changed during the backup.
+    '''
+    changed = set(recorded.get('changed', []))
+    return sorted(table for table in recorded['tables'] if table not in changed)
+
+
+def compare(recorded, restored):
+    '''
+    {table: (recorded, restored)} for the compared_tables() that differ. A
+    table missing from the restore is None.
+    '''
+    mismatches = {}
+    for table in compared_tables(recorded):
+        expected = recorded['tables'].get(table)
+        actual = restored.get(table)
+        if expected != actual:
+            mismatches[table] = (expected, actual)
+    return mismatches
@@ -0,0 +1,321 @@
+'''
+Send backup artifacts to several destinations from a single read.
+
+Each artifact is read once and its chunks are handed to one writer thread
+per destination through a queue of at most ``buffer`` chunks. The reader
+never waits for a destination: one that falls ``buffer`` chunks behind is
+detached, and its writer reads the rest of the file on its own from where
+its queue ends. A slow destination so never holds the others back, and a
+failed one is dropped without stopping the rest. Destinations are
+configured in BACKUP_DESTINATIONS::
+
+    BACKUP_DESTINATIONS = [
+        {'type': 'local', 'directory': '/mnt/backup'},
+        {'type': 'sftp', 'server': 'offsite.example.com', 'username': 'backup',
+         'password': '...', 'directory': 'site', 'rate_limit': 2 * 1024 * 1024},
+        {'type': 's3', 'bucket': 'backups', 'prefix': 'site'},
+        {'type': 'email', 'to': ['admin@example.com'], 'from': 'backup@example.com'},
+    ]
+
+The type is ``email`` or any storage backend accepted by BACKUP_STORAGE,
+which gets the rest of the settings. Every destination also accepts
+``name``, ``rate_limit`` (bytes per second) and ``retries``.
+'''
+import os
+import Queue
+import threading
+import time
+from cStringIO import StringIO
+from datetime import datetime
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+
+from django_backup.storage import get_storage
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_BUFFER = 16
+DEFAULT_RETRIES = 2
+# queued for a writer that fell behind, in place of the chunks it missed
+DETACH = object()
+# queued when the source could not be read to the end
+ABORT = object()
+
+
+class Destination(object):
+    '''
+    a place to store artifacts. Subclasses open a writer per artifact, which
+    is stored by its close() and discarded by its abort().
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.name = config.get('name') or self.default_name()
+        self.rate_limit = config.get('rate_limit')
+        self.retries = config.get('retries', DEFAULT_RETRIES)
+        self.sent = []
+        self.failed = []
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def default_name(self):
+        return self.config['type']
+
+    def open(self, filename):
+        raise NotImplementedError
+
+    def finish(self):
+        '''
+        called once every artifact has been sent.
+        '''
+
+    def close(self):
+        pass
+
+
+class StorageDestination(Destination):
+    '''
+    any storage backend, see django_backup.storage.
+    '''
+
+    def __init__(self, config, storage):
+        self.storage = storage
+        Destination.__init__(self, config)
+
+    def default_name(self):
+        return str(self.storage)
+
+    def open(self, filename):
+        return self.storage.open_writer(filename)
+
+    def close(self):
+        self.storage.close()
+
+
+class EmailWriter(object):
+
+    def __init__(self, destination, filename):
+        self.destination = destination
+        self.filename = filename
+        self.buffer = StringIO()
+
+    def write(self, data):
+        self.buffer.write(data)
+
+    def close(self):
+        self.destination.attachments.append((self.filename, self.buffer.getvalue()))
+        self.buffer.close()
+
+    def abort(self):
+        self.buffer.close()
+
+
+class EmailDestination(Destination):
+    '''
+    collects every artifact and sends them attached to a single e-mail.
+    '''
+
+    def __init__(self, config):
+        Destination.__init__(self, config)
+        self.attachments = []
+
+    def default_name(self):
+        return 'email:%s' % ','.join(self.config['to'])
+
+    def open(self, filename):
+        return EmailWriter(self, filename)
+
+    def finish(self):
+        if not self.attachments:
+            return
+        subject = "Your DB-backup for " + datetime.now().strftime("%d %b %Y")
+        body = "Timestamp of the backup is " + datetime.now().strftime("%d %b %Y")
+        address_from = self.config.get('from') or settings.SERVER_EMAIL
+        email = EmailMessage(subject, body, address_from, self.config['to'])
+        email.content_subtype = 'html'
+        for filename, content in self.attachments:
+            email.attach(filename, content, 'application/octet-stream')
+        email.send()
+
+
+DESTINATION_OPTIONS = ('type', 'name', 'rate_limit', 'retries')
+
+
+def get_destinations(configs):
+    '''
+    build destinations from BACKUP_DESTINATIONS. The type of each one is
+    'email' or a storage backend, which gets the remaining settings.
+    '''
+    destinations = []
+    for config in configs:
+        if config['type'] == 'email':
+            destinations.append(EmailDestination(config))
+            continue
+        storage_config = dict((k, v) for k, v in config.items() if k not in DESTINATION_OPTIONS)
+        storage_config['backend'] = config['type']
+        destinations.append(StorageDestination(config, get_storage(storage_config)))
+    return destinations
+
+
+class Writer(threading.Thread):
+    '''
+    writes one artifact to one destination, from the chunks it is handed
+    or, once detached, from the file itself.
+    '''
+
+    def __init__(self, destination, path, buffer, chunk_size=DEFAULT_CHUNK_SIZE):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.destination = destination
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.buffer = buffer
+        self.chunk_size = chunk_size
+        # only the reader adds to it, so qsize() never underestimates
+        self.queue = Queue.Queue()
+        self.offset = 0
+        self.detached = False
+        self.error = None
+        self.written = 0
+
+    def put(self, chunk):
+        '''
+        hand a chunk over without waiting. A writer with buffer chunks
+        queued already is detached instead. Returns False once the
+        destination has failed.
+        '''
+        if self.error is not None:
+            return False
+        if self.detached:
+            return True
+        if self.queue.qsize() >= self.buffer:
+            self.detached = True
+            self.queue.put(DETACH)
+        else:
+            self.queue.put(chunk)
+            self.offset += len(chunk)
+        return True
+
+    def end(self, complete=True):
+        if not self.detached:
+            self.queue.put(None if complete else ABORT)
+
+    def send(self, writer, chunk, started):
+        writer.write(chunk)
+        self.written += len(chunk)
+        self.throttle(started)
+
+    def send_rest(self, writer, started):
+        '''
+        read the file from where the queued chunks ended.
+        '''
+        f = open(self.path, 'rb')
+        try:
+            f.seek(self.offset)
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    return
+                self.send(writer, chunk, started)
+        finally:
+            f.close()
+
+    def throttle(self, started):
+        if self.destination.rate_limit:
+            ahead = float(self.written) / self.destination.rate_limit - (time.time() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def run(self):
+        started = time.time()
+        writer = None
+        try:
+            writer = self.destination.open(self.filename)
+            while True:
+                chunk = self.queue.get()
+                if chunk is None:
+                    break
+                if chunk is ABORT:
+                    raise IOError('could not read %s' % self.path)
+                if chunk is DETACH:
+                    self.send_rest(writer, started)
+                    break
+                self.send(writer, chunk, started)
+            writer.close()
+        except Exception, e:
+            self.error = e
+            if writer is not None:
+                try:
+                    writer.abort()
+                except Exception:
+                    pass
+        self.destination.seconds += time.time() - started
+
+
+def tee_file(path, destinations, chunk_size=DEFAULT_CHUNK_SIZE, buffer=DEFAULT_BUFFER):
+    '''
+    read path once and write it to every destination concurrently. Returns
+    {destination: error} for the destinations that failed.
+    '''
+    filename = os.path.basename(path)
+    writers = [Writer(destination, path, buffer, chunk_size) for destination in destinations]
+    for writer in writers:
+        writer.start()
+    complete = False
+    try:
+        f = open(path, 'rb')
+        try:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                active = [writer for writer in writers if not writer.detached and writer.error is None]
+                if not active:
+                    # the rest read on their own
+                    break
+                for writer in active:
+                    writer.put(chunk)
+        finally:
+            f.close()
+        complete = True
+    finally:
+        for writer in writers:
+            writer.end(complete)
+        for writer in writers:
+            writer.join()
+    failed = {}
+    for writer in writers:
+        if writer.error is None:
+            writer.destination.sent.append(filename)
+            writer.destination.bytes += writer.written
+        else:
+            failed[writer.destination] = writer.error
+    return failed
+
+
+def fan_out(paths, destinations, chunk_size=DEFAULT_CHUNK_SIZE, buffer=DEFAULT_BUFFER):
+    '''
+    send every file to every destination. A destination that fails an
+    artifact retries it on its own, up to its retry count.
+    '''
+    for path in paths:
+        print 'Sending %s to %s' % (path, ', '.join(d.name for d in destinations))
+        failed = tee_file(path, destinations, chunk_size, buffer)
+        for destination, error in failed.items():
+            for attempt in range(destination.retries):
+                print '%s failed for %s (%s), retrying' % (destination.name, path, error)
+                error = tee_file(path, [destination], chunk_size, buffer).get(destination)
+                if error is None:
+                    break
+            if error is not None:
+                print '%s gave up on %s: %s' % (destination.name, path, error)
+                destination.failed.append(os.path.basename(path))
+    for destination in destinations:
+        try:
+            destination.finish()
+        except Exception, e:
+            print '%s failed to finish: %s' % (destination.name, e)
+            destination.failed.extend(destination.sent)
+            destination.sent = []
+        destination.close()
+    return destinations
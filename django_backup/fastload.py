@@ -0,0 +1,287 @@
+'''
+Fast loading of database dumps.
+
+Replaying a dump statement by statement checks every constraint, updates
+every index and commits every row. The fast loaders keep the dump as it is
+but change how it is fed to the server:
+
+MySQL: the dump is streamed to one ``mysql`` session with foreign key and
+unique checks off and autocommit off, committing every ``batch`` INSERT
+statements. The previous session values are put back when the load ends.
+
+PostgreSQL: the ``pg_dump`` script is split on its ``-- Name: ...; Type:
+...`` headers. The schema is created first, the table data is loaded by
+several sessions at once with synchronous_commit off, then the indexes and
+constraints are built in parallel sessions with a larger
+maintenance_work_mem, the foreign keys after them, and the remaining
+post-data items last. The settings are per session, so nothing has to be
+reset afterwards. The tables are analyzed at the end. The DROP statements
+``pg_dump --clean`` starts with are only run when the database is not new,
+as without ``--if-exists`` they fail on the objects that don't exist.
+
+Both count the rows of every table while reading the dump, and
+check_row_counts compares that with the restored tables.
+'''
+import os
+import re
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+from django_backup.db import ClientError
+
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH = 64
+DEFAULT_MAINTENANCE_WORK_MEM = '512MB'
+
+MYSQL_PROLOGUE = '''SET @FASTLOAD_AUTOCOMMIT=@@AUTOCOMMIT, AUTOCOMMIT=0;
+SET @FASTLOAD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0;
+SET @FASTLOAD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0;
+'''
+MYSQL_EPILOGUE = '''COMMIT;
+SET FOREIGN_KEY_CHECKS=@FASTLOAD_FOREIGN_KEY_CHECKS;
+SET UNIQUE_CHECKS=@FASTLOAD_UNIQUE_CHECKS;
+SET AUTOCOMMIT=@FASTLOAD_AUTOCOMMIT;
+'''
+
+MYSQL_INSERT = re.compile(r'^INSERT INTO (`(?:[^`]|``)+`)')
+# string literals as mysqldump escapes them, so separators inside them
+# are not counted as rows
+MYSQL_STRING = re.compile(r"'(?:[^'\\]|\\.)*'", re.S)
+
+PG_HEADER = re.compile(r'^-- (?:Data for )?Name: (.*?); Type: (.*?); Schema: (.*?);')
+PG_COPY = re.compile(r'^COPY (\S+) ')
+PG_TABLE = re.compile(r'\b(?:ALTER TABLE|ON)(?: ONLY)? ([^\s(]+)')
+PG_SESSION = re.compile(r'^(SET |SELECT pg_catalog\.set_config)')
+PG_CLEAN = re.compile(r'^(DROP |ALTER )')
+PG_DATA_TYPES = ('TABLE DATA', 'SEQUENCE SET', 'BLOB', 'BLOBS', 'BLOB DATA', 'LARGE OBJECT')
+PG_INDEX_TYPES = ('INDEX', 'CONSTRAINT')
+PG_FK_TYPES = ('FK CONSTRAINT',)
+PG_LOAD_SETTINGS = ['SET synchronous_commit = off;\n']
+
+
+def count_mysql_rows(line):
+    '''
+    the rows in an extended INSERT statement.
+    '''
+    values = line[line.find(' VALUES ') + 8:]
+    return MYSQL_STRING.sub('', values).count('),(') + 1
+
+
+def mysql_fast_load(client, path, batch=DEFAULT_BATCH):
+    '''
+    load a mysqldump file with checks off and batched commits. Returns
+    {table: rows} as counted in the dump.
+    '''
+    counts = {}
+    process = client.open_script()
+    source = open(path, 'rb')
+    try:
+        try:
+            process.stdin.write(MYSQL_PROLOGUE)
+            inserts = 0
+            for line in source:
+                match = MYSQL_INSERT.match(line)
+                if match:
+                    table = match.group(1)
+                    counts[table] = counts.get(table, 0) + count_mysql_rows(line)
+                    inserts += 1
+                process.stdin.write(line)
+                if match and inserts % batch == 0:
+                    process.stdin.write('COMMIT;\n')
+            process.stdin.write(MYSQL_EPILOGUE)
+        except IOError, e:
+            raise ClientError('mysql stopped reading the dump: %s' % e)
+    finally:
+        source.close()
+        process.stdin.close()
+        code = process.wait()
+    if code != 0:
+        raise ClientError('mysql exited with %d loading %s' % (code, path))
+    return counts
+
+
+class PostgresDump(object):
+    '''
+    a pg_dump script split into sections. Table data goes straight to
+    ``workers`` script files, balanced by size, the rest is small enough
+    to keep in memory.
+    '''
+
+    def __init__(self, path, workdir, workers=DEFAULT_WORKERS):
+        self.path = path
+        self.session = []
+        self.clean = []
+        self.pre = []
+        self.post = []
+        self.indexes = []
+        self.foreign_keys = []
+        self.counts = {}
+        self.data_files = [os.path.join(workdir, 'data_%d.sql' % i) for i in range(workers)]
+        self.data_sizes = [0] * workers
+
+    def split(self):
+        outputs = [open(i, 'wb') for i in self.data_files]
+        source = open(self.path, 'rb')
+        try:
+            self._split(source, outputs)
+        finally:
+            source.close()
+            for output in outputs:
+                output.close()
+        return self
+
+    def schema(self, clean=True):
+        '''
+        the script creating the schema, with the DROP statements of a
+        --clean dump when clean.
+        '''
+        if not clean or not self.clean:
+            return self.pre
+        return self.session + self.clean + self.pre
+
+    def _split(self, source, outputs):
+        target = self.pre
+        data = None         # index of the data file being written
+        seen_header = False
+        seen_data = False
+        copy_table = None
+        for line in source:
+            if copy_table is not None:
+                # rows of a COPY block, up to its \.
+                if line == '\\.\n':
+                    copy_table = None
+                else:
+                    self.counts[copy_table] += 1
+            else:
+                header = PG_HEADER.match(line)
+                if header:
+                    kind = header.group(2)
+                    data = None
+                    seen_header = True
+                    if kind in PG_DATA_TYPES:
+                        seen_data = True
+                        data = self.data_sizes.index(min(self.data_sizes))
+                    elif kind in PG_INDEX_TYPES:
+                        target = []
+                        self.indexes.append(target)
+                    elif kind in PG_FK_TYPES:
+                        target = []
+                        self.foreign_keys.append(target)
+                    elif seen_data or self.indexes or self.foreign_keys:
+                        # a schema-only dump has no data between the two
+                        target = self.post
+                    else:
+                        target = self.pre
+                elif not seen_header and PG_CLEAN.match(line):
+                    # --clean drops everything before the first item
+                    self.clean.append(line)
+                    continue
+                elif target is self.pre and not seen_data and PG_SESSION.match(line):
+                    # the session settings every parallel session repeats
+                    self.session.append(line)
+                if data is not None:
+                    copy = PG_COPY.match(line)
+                    if copy and line.rstrip().endswith('FROM stdin;'):
+                        copy_table = copy.group(1)
+                        self.counts.setdefault(copy_table, 0)
+            if data is not None:
+                if not self.data_sizes[data]:
+                    # each data file runs in its own session
+                    outputs[data].writelines(self.session + PG_LOAD_SETTINGS)
+                outputs[data].write(line)
+                self.data_sizes[data] += len(line)
+            else:
+                target.append(line)
+
+
+def group_by_table(items, workers):
+    '''
+    spread index or constraint items over workers, keeping the items of a
+    table together so parallel sessions don't queue on its lock.
+    '''
+    tables = {}
+    for item in items:
+        match = PG_TABLE.search(''.join(line for line in item if not line.startswith('--')))
+        tables.setdefault(match.group(1) if match else None, []).extend(item)
+    groups = [[] for i in range(workers)]
+    for lines in sorted(tables.values(), key=len, reverse=True):
+        min(groups, key=len).extend(lines)
+    return [group for group in groups if group]
+
+
+def write_script(path, *parts):
+    f = open(path, 'wb')
+    try:
+        for part in parts:
+            f.writelines(part)
+    finally:
+        f.close()
+    return path
+
+
+def run_parallel(client, paths, log, workers):
+    pool = ThreadPool(max(1, min(workers, len(paths))))
+    try:
+        pool.map(lambda path: client.run_file(path, log), paths, chunksize=1)
+    finally:
+        pool.terminate()
+
+
+def postgresql_fast_load(client, path, workers=DEFAULT_WORKERS, log=None,
+                         maintenance_work_mem=DEFAULT_MAINTENANCE_WORK_MEM, clean=True):
+    '''
+    load a pg_dump script section by section, loading the data and
+    building the indexes in parallel. clean is False when the database was
+    just created, and there is nothing to drop. Returns {table: rows} as
+    counted in the dump.
+    '''
+    workdir = tempfile.mkdtemp(prefix='fastload_', dir=os.path.dirname(path))
+    try:
+        dump = PostgresDump(path, workdir, workers).split()
+        session = dump.session
+        build_settings = ["SET maintenance_work_mem = '%s';\n" % maintenance_work_mem]
+
+        print '\tcreating schema'
+        client.run_file(write_script(os.path.join(workdir, 'pre.sql'), dump.schema(clean)), log)
+
+        print '\tloading data in %d sessions' % len([i for i in dump.data_sizes if i])
+        scripts = [data_file for data_file, size in zip(dump.data_files, dump.data_sizes) if size]
+        run_parallel(client, scripts, log, workers)
+
+        for name, items in (('indexes', dump.indexes), ('foreign keys', dump.foreign_keys)):
+            groups = group_by_table(items, workers)
+            print '\tbuilding %d %s in %d sessions' % (len(items), name, len(groups))
+            scripts = [write_script(os.path.join(workdir, '%s_%d.sql' % (name.replace(' ', '_'), i)),
+                                    session, build_settings, group)
+                       for i, group in enumerate(groups)]
+            run_parallel(client, scripts, log, workers)
+
+        print '\tfinishing'
+        client.run_file(write_script(os.path.join(workdir, 'post.sql'), session, dump.post, ['ANALYZE;\n']), log)
+        return dump.counts
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def check_row_counts(client, expected, workers=DEFAULT_WORKERS):
+    '''
+    compare the rows of the restored tables with the rows counted in the
+    dump. Returns {table: (expected, restored)} for the tables that differ.
+    '''
+    tables = sorted(expected)
+    chunks = [tables[i::workers] for i in range(workers)]
+
+    def count(chunk):
+        sql = ' UNION ALL '.join("SELECT '%s', COUNT(*) FROM %s" % (table.replace("'", "''"), table)
+                                 for table in chunk)
+        return client.query(sql)
+
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(count, [chunk for chunk in chunks if chunk])
+    finally:
+        pool.terminate()
+    restored = dict((table, int(rows)) for result in results for table, rows in result)
+    return dict((table, (expected[table], restored.get(table)))
+                for table in tables if restored.get(table) != expected[table])
@@ -0,0 +1,473 @@
+'''
+Table-level incremental database backups.
+
+Most tables don't change from one night to the next. An incremental backup
+is a ``backup_<ts>.tables`` manifest naming one artifact per table, below
+``tables/``. Only the tables whose change signal differs from the previous
+manifest are dumped; the others point at the artifact an earlier backup
+stored. The signals are cheap to read:
+
+* MySQL: CREATE_TIME and UPDATE_TIME from information_schema.tables, or
+  CHECKSUM TABLE for engines that don't keep UPDATE_TIME. MySQL 8 caches
+  these for information_schema_stats_expiry seconds, so the cache is
+  turned off for the session that reads them.
+* PostgreSQL: the insert, update and delete counters of pg_stat_user_tables
+  and the relation's file node, which TRUNCATE changes, plus the time the
+  statistics were last reset and the server started, since a reset or a
+  crash puts the counters back to 0
+
+plus a hash of the table's columns, so a schema change dumps the table
+again. A signal that can't be trusted is not recorded, which dumps the
+table now and in the next backup: an UPDATE_TIME in the last seconds, or
+PostgreSQL counters that moved while they were read twice, UNSETTLED_SECONDS
+apart, since backends report them a little after they commit. With
+track_counts off no PostgreSQL signal is trusted, and a counter lower than
+in the previous backup, as after pg_stat_reset_single_table_counters,
+dumps every table.
+
+The schema is small and is dumped in full every time, split in two parts.
+The pre-data part holds the tables. The post-data part holds the indexes,
+constraints and triggers. Restoring assembles one script in this order:
+pre-data schema, every table's data, post-data schema.
+
+Artifacts no manifest refers to any more are removed by collect_garbage.
+'''
+import gzip
+import hashlib
+import json
+import os
+import re
+import subprocess
+import tempfile
+import time
+import zlib
+
+from django_backup.db import ClientError
+from django_backup.fastload import PostgresDump, PG_HEADER
+from django_backup.storage import COPY_CHUNK_SIZE
+
+TABLES_SUFFIX = '.tables'
+ARTIFACT_DIR = 'tables'
+FORMAT = 1
+# an UPDATE_TIME this close to the server's clock may miss a write made in
+# the same second, and PostgreSQL backends report their counters up to a
+# second after they commit
+UNSETTLED_SECONDS = 2
+
+MYSQL_SIGNALS = '''SET SESSION group_concat_max_len = 1048576;
+SELECT t.table_name, t.create_time, t.update_time, TIMESTAMPDIFF(SECOND, t.update_time, NOW()),
+MD5(GROUP_CONCAT(c.column_name, ' ', c.column_type ORDER BY c.ordinal_position))
+FROM information_schema.tables t JOIN information_schema.columns c
+ON c.table_schema = t.table_schema AND c.table_name = t.table_name
+WHERE t.table_schema = DATABASE() AND t.table_type = 'BASE TABLE'
+GROUP BY t.table_name, t.create_time, t.update_time'''
+MYSQL_STATS_EXPIRY = "SHOW VARIABLES LIKE 'information_schema_stats_expiry'"
+POSTGRESQL_SIGNALS = '''SELECT s.schemaname, s.relname, s.n_tup_ins, s.n_tup_upd, s.n_tup_del,
+pg_relation_filenode(s.relid),
+md5(string_agg(a.attname || ' ' || format_type(a.atttypid, a.atttypmod), ',' ORDER BY a.attnum)),
+current_setting('track_counts'),
+(SELECT coalesce(d.stats_reset::text, '') FROM pg_stat_database d WHERE d.datname = current_database())
+|| ' ' || pg_postmaster_start_time()
+FROM pg_stat_user_tables s JOIN pg_attribute a ON a.attrelid = s.relid AND a.attnum > 0 AND NOT a.attisdropped
+GROUP BY 1, 2, 3, 4, 5, 6'''
+POSTGRESQL_SEQUENCES = '''SELECT n.nspname, c.relname FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind = 'S' AND n.nspname NOT IN ('pg_catalog', 'information_schema')'''
+
+MYSQL_DATA_HEADER = re.compile(r'^-- Dumping data for table `((?:[^`]|``)+)`')
+
+
+class IncrementalError(Exception):
+    pass
+
+
+def is_incremental(filename):
+    return filename.endswith(TABLES_SUFFIX)
+
+
+def artifact_name(time_suffix, part):
+    return '%s/%s-%s.sql.gz' % (ARTIFACT_DIR, time_suffix, hashlib.md5(part).hexdigest()[:16])
+
+
+def table_signals(client, exclude=(), checksum=True, settle=UNSETTLED_SECONDS):
+    '''
+    {table: signal} for the tables of the database, the signal None when it
+    can't be trusted. PostgreSQL counters are read twice, settle seconds
+    apart.
+    '''
+    if client.is_mysql:
+        return mysql_signals(client, exclude, checksum)
+    signals = postgresql_signals(client, exclude)
+    if settle:
+        time.sleep(settle)
+        later = postgresql_signals(client, exclude)
+        for table, signal in signals.items():
+            if later.get(table) != signal:
+                signals[table] = None
+    return signals
+
+
+def mysql_signals(client, exclude=(), checksum=True):
+    signals = {}
+    unknown = []
+    sql = MYSQL_SIGNALS
+    if client.query(MYSQL_STATS_EXPIRY):
+        # MySQL 8 serves UPDATE_TIME from a cache refreshed once a day
+        sql = 'SET SESSION information_schema_stats_expiry = 0;\n' + sql
+    for name, created, updated, age, columns in client.query(sql):
+        if name in exclude:
+            continue
+        if updated == 'NULL':
+            # InnoDB before 5.7 and some other engines keep no UPDATE_TIME
+            unknown.append(name)
+            signals[name] = [created, None, columns] if checksum else None
+        elif int(age) > UNSETTLED_SECONDS:
+            signals[name] = [created, updated, columns]
+        else:
+            signals[name] = None
+    if unknown and checksum:
+        sql = 'CHECKSUM TABLE %s' % ', '.join(client.quote_name(name) for name in unknown)
+        for qualified, value in client.query(sql):
+            name = qualified.split('.', 1)[-1]
+            if name in signals and value != 'NULL':
+                signals[name][1] = 'checksum:%s' % value
+        for name in unknown:
+            if signals[name][1] is None:
+                signals[name] = None
+    return signals
+
+
+def postgresql_signals(client, exclude=()):
+    signals = {}
+    for row in client.query(POSTGRESQL_SIGNALS):
+        schema, name, inserted, updated, deleted, filenode, columns, track_counts, epoch = row
+        key = '%s.%s' % (schema, name)
+        if key in exclude or name in exclude:
+            continue
+        if track_counts != 'on':
+            # the counters never move
+            signals[key] = None
+        else:
+            signals[key] = [inserted, updated, deleted, filenode, columns, epoch]
+    return signals
+
+
+def read_manifest(storage, name):
+    stream = storage.get_stream(name)
+    try:
+        return json.loads(stream.read())
+    finally:
+        stream.close()
+
+
+def latest_manifest(storage):
+    '''
+    the newest manifest on storage, or None.
+    '''
+    try:
+        names = sorted(i for i in storage.listdir() if is_incremental(i))
+    except (IOError, OSError):
+        return None
+    if not names:
+        return None
+    return read_manifest(storage, names[-1])
+
+
+def counters_went_down(signal, previous):
+    '''
+    whether the PostgreSQL counters of a table are lower than in the
+    previous backup, so they were reset since.
+    '''
+    if signal is None or previous is None or len(signal) != 6 or len(previous) != 6:
+        return False
+    try:
+        return any(int(now) < int(before) for now, before in zip(signal[:3], previous[:3]))
+    except (TypeError, ValueError):
+        return False
+
+
+def changed_tables(signals, previous):
+    '''
+    the tables to dump given the signals and the manifests of the previous
+    backups the new one will be compared with. All of them when some
+    counters were reset, the others can't be trusted either.
+    '''
+    changed = set()
+    for table, signal in signals.items():
+        for manifest in previous:
+            entry = manifest and manifest['tables'].get(table)
+            if entry is not None and counters_went_down(signal, entry['signal']):
+                return set(signals)
+            if signal is None or entry is None or entry['signal'] != signal:
+                changed.add(table)
+    return changed
+
+
+def gzip_file(path, lines):
+    out = gzip.open(path, 'wb', 6)
+    try:
+        out.writelines(lines)
+    finally:
+        out.close()
+
+
+class GzipSections(object):
+    '''
+    writes the sections of a dump to one gzip file each.
+    '''
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.paths = {}
+        self.current = None
+
+    def open(self, key):
+        self.close()
+        path = os.path.join(self.workdir, 'table_%d.sql.gz' % len(self.paths))
+        self.paths[key] = path
+        self.current = gzip.open(path, 'wb', 6)
+
+    def write(self, line):
+        self.current.write(line)
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+
+class TableDump(object):
+    '''
+    the dumps of one incremental run: the schema in full and the data of the
+    changed tables, one gzip file per table in workdir.
+    '''
+
+    def __init__(self, client, workdir, dump_path=None):
+        self.client = client
+        self.workdir = workdir
+        self.dump_path = dump_path
+        self.schema = self.post = self.extra = None
+        self.tables = {}
+        self.prologue = self.epilogue = ''
+
+    def run(self, args):
+        process = subprocess.Popen(self.client.dump_command(self.dump_path) + args,
+                                   stdout=subprocess.PIPE, env=self.client.env())
+        return process
+
+    def wait(self, process):
+        process.stdout.close()
+        code = process.wait()
+        if code != 0:
+            raise ClientError('%s exited with %d' % (self.dump_path or 'the dump', code))
+
+    def dump(self, tables):
+        if self.client.is_mysql:
+            self.dump_mysql(sorted(tables))
+        else:
+            self.dump_postgresql(sorted(tables))
+        missing = set(tables) - set(self.tables)
+        if missing:
+            raise IncrementalError('the dump has no data for %s' % ', '.join(sorted(missing)))
+        return self
+
+    def dump_to(self, name, args, compress=True):
+        path = os.path.join(self.workdir, name)
+        process = self.run(args)
+        try:
+            if compress:
+                gzip_file(path, process.stdout)
+            else:
+                out = open(path, 'wb')
+                try:
+                    out.writelines(process.stdout)
+                finally:
+                    out.close()
+        finally:
+            self.wait(process)
+        return path
+
+    def dump_mysql(self, tables):
+        db = [self.client.name]
+        self.schema = self.dump_to('schema.sql.gz', ['--no-data', '--skip-triggers'] + db)
+        self.post = self.dump_to('post.sql.gz', ['--no-data', '--no-create-info', '--triggers'] + db)
+        if not tables:
+            return
+        process = self.run(['--no-create-info', '--skip-triggers'] + db + tables)
+        sections = GzipSections(self.workdir)
+        prologue, epilogue = [], []
+        unlocked = False
+        try:
+            for line in process.stdout:
+                header = MYSQL_DATA_HEADER.match(line)
+                if header:
+                    sections.open(header.group(1).replace('``', '`'))
+                    epilogue, unlocked = [], False
+                if sections.current is None:
+                    prologue.append(line)
+                elif unlocked:
+                    # what follows the last table restores the session
+                    epilogue.append(line)
+                else:
+                    sections.write(line)
+                    unlocked = line.startswith('UNLOCK TABLES;')
+        finally:
+            sections.close()
+            self.wait(process)
+        self.tables = sections.paths
+        self.prologue = ''.join(prologue)
+        self.epilogue = ''.join(epilogue)
+
+    def dump_postgresql(self, tables):
+        schema_file = self.dump_to('schema_plain.sql', ['--schema-only', '--clean', '--if-exists', self.client.name],
+                                   compress=False)
+        schema = PostgresDump(schema_file, self.workdir, 1).split()
+        os.remove(schema_file)
+        self.schema = os.path.join(self.workdir, 'schema.sql.gz')
+        gzip_file(self.schema, schema.schema())
+        self.post = os.path.join(self.workdir, 'post.sql.gz')
+        gzip_file(self.post, schema.session + sum(schema.indexes, []) + sum(schema.foreign_keys, []) + schema.post)
+
+        q = self.client.quote_name
+        selected = []
+        for table in tables:
+            namespace, name = table.split('.', 1)
+            selected += ['-t', '%s.%s' % (q(namespace), q(name))]
+        # sequences are tiny and move with their tables, dump them all
+        for namespace, name in self.client.query(POSTGRESQL_SEQUENCES):
+            selected += ['-t', '%s.%s' % (q(namespace), q(name))]
+        if not selected:
+            return
+        process = self.run(['--data-only'] + selected + [self.client.name])
+        sections = GzipSections(self.workdir)
+        prologue, extra = [], []
+        target = prologue
+        try:
+            for line in process.stdout:
+                header = PG_HEADER.match(line)
+                if header:
+                    name, kind, namespace = header.groups()
+                    if kind == 'TABLE DATA':
+                        sections.open('%s.%s' % (namespace, name))
+                        target = sections
+                    else:
+                        sections.close()
+                        target = extra
+                if target is sections:
+                    sections.write(line)
+                else:
+                    target.append(line)
+        finally:
+            sections.close()
+            self.wait(process)
+        self.tables = sections.paths
+        self.prologue = ''.join(prologue)
+        if extra:
+            self.extra = os.path.join(self.workdir, 'extra.sql.gz')
+            gzip_file(self.extra, extra)
+
+
+def store_backup(storage, name, time_suffix, dump, signals, previous):
+    '''
+    store the artifacts of dump and the manifest name on storage, pointing
+    the tables that were not dumped at the artifacts of the previous
+    manifest. Returns (artifacts stored, bytes stored).
+    '''
+    storage.ensure()
+    stored = size = 0
+
+    def put(part, path):
+        artifact = artifact_name(time_suffix, part)
+        storage.put_file(artifact, path)
+        return artifact, os.path.getsize(path)
+
+    manifest = {
+        'format': FORMAT,
+        'engine': dump.client.engine,
+        'tables': {},
+        'extra': None,
+    }
+    for part in ('schema', 'post', 'extra'):
+        path = getattr(dump, part)
+        if path is not None:
+            manifest[part], part_size = put(':' + part, path)
+            stored += 1
+            size += part_size
+    if dump.tables:
+        manifest['prologue'] = dump.prologue
+        manifest['epilogue'] = dump.epilogue
+    else:
+        manifest['prologue'] = previous and previous.get('prologue') or ''
+        manifest['epilogue'] = previous and previous.get('epilogue') or ''
+    for table, signal in sorted(signals.items()):
+        if table in dump.tables:
+            artifact, table_size = put(table, dump.tables[table])
+            manifest['tables'][table] = {'artifact': artifact, 'signal': signal, 'bytes': table_size}
+            stored += 1
+            size += table_size
+        else:
+            manifest['tables'][table] = previous['tables'][table]
+    writer = storage.open_writer(name)
+    writer.write(json.dumps(manifest, sort_keys=True, indent=1))
+    writer.close()
+    return stored, size
+
+
+def referenced(manifest):
+    names = set(entry['artifact'] for entry in manifest['tables'].values())
+    names.update(manifest[part] for part in ('schema', 'post', 'extra') if manifest.get(part))
+    return names
+
+
+def copy_gzipped(storage, name, out):
+    stream = storage.get_stream(name)
+    try:
+        # storage streams don't seek, which GzipFile needs
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            chunk = stream.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(decompressor.decompress(chunk))
+        out.write(decompressor.flush())
+    finally:
+        stream.close()
+
+
+def assemble(storage, name, out):
+    '''
+    write the full database script of manifest name to out: the schema,
+    every table's data and the post-data schema.
+    '''
+    manifest = read_manifest(storage, name)
+    copy_gzipped(storage, manifest['schema'], out)
+    out.write(manifest['prologue'])
+    for table in sorted(manifest['tables']):
+        copy_gzipped(storage, manifest['tables'][table]['artifact'], out)
+    if manifest.get('extra'):
+        copy_gzipped(storage, manifest['extra'], out)
+    out.write(manifest['epilogue'])
+    copy_gzipped(storage, manifest['post'], out)
+    return manifest
+
+
+def collect_garbage(storage):
+    '''
+    delete the artifacts no manifest refers to. Returns the number deleted.
+    '''
+    keep = set()
+    for name in storage.listdir():
+        if is_incremental(name):
+            keep.update(referenced(read_manifest(storage, name)))
+    try:
+        artifacts = ['%s/%s' % (ARTIFACT_DIR, i) for i in storage.listdir(ARTIFACT_DIR)]
+    except (IOError, OSError):
+        return 0
+    garbage = [i for i in artifacts if i not in keep]
+    for i in range(0, len(garbage), 1000):
+        storage.delete_batch(garbage[i:i + 1000])
+    return len(garbage)
+
+
+def make_workdir(directory):
+    return tempfile.mkdtemp(prefix='tables_', dir=directory)
@@ -6,25 +6,67 @@ from datetime import datetime
 from datetime import timedelta
 from optparse import make_option
 import re
+import shutil
+import subprocess
+import threading
 
 from django.core.management.base import BaseCommand, CommandError
 from django.core.mail import EmailMessage
 from django.conf import settings
 from django.db import connection
+from django.utils.html import escape
 
-import pysftp as ssh
+from django_backup import adaptive
+from django_backup import archive
+from django_backup import connections
+from django_backup import cas
+from django_backup import crypto
+from django_backup import delta
+from django_backup import drill
+from django_backup import fanout
+from django_backup import incremental
+from django_backup import plan
+from django_backup.db import ClientError, DatabaseClient
+from django_backup.report import RunReport, get_report_file, read_history
+from django_backup.storage import (LocalStorage, PART_SUFFIX, StorageError, copy_stream, get_default_storage,
+                                   is_partial)
+from django_backup.snapshots import SnapshotIndex, format_size, remove_snapshots, DEFAULT_WORKERS
 
 TIME_FORMAT = '%Y%m%d-%H%M%S'
 regex = re.compile(r'(\d){8}-(\d){6}')
 GOOD_RSYNC_FLAG = '__good_backup'
 
 
+def feed_stream(source, target, counted):
+    '''
+    copy source into target and close it, appending the bytes copied to
+    counted. The copy stops when target goes away.
+    '''
+    try:
+        counted.append(copy_stream(source, target))
+    except IOError:
+        # gzip died, its exit code says why
+        pass
+    finally:
+        try:
+            target.close()
+        except IOError:
+            pass
+
+
+def is_sidecar(filename):
+    '''
+    files stored next to a backup that are not backups themselves.
+    '''
+    return filename.endswith(delta.SIGNATURE_SUFFIX) or drill.is_checks(filename)
+
+
 def is_db_backup(filename):
-    return filename.startswith('backup_')
+    return filename.startswith('backup_') and not is_sidecar(filename) and not is_partial(filename)
 
 
 def is_media_backup(filename):
-    return filename.startswith('dir_')
+    return filename.startswith('dir_') and not is_partial(filename)
 
 
 def is_backup(filename):
@@ -107,14 +149,24 @@ class Command(BaseCommand):
             help='Sends email with attached dump file'),
         make_option('--ftp', '-f', action='store_true', default=False, dest='ftp',
             help='Backup file via FTP'),
+        make_option('--fanout', action='store_true', default=False, dest='fanout',
+            help='Send backups to every destination in BACKUP_DESTINATIONS from a single read'),
+        make_option('--delta', action='store_true', default=False, dest='delta',
+            help='Upload database dumps as a delta against the previous remote dump'),
         make_option('--compress', '-c', action='store_true', default=False, dest='compress',
             help='Compress dump file'),
+        make_option('--adaptive', action='store_true', default=False, dest='adaptive',
+            help='Compress the dump with the gzip level that keeps compression and upload busy'),
+        make_option('--encrypt', action='store_true', default=False, dest='encrypt',
+            help='Encrypt dump and media files'),
         make_option('--directory', '-d', action='append', default=[], dest='directories',
             help='Destination Directory'),
         make_option('--media', '-m', action='store_true', default=False, dest='media',
             help='Backup media dir'),
         make_option('--rsync', '-r', action='store_true', default=False, dest='rsync',
             help='Backup media dir with rsync'),
+        make_option('--cas', action='store_true', default=False, dest='cas',
+            help='Backup media dir into a content-addressed store'),
         make_option('--cleandb', action='store_true', default=False, dest='clean_db',
             help='Clean up surplus database backups'),
         make_option('--cleanmedia', action='store_true', default=False, dest='clean_media',
@@ -137,6 +189,18 @@ class Command(BaseCommand):
             help='Clean up local broken rsync backups'),
         make_option('--cleanremotersync', action='store_true', default=False, dest='clean_remote_rsync',
             help='Clean up remote broken rsync backups'),
+        make_option('--rsyncusage', action='store_true', default=False, dest='rsync_usage',
+            help='Report the space held by each local rsync backup'),
+        make_option('--plan', action='store_true', default=False, dest='plan',
+            help='Estimate the sizes and duration of the backup without running it'),
+        make_option('--preflight', action='store_true', default=False, dest='preflight',
+            help='Check the local free space first, streaming the dump or refusing to start when short'),
+        make_option('--stream', action='store_true', default=False, dest='stream',
+            help='Compress the dump as it is written instead of from a plain dump file'),
+        make_option('--incremental', action='store_true', default=False, dest='incremental',
+            help='Dump only the tables that changed since the last backup'),
+        make_option('--checks', action='store_true', default=False, dest='checks',
+            help='Record the row counts and checksums of the tables for restore --drill'),
     )
     help = "Backup database. Only Mysql and Postgresql engines are implemented"
 
@@ -144,10 +208,16 @@ class Command(BaseCommand):
         self.time_suffix = time.strftime(TIME_FORMAT)
         self.email = options.get('email')
         self.ftp = options.get('ftp')
-        self.compress = options.get('compress')
-        self.directories = options.get('directories')
+        self.fanout = options.get('fanout')
+        self.adaptive = options.get('adaptive')
+        self.compress = options.get('compress') or self.adaptive
+        self.delta = options.get('delta')
+        self.encrypt = options.get('encrypt')
+        # copied, the option default is shared between call_command() runs
+        self.directories = list(options.get('directories') or [])
         self.media = options.get('media')
         self.rsync = options.get('rsync')
+        self.cas = options.get('cas')
         self.clean = options.get('clean')
         self.clean_db = options.get('clean_db')
         self.clean_media = options.get('clean_media')
@@ -160,6 +230,18 @@ class Command(BaseCommand):
         self.clean_remote_rsync = options.get('clean_remote_rsync') and self.rsync #only when rsync is True
         self.no_local = options.get('no_local')
         self.delete_local = options.get('delete_local')
+        self.rsync_usage = options.get('rsync_usage')
+        self.plan = options.get('plan')
+        self.preflight = options.get('preflight')
+        self.stream = options.get('stream')
+        self.incremental = options.get('incremental')
+        self.checks = options.get('checks')
+        self.uploaded = set()
+        # bytes uploaded and the seconds spent sending them
+        self.sent_bytes = 0
+        self.send_seconds = 0.0
+        self.media_source_bytes = None
+        self.media_errors = []
 
         try:
             self.engine = settings.DATABASES['default']['ENGINE']
@@ -181,6 +263,45 @@ class Command(BaseCommand):
         self.ftp_server = getattr(settings, 'BACKUP_FTP_SERVER', '')
         self.ftp_username = getattr(settings, 'BACKUP_FTP_USERNAME', '')
         self.ftp_password = getattr(settings, 'BACKUP_FTP_PASSWORD', '')
+        self.prune_workers = getattr(settings, 'BACKUP_PRUNE_WORKERS', DEFAULT_WORKERS)
+        if self.adaptive and (self.encrypt or self.delta):
+            print '--adaptive does not apply with --encrypt or --delta, compressing with gzip'
+            self.adaptive = False
+        if self.incremental:
+            if self.fanout:
+                raise CommandError('--incremental does not work with --fanout')
+            if self.encrypt:
+                # the tables would be uploaded in the clear
+                raise CommandError('--incremental does not work with --encrypt')
+            ignored = [option for option in ('compress', 'delta', 'stream') if getattr(self, option)]
+            if ignored:
+                print '--incremental stores every table gzipped, ignoring --%s' % ', --'.join(ignored)
+            self.compress = self.adaptive = self.delta = self.stream = False
+        if self.encrypt:
+            try:
+                self.encryption_key = crypto.load_key(settings)
+            except crypto.EncryptionError, e:
+                raise CommandError(str(e))
+            self.encryption_workers = getattr(settings, 'BACKUP_ENCRYPTION_WORKERS', crypto.DEFAULT_WORKERS)
+
+        # Backing up media directories,
+        if self.media:
+            self.directories += [settings.MEDIA_ROOT]
+        if self.cas and self.encrypt and self.directories:
+            # blobs are named by the hash of their plain content, encrypting
+            # them would either leak that or lose the deduplication
+            raise CommandError('--encrypt does not work with --cas media backups')
+        if self.rsync and self.encrypt and self.directories:
+            # rsync copies the files themselves
+            raise CommandError('--encrypt does not work with --rsync media backups')
+
+        if self.rsync_usage:
+            self.report_rsync_usage()
+            return
+
+        if self.plan:
+            print '\n'.join(self.get_plan().lines())
+            return
 
         if self.clean_rsync:
             print 'cleaning broken rsync backups'
@@ -221,29 +342,113 @@ class Command(BaseCommand):
         if not os.path.exists(self.backup_dir):
             os.makedirs(self.backup_dir)
 
+        if self.preflight:
+            self.check_free_space()
+
+        self.report = RunReport(get_report_file(settings, self.backup_dir), engine=self.engine,
+                                database=self.db, compress=self.compress, adaptive=self.adaptive,
+                                stream=self.stream, incremental=self.incremental)
+        try:
+            # with the dump size, the plan's dump ratio for later runs
+            stats = self.get_database_stats()
+            if stats:
+                self.report.data['database_bytes'] = stats[0]
+            self.run_backup()
+        except Exception, e:
+            self.report.fail(e)
+            raise
+        finally:
+            self.report.save()
+        print '=' * 70
+        print self.report.summary()
+
+    def get_client(self):
+        return DatabaseClient(self.engine, self.db, self.user, self.passwd, self.host, self.port)
+
+    def signal_checksum(self):
+        return getattr(settings, 'BACKUP_INCREMENTAL_CHECKSUM', True)
+
+    def get_database_stats(self):
+        '''
+        (bytes, rows, tables) of the data to dump according to the
+        database's statistics, or None when they can't be read.
+        '''
+        if not hasattr(self, 'database_stats'):
+            self.database_stats = None
+            try:
+                self.database_stats = plan.database_stats(self.get_client(), exclude=self.get_blacklist_tables())
+            except (ClientError, OSError), e:
+                print 'could not read the database statistics: %s' % e
+        return self.database_stats
+
+    def get_plan(self):
+        runs = read_history(get_report_file(settings, self.backup_dir), plan.HISTORY_RUNS)
+        since = None
+        if runs:
+            since = time.mktime(time.strptime(runs[-1]['started'], '%Y-%m-%d %H:%M:%S'))
+        media = None
+        if self.directories:
+            print 'Walking media directories...'
+            media = plan.media_stats(self.directories,
+                                     getattr(settings, 'BACKUP_PLAN_WORKERS', plan.DEFAULT_WORKERS), since)
+            self.media_source_bytes = media[1]
+        mode = 'rsync' if self.rsync else 'cas' if self.cas else 'tar'
+        return plan.BackupPlan(runs, self.get_database_stats(), media, compress=self.compress or self.stream,
+                               mode=mode, upload=self.ftp or self.fanout, stream=self.stream)
+
+    def check_free_space(self):
+        '''
+        refuse to start a run that won't fit in BACKUP_LOCAL_DIRECTORY, or
+        stream the dump when that makes it fit.
+        '''
+        estimate = self.get_plan()
+        free = plan.free_space(self.backup_dir)
+        needed = estimate.local_bytes()
+        print 'preflight: %s needed, %s free in %s' % (format_size(needed), format_size(free), self.backup_dir)
+        max_seconds = getattr(settings, 'BACKUP_MAX_DURATION', None)
+        if max_seconds and estimate.total_seconds > max_seconds:
+            print 'preflight: the run is expected to take %ds, longer than BACKUP_MAX_DURATION' % (
+                estimate.total_seconds)
+        result = estimate.check_space(free)
+        if result == 'stream' and not self.stream:
+            print 'preflight: not enough space for a plain dump, streaming it into gzip'
+            self.stream = True
+        elif result is None:
+            raise CommandError('Not enough space in %s: %s needed, %s free' % (
+                self.backup_dir, format_size(needed), format_size(free)))
+
+    def run_backup(self):
         outfile = os.path.join(self.backup_dir, 'backup_%s.sql' % self.time_suffix)
 
-        # Doing backup
-        if self.engine == 'django.db.backends.mysql':
-            print 'Doing Mysql backup to database %s into %s' % (self.db, outfile)
-            self.do_mysql_backup(outfile)
-        # TODO reinstate postgres support
-        elif self.engine == 'django.db.backends.postgresql_psycopg2':
-            print 'Doing Postgresql backup to database %s into %s' % (self.db, outfile)
-            self.do_postgresql_backup(outfile)
-        else:
-            raise CommandError('Backup in %s engine not implemented' % self.engine)
+        if self.checks:
+            try:
+                signals = incremental.table_signals(self.get_client(), self.get_blacklist_tables(),
+                                                    self.signal_checksum())
+            except (ClientError, OSError), e:
+                raise CommandError('Could not read the tables before the dump: %s' % e)
 
-        # Compressing backup
-        if self.compress:
-            compressed_outfile = outfile + '.gz'
-            print 'Compressing backup file %s to %s' % (outfile, compressed_outfile)
-            self.do_compress(outfile, compressed_outfile)
-            outfile = compressed_outfile
+        if self.incremental:
+            with self.report.stage('dump', incremental=True) as record:
+                record.update(self.do_incremental_backup())
+            # the tables are stored as they are dumped
+            outfile = None
+        elif self.stream:
+            outfile += '.gz'
+            if self.encrypt:
+                outfile += crypto.ENCRYPTED_SUFFIX
+            print 'Streaming backup of database %s into %s' % (self.db, outfile)
+            with self.report.stage('dump', streamed=True) as record:
+                record.update(self.do_stream_backup(outfile))
+                record['bytes'] = os.path.getsize(outfile)
+        else:
+            with self.report.stage('dump') as record:
+                self.do_backup(outfile)
+                record['bytes'] = os.path.getsize(outfile)
+            outfile = self.compress_backup(outfile)
 
-        # Backing up media directories,
-        if self.media:
-            self.directories += [settings.MEDIA_ROOT]
+        db_outfiles = [outfile] if outfile else []
+        if self.checks:
+            db_outfiles.append(self.record_checks(signals))
 
         # Backing up directories
         dir_outfiles = []
@@ -251,35 +456,253 @@ class Command(BaseCommand):
         if self.directories:  # We need to do media backup
             all_directories = ' '.join(self.directories)
             self.all_directories = all_directories
-            if self.rsync:
-                self.do_media_rsync_backup()
-            else:
-                # Backup all the directories in one file.
-                all_outfile = os.path.join(self.backup_dir, 'dir_%s.tar.gz' % (self.time_suffix))
-                self.compress_dir(all_directories, all_outfile)
-                dir_outfiles.append(all_outfile)
+            with self.report.stage('media') as record:
+                if self.rsync:
+                    self.do_media_rsync_backup()
+                elif self.cas:
+                    self.do_media_cas_backup()
+                else:
+                    # Backup all the directories in one file.
+                    all_outfile = os.path.join(self.backup_dir, 'dir_%s.tar.gz' % (self.time_suffix))
+                    if self.encrypt:
+                        all_outfile += crypto.ENCRYPTED_SUFFIX
+                    try:
+                        self.compress_dir(self.directories, all_outfile)
+                    finally:
+                        if self.media_errors:
+                            record['errors'] = self.media_errors
+                    dir_outfiles.append(all_outfile)
+                    record['bytes'] = os.path.getsize(all_outfile)
+                    if self.media_source_bytes:
+                        record['source_bytes'] = self.media_source_bytes
+
+        if self.fanout:
+            print "Sending backups to all destinations"
+            with self.report.stage('upload') as record:
+                record['bytes'] = sum(os.path.getsize(i) for i in dir_outfiles + db_outfiles)
+                self.store_fanout(dir_outfiles + db_outfiles)
+                self.record_upload(record)
+            return
 
         # Sending mail with backups
         if self.email:
             print "Sending e-mail with backups to '%s'" % self.email
-            self.sendmail(settings.SERVER_EMAIL, [self.email], dir_outfiles + [outfile])
+            if self.incremental:
+                print 'incremental database backups are not sent by e-mail'
+            with self.report.stage('email'):
+                self.sendmail(settings.SERVER_EMAIL, [self.email], dir_outfiles + db_outfiles)
 
         if self.ftp:
             print "Saving to remote server"
-            self.store_ftp(local_files=[os.path.join(os.getcwd(), x) for x in dir_outfiles + [outfile]])
+            local_files = [os.path.join(os.getcwd(), x) for x in dir_outfiles + db_outfiles]
+            with self.report.stage('upload') as record:
+                record['bytes'] = sum(os.path.getsize(i) for i in local_files
+                                      if os.path.basename(i) not in self.uploaded)
+                self.store_ftp(local_files=local_files)
+                self.record_upload(record)
+
+    def record_upload(self, record):
+        '''
+        add what was sent and how long sending it took, including dumps
+        uploaded while they were compressed, to the upload stage's record.
+        '''
+        if self.sent_bytes and self.send_seconds:
+            record['sent_bytes'] = self.sent_bytes
+            record['send_seconds'] = round(self.send_seconds, 3)
+            print 'upload: %s in %.1fs (%s/s)' % (format_size(self.sent_bytes), self.send_seconds,
+                                                 format_size(self.sent_bytes / self.send_seconds))
+
+    def do_backup(self, outfile):
+        if self.engine == 'django.db.backends.mysql':
+            print 'Doing Mysql backup to database %s into %s' % (self.db, outfile)
+            self.do_mysql_backup(outfile)
+        # TODO reinstate postgres support
+        elif self.engine == 'django.db.backends.postgresql_psycopg2':
+            print 'Doing Postgresql backup to database %s into %s' % (self.db, outfile)
+            self.do_postgresql_backup(outfile)
+        else:
+            raise CommandError('Backup in %s engine not implemented' % self.engine)
+
+    def record_checks(self, signals):
+        '''
+        write the row counts and checksums of the tables next to the dump,
+        for restore --drill. signals are the tables' change signals from
+        before the dump.
+        '''
+        checks_file = os.path.join(self.backup_dir, drill.checks_name(self.time_suffix))
+        print 'Recording table checks into %s' % checks_file
+        with self.report.stage('checks') as record:
+            try:
+                checks = drill.record_checks(
+                    self.get_client(), signals, self.get_blacklist_tables(),
+                    getattr(settings, 'BACKUP_DRILL_WORKERS', drill.DEFAULT_WORKERS), self.signal_checksum())
+            except (ClientError, OSError), e:
+                raise CommandError('Could not record the table checks: %s' % e)
+            drill.write_checks(checks_file, checks)
+            record['tables'] = len(checks['tables'])
+        if checks['changed']:
+            print 'tables written during the backup, drills will not check them: %s' % ', '.join(checks['changed'])
+        return checks_file
+
+    def do_incremental_backup(self):
+        '''
+        dump the schema and the tables that changed since the last backup
+        of every store, locally and on the remote storage with --ftp. See
+        django_backup.incremental.
+        '''
+        name = 'backup_%s%s' % (self.time_suffix, incremental.TABLES_SUFFIX)
+        client = self.get_client()
+        stores = []
+        if not self.delete_local and not self.no_local:
+            stores.append(LocalStorage(self.backup_dir))
+        if self.ftp:
+            stores.append(self.get_storage())
+        if not stores:
+            raise CommandError('--incremental needs a local backup or --ftp')
+        if client.is_mysql:
+            dump_path = getattr(settings, 'BACKUP_SQLDUMP_PATH', None)
+        else:
+            dump_path = getattr(settings, 'BACKUP_PG_DUMP_PATH', None)
+        stats = {'bytes_stored': 0}
+        workdir = incremental.make_workdir(self.backup_dir)
+        try:
+            signals = incremental.table_signals(client, exclude=self.get_blacklist_tables(),
+                                                checksum=self.signal_checksum())
+            previous = [incremental.latest_manifest(storage) for storage in stores]
+            changed = incremental.changed_tables(signals, previous)
+            print 'Doing incremental backup of database %s: %d of %d tables changed' % (
+                self.db, len(changed), len(signals))
+            dump = incremental.TableDump(client, workdir, dump_path).dump(changed)
+            for storage, manifest in zip(stores, previous):
+                print 'Saving %s to %s' % (name, storage)
+                files, size = incremental.store_backup(storage, name, self.time_suffix, dump, signals, manifest)
+                print 'stored %d files, %s' % (files, format_size(size))
+                stats['bytes_stored'] += size
+        except (ClientError, incremental.IncrementalError, OSError), e:
+            raise CommandError('Incremental backup failed: %s' % e)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        stats.update(tables=len(signals), tables_dumped=len(changed))
+        return stats
+
+    def compress_backup(self, outfile):
+        '''
+        compress and/or encrypt the dump as asked, returning the file to keep.
+        '''
+        if self.compress:
+            compressed_outfile = outfile + '.gz'
+            if self.encrypt:
+                compressed_outfile += crypto.ENCRYPTED_SUFFIX
+            print 'Compressing backup file %s to %s' % (outfile, compressed_outfile)
+            with self.report.stage('compress', bytes_in=os.path.getsize(outfile)) as record:
+                if self.adaptive:
+                    record.update(self.do_adaptive_compress(outfile, compressed_outfile))
+                else:
+                    self.do_compress(outfile, compressed_outfile)
+                record['bytes'] = os.path.getsize(compressed_outfile)
+            return compressed_outfile
+        elif self.encrypt:
+            encrypted_outfile = outfile + crypto.ENCRYPTED_SUFFIX
+            print 'Encrypting backup file %s to %s' % (outfile, encrypted_outfile)
+            with self.report.stage('encrypt') as record:
+                self.do_encrypt(outfile, encrypted_outfile)
+                record['bytes'] = os.path.getsize(encrypted_outfile)
+            return encrypted_outfile
+        return outfile
 
-    def compress_dir(self, directory, outfile):
+    def compress_dir(self, directories, outfile):
+        '''
+        archive the directories into outfile, scanning and reading them in
+        parallel and compressing with a gzip process. Names are relative to
+        each directory, so the archive extracts into MEDIA_ROOT. The archive
+        is written to a .part file, renamed to outfile once complete.
+        '''
         print 'Backup directories ...'
-        command = 'cd %s && tar -czf %s *' % (directory, outfile)
+        workers = getattr(settings, 'BACKUP_ARCHIVE_WORKERS', archive.DEFAULT_WORKERS)
+        scanner = archive.DirectoryScanner(workers)
+        try:
+            entries = scanner.scan(directories)
+        except archive.ArchiveError, e:
+            raise CommandError('Could not archive %s: %s' % (', '.join(directories), e))
+        finally:
+            self.media_errors = scanner.errors
+        for error in scanner.errors:
+            print 'could not read %s' % error
         print '=' * 70
-        print 'Running Command: %s' % command
-        os.system(command)
+        print 'Archiving %d entries from %s into %s' % (len(entries), ', '.join(directories), outfile)
+        partfile = outfile + PART_SUFFIX
+        try:
+            self.write_archive(entries, partfile, workers)
+        except:
+            if os.path.exists(partfile):
+                os.unlink(partfile)
+            raise
+        os.rename(partfile, outfile)
+
+    def write_archive(self, entries, outfile, workers):
+        out = open(outfile, 'wb')
+        process = subprocess.Popen(['gzip', '--stdout'], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE if self.encrypt else out)
+        errors = []
+        encrypter = None
+        if self.encrypt:
+            def encrypt():
+                try:
+                    crypto.encrypt_stream(process.stdout, out, self.encryption_key,
+                                          workers=self.encryption_workers)
+                except Exception, e:
+                    errors.append(e)
+                    # gzip stops on the closed pipe, and the archiver with it
+                    process.stdout.close()
+            encrypter = threading.Thread(target=encrypt)
+            encrypter.start()
+        archiver = archive.Archiver(process.stdin, workers, getattr(settings, 'BACKUP_ARCHIVE_PREFETCH_BYTES',
+                                                                    archive.DEFAULT_PREFETCH_BYTES))
+        failure = None
+        try:
+            stats = archiver.write(entries)
+        except IOError, e:
+            failure = e
+        finally:
+            process.stdin.close()
+            if encrypter is not None:
+                encrypter.join()
+            code = process.wait()
+            out.close()
+        if errors:
+            raise CommandError('Encrypting %s failed: %s' % (outfile, errors[0]))
+        if failure is not None or code != 0:
+            raise CommandError('Archiving into %s failed: %s' % (outfile, failure or 'gzip exited with %d' % code))
+        if archiver.changed:
+            print '%d files changed while they were archived' % len(archiver.changed)
+        print 'archived %(files)d files, %(directories)d directories and %(links)d links, skipped %(skipped)d' % stats
+        if self.media_source_bytes is None:
+            self.media_source_bytes = stats['bytes']
+
+    def encrypt_command(self, command, outfile, shell=False):
+        '''
+        run command and encrypt its output into outfile as it is produced.
+        '''
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, shell=shell)
+        out = open(outfile, 'wb')
+        try:
+            crypto.encrypt_stream(process.stdout, out, self.encryption_key,
+                                  workers=self.encryption_workers)
+        finally:
+            out.close()
+            process.stdout.close()
+        if process.wait() != 0:
+            raise CommandError('%s failed while writing %s' % (command, outfile))
+
+    def do_encrypt(self, infile, outfile):
+        crypto.encrypt_file(infile, outfile, self.encryption_key, workers=self.encryption_workers)
+        os.system('rm %s' % infile)
 
     def get_connection(self):
         '''
         get the ssh connection to the remote server.
         '''
-        return ssh.Connection(host=self.ftp_server, username=self.ftp_username, password=self.ftp_password)
+        return connections.get_connection(self.ftp_server, self.ftp_username, self.ftp_password)
 
     def get_blacklist_tables(self):
         '''
@@ -287,21 +710,163 @@ class Command(BaseCommand):
         '''
         return getattr(settings, 'BACKUP_TABLES_BLACKLIST', [])
 
-    def store_ftp(self, local_files=[]):
-        sftp = self.get_connection()
-        if self.remote_dir:
+    def get_storage(self):
+        '''
+        the remote storage backend, see BACKUP_STORAGE.
+        '''
+        if getattr(self, 'storage', None) is None:
             try:
-                sftp.mkdir(self.remote_dir)
-            except IOError:
-                pass
+                self.storage = get_default_storage(settings)
+            except StorageError, e:
+                raise CommandError(str(e))
+        return self.storage
+
+    def store_ftp(self, local_files=[]):
+        storage = self.get_storage()
+        storage.ensure()
         for local_file in local_files:
             filename = os.path.split(local_file)[-1]
-            print 'Saving %s to remote server ' % local_file
-            sftp.put(local_file, os.path.join(self.remote_dir or '', filename))
-        sftp.close()
+            if filename in self.uploaded:
+                continue
+            print 'Saving %s to %s' % (local_file, storage)
+            if self.delta and is_db_backup(filename):
+                self.store_delta(storage, local_file, filename)
+            else:
+                self.put_file(storage, filename, local_file)
+        storage.close()
+        self.clean_local_backups(local_files)
+
+    def put_file(self, storage, name, path):
+        started = time.time()
+        self.sent_bytes += storage.put_file(name, path)
+        self.send_seconds += time.time() - started
+
+    def store_delta(self, storage, local_file, filename):
+        '''
+        upload a dump as a delta against the newest remote dump that has a
+        signature, or in full when there is none, the chain of deltas is
+        long enough or the delta would barely be smaller. The signature of
+        the dump is uploaded either way for tomorrow's delta.
+        '''
+        if crypto.is_encrypted(filename):
+            print 'Encrypted dumps do not delta, saving %s in full' % filename
+            self.put_file(storage, filename, local_file)
+            return
+        stored = set(storage.listdir())
+        candidates = sorted(i for i in stored if is_db_backup(i) and i != filename
+                            and delta.logical_name(i) + delta.SIGNATURE_SUFFIX in stored)
+        block_size = getattr(settings, 'BACKUP_DELTA_BLOCK_SIZE', delta.DEFAULT_BLOCK_SIZE)
+        max_chain = getattr(settings, 'BACKUP_DELTA_MAX_CHAIN', 7)
+        max_ratio = getattr(settings, 'BACKUP_DELTA_MAX_RATIO', 0.8)
+
+        signature_file = local_file + delta.SIGNATURE_SUFFIX
+        source = open(local_file, 'rb')
+        out = open(signature_file, 'wb')
+        try:
+            delta.write_signature(source, out, block_size)
+        finally:
+            out.close()
+            source.close()
+
+        uploaded = False
+        if candidates:
+            base = candidates[-1]
+            try:
+                chain = delta.resolve_chain(storage, base, stored)
+            except delta.DeltaError, e:
+                print 'Cannot use %s as a delta base (%s), saving %s in full' % (base, e, filename)
+                chain = None
+            if chain is None:
+                pass
+            elif len(chain) > max_chain:
+                print '%s has %d deltas, saving %s in full' % (base, len(chain) - 1, filename)
+            else:
+                uploaded = self.upload_delta(storage, local_file, filename, delta.logical_name(base), max_ratio)
+        if not uploaded:
+            self.put_file(storage, filename, local_file)
+        self.put_file(storage, filename + delta.SIGNATURE_SUFFIX, signature_file)
+        os.remove(signature_file)
+
+    def upload_delta(self, storage, local_file, filename, base, max_ratio):
+        stream = storage.get_stream(base + delta.SIGNATURE_SUFFIX)
+        try:
+            signature = delta.read_signature(stream)
+        finally:
+            stream.close()
+        delta_file = local_file + delta.DELTA_SUFFIX
+        full_size = os.path.getsize(local_file)
+        source = open(local_file, 'rb')
+        out = open(delta_file, 'wb')
+        try:
+            writer = delta.write_delta(source, signature, base, out, int(full_size * max_ratio))
+        except delta.DeltaTooLarge:
+            out.close()
+            os.remove(delta_file)
+            print 'Delta of %s against %s is not worth it, saving it in full' % (filename, base)
+            return False
+        finally:
+            out.close()
+            source.close()
+        delta_size = os.path.getsize(delta_file)
+        print 'Delta of %s against %s: %s, %s of %s reused' % (
+            filename, base, format_size(delta_size),
+            format_size(writer.copied_bytes), format_size(full_size))
+        try:
+            if delta_size > full_size * max_ratio:
+                print 'Delta is not worth it, saving %s in full' % filename
+                return False
+            self.put_file(storage, filename + delta.DELTA_SUFFIX, delta_file)
+            return True
+        finally:
+            os.remove(delta_file)
+
+    def get_destinations(self):
+        '''
+        BACKUP_DESTINATIONS, plus the remote storage and --email address when
+        --ftp and --email are given.
+        '''
+        configs = list(getattr(settings, 'BACKUP_DESTINATIONS', []))
+        try:
+            destinations = fanout.get_destinations(configs)
+        except (KeyError, ValueError, StorageError), e:
+            raise CommandError('Invalid BACKUP_DESTINATIONS: %s' % e)
+        if self.ftp:
+            destinations.append(fanout.StorageDestination({'type': 'storage'}, self.get_storage()))
+        if self.email:
+            destinations.append(fanout.EmailDestination({'type': 'email', 'to': [self.email]}))
+        return destinations
+
+    def store_fanout(self, local_files):
+        destinations = self.get_destinations()
+        if not destinations:
+            raise CommandError('No backup destinations configured')
+        fanout.fan_out(local_files, destinations,
+                       buffer=getattr(settings, 'BACKUP_FANOUT_BUFFER', fanout.DEFAULT_BUFFER))
+        print '=' * 70
+        failed = []
+        slowest = None
+        for destination in destinations:
+            rate = destination.bytes / destination.seconds if destination.seconds else 0
+            print '%s: sent %s, failed %s, %s in %.1fs (%s/s)' % (
+                destination.name, destination.sent, destination.failed,
+                format_size(destination.bytes), destination.seconds, format_size(rate))
+            if destination.failed:
+                failed.append(destination.name)
+            elif rate and (slowest is None or rate < slowest[0]):
+                slowest = (rate, destination)
+        if slowest is not None:
+            # the run waits for the slowest destination
+            self.sent_bytes = slowest[1].bytes
+            self.send_seconds = slowest[1].seconds
+        if failed:
+            # keep the local copies when a destination is missing them
+            raise CommandError('Backup failed for destinations: %s' % ', '.join(failed))
+        self.clean_local_backups(local_files)
+
+    def clean_local_backups(self, local_files):
         if self.delete_local:
             backups = os.listdir(self.backup_dir)
-            backups = filter(is_backup, backups)
+            backups = [i for i in backups if is_backup(i) or drill.is_checks(i)]
             backups.sort()
             print '=' * 70
             print '--cleanlocal, local db and media backups found: %s' % backups
@@ -332,6 +897,10 @@ class Command(BaseCommand):
     def sendmail(self, address_from, addresses_to, attachments):
         subject = "Your DB-backup for " + datetime.now().strftime("%d %b %Y")
         body = "Timestamp of the backup is " + datetime.now().strftime("%d %b %Y")
+        if self.media_errors:
+            body += "<br><br>%d media directories could not be read and are missing from the backup:<br>" % (
+                len(self.media_errors))
+            body += "<br>".join(escape(i) for i in self.media_errors)
 
         email = EmailMessage(subject, body, address_from, addresses_to)
         email.content_subtype = 'html'
@@ -339,11 +908,138 @@ class Command(BaseCommand):
             email.attach_file(attachment)
         email.send()
 
+    def gzip_flags(self):
+        # let unchanged parts of the dump compress to the same bytes
+        return '--rsyncable ' if self.delta else ''
+
     def do_compress(self, infile, outfile):
-        os.system('gzip --stdout %s > %s' % (infile, outfile))
+        if self.encrypt:
+            self.encrypt_command(['gzip', '--stdout', infile], outfile)
+        else:
+            os.system('gzip %s--stdout %s > %s' % (self.gzip_flags(), infile, outfile))
+        os.system('rm %s' % infile)
+
+    def do_adaptive_compress(self, infile, outfile):
+        source = open(infile, 'rb')
+        try:
+            stats = self.adaptive_compress(source, outfile)
+        finally:
+            source.close()
         os.system('rm %s' % infile)
+        return stats
+
+    def adaptive_compress(self, source, outfile):
+        '''
+        compress source block by block, choosing each block's gzip level from
+        the measured compression and write speed. With --ftp the blocks are
+        uploaded as they are compressed, so the upload sets the pace. With
+        --fanout the upload follows, at the rate earlier runs measured.
+        '''
+        out = open(outfile, 'wb')
+        sinks = [out]
+        remote = None
+        upload_rate = None
+        filename = os.path.basename(outfile)
+        if self.ftp and not self.fanout:
+            storage = self.get_storage()
+            storage.ensure()
+            remote = adaptive.TimedWriter(storage.open_writer(filename))
+            sinks.append(remote)
+            print 'Uploading %s to %s while compressing' % (filename, storage)
+        elif self.fanout:
+            upload_rate = plan.upload_rate(read_history(get_report_file(settings, self.backup_dir),
+                                                        plan.HISTORY_RUNS))
+            if upload_rate:
+                print 'Expecting uploads at %s/s' % format_size(upload_rate)
+        compressor = adaptive.AdaptiveCompressor(
+            sinks, block_size=getattr(settings, 'BACKUP_ADAPTIVE_BLOCK_SIZE', adaptive.DEFAULT_BLOCK_SIZE),
+            upload_rate=upload_rate)
+        try:
+            stats = compressor.run(source)
+            if remote is not None:
+                remote.close()
+                self.uploaded.add(filename)
+                self.sent_bytes += remote.bytes
+                self.send_seconds += remote.seconds
+        except Exception:
+            if remote is not None:
+                remote.abort()
+            raise
+        finally:
+            out.close()
+        print 'gzip levels used (level: blocks): %s' % stats['levels']
+        return stats
+
+    def dump_command(self):
+        '''
+        the shell command writing the dump to its stdout.
+        '''
+        if self.engine == 'django.db.backends.mysql':
+            # the first failing dump is the exit status of the group
+            return '(%s)' % ' && '.join(self.mysql_dump_commands())
+        elif self.engine == 'django.db.backends.postgresql_psycopg2':
+            return self.postgresql_dump_command()
+        raise CommandError('Backup in %s engine not implemented' % self.engine)
+
+    def do_stream_backup(self, outfile):
+        '''
+        compress the dump as the database client writes it, so the plain
+        dump never needs space on disk. The client and gzip are separate
+        processes so a failed dump isn't hidden by gzip's exit code. Returns
+        the statistics for the run report, with the size of the plain dump.
+        '''
+        command = self.dump_command()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True)
+        if self.adaptive:
+            try:
+                stats = self.adaptive_compress(process.stdout, outfile)
+            finally:
+                process.stdout.close()
+            if process.wait() != 0:
+                raise CommandError('%s failed while writing %s' % (command, outfile))
+            stats['dump_bytes'] = stats['bytes_in']
+            return stats
+        gzip_command = ('gzip %s--stdout' % self.gzip_flags()).split()
+        print 'Running Command: %s | %s' % (command, ' '.join(gzip_command))
+        out = open(outfile, 'wb')
+        compressor = None
+        # the dump is copied into gzip to count it
+        counted = []
+        try:
+            compressor = subprocess.Popen(gzip_command, stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE if self.encrypt else out)
+            feeder = threading.Thread(target=feed_stream, args=(process.stdout, compressor.stdin, counted))
+            feeder.daemon = True
+            feeder.start()
+            if self.encrypt:
+                try:
+                    crypto.encrypt_stream(compressor.stdout, out, self.encryption_key,
+                                          workers=self.encryption_workers)
+                finally:
+                    compressor.stdout.close()
+        finally:
+            out.close()
+            code = None
+            if compressor is not None:
+                code = compressor.wait()
+                feeder.join()
+            # a dump still writing sees gzip go away
+            process.stdout.close()
+            dump_code = process.wait()
+        if dump_code != 0:
+            raise CommandError('%s exited with %d while writing %s' % (command, dump_code, outfile))
+        if code != 0 or not counted:
+            raise CommandError('gzip exited with %s while writing %s' % (code, outfile))
+        return {'dump_bytes': counted[0]}
 
     def do_mysql_backup(self, outfile):
+        commands = self.mysql_dump_commands()
+        os.system('%s > %s' % (commands[0], outfile))
+        #append table structures of blacklist_tables 
+        for command in commands[1:]:
+            os.system('%s >> %s' % (command, outfile))
+
+    def mysql_dump_commands(self):
         args = []
         if self.user:
             args += ["--user='%s'" % self.user]
@@ -360,16 +1056,20 @@ class Command(BaseCommand):
             all_tables = connection.introspection.get_table_list(connection.cursor())
             tables = list(set(all_tables) - set(blacklist_tables))
             args += tables
-        os.system('%s %s > %s' % (getattr(settings, 'BACKUP_SQLDUMP_PATH', 'mysqldump'), ' '.join(args), outfile))
-        #append table structures of blacklist_tables 
+        commands = ['%s %s' % (getattr(settings, 'BACKUP_SQLDUMP_PATH', 'mysqldump'), ' '.join(args))]
         if blacklist_tables:
             all_tables = connection.introspection.get_table_list(connection.cursor())
             blacklist_tables = list(set(all_tables) and set(blacklist_tables))
             args = base_args + ['-d'] + blacklist_tables
-            cmd = '%s %s >> %s' % (getattr(settings, 'BACKUP_SQLDUMP_PATH', 'mysqldump'), ' '.join(args), outfile)
-            os.system(cmd)
+            commands.append('%s %s' % (getattr(settings, 'BACKUP_SQLDUMP_PATH', 'mysqldump'), ' '.join(args)))
+        return commands
             
     def do_postgresql_backup(self, outfile):
+        pgdump_cmd = '%s > %s' % (self.postgresql_dump_command(), outfile)
+        print pgdump_cmd
+        os.system(pgdump_cmd)
+
+    def postgresql_dump_command(self):
         args = []
         if self.user:
             args += ["--username=%s" % self.user]
@@ -383,9 +1083,8 @@ class Command(BaseCommand):
 
         if self.passwd:
             os.environ['PGPASSWORD'] = self.passwd
-        pgdump_cmd = '%s %s --clean > %s' % (pgdump_path, ' '.join(args), outfile)
-        print pgdump_cmd
-        os.system(pgdump_cmd)
+        # --if-exists, or psql stops at the first DROP of a missing object
+        return '%s %s --clean --if-exists' % (pgdump_path, ' '.join(args))
 
     def clean_local_surplus_db(self):
         try:
@@ -397,7 +1096,9 @@ class Command(BaseCommand):
             remove_list = decide_remove(backups, settings.BACKUP_DATABASE_COPIES)
             print '=' * 70
             print 'local db backups to clean %s' % remove_list
-            remove_all = ' '.join([os.path.join(self.backup_dir, i) for i in remove_list])
+            stored = set(os.listdir(self.backup_dir))
+            checks = [i for i in self.checks_sidecars(remove_list) if i in stored]
+            remove_all = ' '.join([os.path.join(self.backup_dir, i) for i in remove_list + checks])
             if remove_all:
                 print '=' * 70
                 print 'cleaning up local db backups'
@@ -405,32 +1106,60 @@ class Command(BaseCommand):
                 print '=' * 70
                 print 'Running Command: %s' % command
                 os.system(command)
+                if filter(incremental.is_incremental, remove_list):
+                    self.collect_table_garbage(LocalStorage(self.backup_dir))
         except ImportError:
             print 'cleaned nothing, because BACKUP_DATABASE_COPIES is missing'
 
     def clean_remote_surplus_db(self):
         try:
-            sftp = self.get_connection()
-            backups = [i.strip() for i in sftp.execute('ls %s' % self.remote_dir)]
+            storage = self.get_storage()
+            backups = storage.listdir()
             backups = filter(is_db_backup, backups)
             backups.sort()
             print '=' * 70
             print 'remote db backups found: %s' % backups
             remove_list = decide_remove(backups, settings.BACKUP_DATABASE_COPIES)
+            remove_list = self.keep_delta_bases(storage, backups, remove_list)
             print '=' * 70
             print 'remote db backups to clean %s' % remove_list
-            remove_all_remote = ' '.join([os.path.join(self.remote_dir, i) for i in remove_list])
-            if remove_all_remote:
-                print '=' * 70
-                print 'cleaning up remote db backups'
-                command = 'rm %s' % remove_all_remote
+            if remove_list:
                 print '=' * 70
-                print 'Running Command on remote server: %s' % command
-                sftp.execute(command)
-            sftp.close()
+                print 'cleaning up remote db backups on %s' % storage
+                stored = set(storage.listdir())
+                sidecars = [delta.logical_name(i) + delta.SIGNATURE_SUFFIX for i in remove_list]
+                sidecars += self.checks_sidecars(remove_list)
+                storage.delete_batch(remove_list + [i for i in sidecars if i in stored])
+                if filter(incremental.is_incremental, remove_list):
+                    self.collect_table_garbage(storage)
+            storage.close()
         except ImportError:
             print 'cleaned nothing, because BACKUP_DATABASE_COPIES is missing'
 
+    def checks_sidecars(self, backups):
+        return [drill.checks_name(regex.search(i).group()) for i in backups]
+
+    def collect_table_garbage(self, storage):
+        removed = incremental.collect_garbage(storage)
+        print 'removed %d unreferenced table backups from %s' % (removed, storage)
+
+    def keep_delta_bases(self, storage, backups, remove_list):
+        '''
+        don't remove dumps that a kept delta still needs.
+        '''
+        stored = set(backups)
+        needed = set()
+        for backup in backups:
+            if backup not in remove_list and delta.is_delta(backup):
+                try:
+                    needed.update(delta.resolve_chain(storage, backup, stored))
+                except delta.DeltaError, e:
+                    print 'could not resolve %s: %s' % (backup, e)
+        kept = [i for i in remove_list if i in needed]
+        if kept:
+            print 'keeping remote db backups needed by deltas: %s' % kept
+        return [i for i in remove_list if i not in needed]
+
     def clean_surplus_db(self):
         self.clean_local_surplus_db()
         self.clean_remote_surplus_db()
@@ -450,21 +1179,58 @@ class Command(BaseCommand):
             remove_list = decide_remove(backups, settings.BACKUP_MEDIA_COPIES)
             print '=' * 70
             print 'local media backups to clean %s' % remove_list
-            remove_all = ' '.join([os.path.join(self.backup_dir, i) for i in remove_list])
-            if remove_all:
+            if remove_list:
                 print '=' * 70
                 print 'cleaning up local media backups'
-                command = 'rm -r %s' % remove_all
-                print '=' * 70
-                print 'Running Command: %s' % command
-                os.system(command)
+                self.prune_local_media(remove_list)
         except ImportError:
             print 'cleaned nothing, because BACKUP_MEDIA_COPIES is missing'
 
+    def get_snapshot_index(self):
+        '''
+        inode index of the local rsync backups, rescanning only new ones.
+        '''
+        snapshots = [i for i in os.listdir(self.backup_dir)
+                     if is_media_backup(i) and os.path.isdir(os.path.join(self.backup_dir, i))]
+        index = SnapshotIndex(self.backup_dir, GOOD_RSYNC_FLAG)
+        scanned = index.refresh(snapshots)
+        if scanned:
+            print 'indexed rsync backups: %s' % sorted(scanned)
+        return index
+
+    def prune_local_media(self, remove_list):
+        '''
+        delete local media backups, reporting how much space the rsync
+        backups among them really hold.
+        '''
+        paths = [os.path.join(self.backup_dir, i) for i in remove_list]
+        snapshots = [i for i, path in zip(remove_list, paths) if os.path.isdir(path)]
+        if snapshots:
+            index = self.get_snapshot_index()
+            print 'space to reclaim: %s' % format_size(index.reclaimable(snapshots))
+        remove_snapshots(paths, self.prune_workers)
+        if filter(cas.is_cas_backup, remove_list):
+            self.collect_cas_garbage(LocalStorage(self.backup_dir))
+
+    def collect_cas_garbage(self, storage):
+        removed = cas.ContentStore(storage, self.cas_workers()).collect_garbage()
+        print 'removed %d unreferenced media blobs from %s' % (removed, storage)
+
+    def report_rsync_usage(self):
+        index = self.get_snapshot_index()
+        usage = index.usage()
+        print '=' * 70
+        print '%-30s %12s %12s' % ('backup', 'apparent', 'unique')
+        for name in sorted(usage):
+            apparent, unique = usage[name]
+            print '%-30s %12s %12s' % (name, format_size(apparent), format_size(unique))
+        print '=' * 70
+        print 'total held by rsync backups: %s' % format_size(index.reclaimable(usage.keys()))
+
     def clean_remote_surplus_media(self):
         try:
-            sftp = self.get_connection()
-            backups = [i.strip() for i in sftp.execute('ls %s' % self.remote_dir)]
+            storage = self.get_storage()
+            backups = storage.listdir()
             backups = filter(is_media_backup, backups)
             backups.sort()
             print '=' * 70
@@ -472,15 +1238,13 @@ class Command(BaseCommand):
             remove_list = decide_remove(backups, settings.BACKUP_MEDIA_COPIES)
             print '=' * 70
             print 'remote media backups to clean %s' % remove_list
-            remove_all_remote = ' '.join([os.path.join(self.remote_dir, i) for i in remove_list])
-            if remove_all_remote:
-                print '=' * 70
-                print 'cleaning up remote media backups'
-                command = 'rm -r %s' % remove_all_remote
+            if remove_list:
                 print '=' * 70
-                print 'Running Command on remote server: %s' % command
-                sftp.execute(command)
-            sftp.close()
+                print 'cleaning up remote media backups on %s' % storage
+                storage.delete_batch(remove_list)
+                if filter(cas.is_cas_backup, remove_list):
+                    self.collect_cas_garbage(storage)
+            storage.close()
         except ImportError:
             print 'cleaned nothing, because BACKUP_MEDIA_COPIES is missing'
 
@@ -528,6 +1292,32 @@ class Command(BaseCommand):
                 pass
             os.system(cmd)
 
+    def cas_workers(self):
+        return getattr(settings, 'BACKUP_CAS_WORKERS', cas.DEFAULT_WORKERS)
+
+    def do_media_cas_backup(self):
+        '''
+        hash the media files and store the new ones by content, locally and
+        on the remote storage with --ftp.
+        '''
+        name = 'dir_%s%s' % (self.time_suffix, cas.MANIFEST_SUFFIX)
+        hash_cache = cas.HashCache(os.path.join(self.backup_dir, cas.CACHE_FILENAME))
+        try:
+            roots = cas.root_names(self.directories)
+        except cas.CASError, e:
+            raise CommandError(str(e))
+        entries = cas.scan(self.directories, hash_cache, self.cas_workers())
+        stores = []
+        if not self.delete_local and not self.no_local:
+            stores.append(LocalStorage(self.backup_dir))
+        if self.ftp:
+            stores.append(self.get_storage())
+        for storage in stores:
+            print 'Doing media backup %s to %s' % (name, storage)
+            blobs, size = cas.ContentStore(storage, self.cas_workers()).backup(entries, name, roots)
+            print 'stored %d new files, %s' % (blobs, format_size(size))
+        hash_cache.save()
+
     def clean_broken_rsync(self):
         self.clean_local_broken_rsync()
         self.clean_remote_broken_rsync()
@@ -555,13 +1345,13 @@ class Command(BaseCommand):
         backups = os.listdir(self.backup_dir)
         backups = filter(is_media_backup, backups)
         backups.sort()
-        commands = []
+        remove_list = []
         for backup in backups:
             #find the GOOD_RSYNC_FLAG file in the backup dir
             backup_path = os.path.join(self.backup_dir, backup)
             flag_file = os.path.join(backup_path, GOOD_RSYNC_FLAG)
-            cmd = 'test -e %s||rm -rf %s' % (flag_file, backup_path)
-            commands.append(cmd)
-        full_cmd = '\n'.join(commands)
-        print full_cmd
-        os.system(full_cmd)
+            if os.path.isdir(backup_path) and not os.path.exists(flag_file):
+                remove_list.append(backup)
+        print 'local broken rsync backups to clean %s' % remove_list
+        if remove_list:
+            self.prune_local_media(remove_list)
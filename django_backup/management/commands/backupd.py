@@ -0,0 +1,301 @@
+import errno
+import fcntl
+import json
+import os
+import signal
+import socket
+import SocketServer
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connection
+
+from django_backup.connections import connection_pool
+from django_backup.schedule import CronSchedule
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def format_datetime(d):
+    if d is None:
+        return None
+    return d.strftime(DATETIME_FORMAT)
+
+
+class Job(object):
+    '''
+    a backup job from BACKUP_DAEMON_JOBS and its run history.
+    '''
+
+    def __init__(self, name, config, now):
+        self.name = name
+        self.schedule = CronSchedule(config['schedule'])
+        self.options = config.get('options', {})
+        self.next_run = self.schedule.next_after(now)
+        self.state = 'idle'
+        self.pending = False
+        self.runs = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.last_start = None
+        self.last_end = None
+        self.last_duration = None
+        self.last_result = None
+
+    def status(self):
+        return {
+            'schedule': str(self.schedule),
+            'options': self.options,
+            'state': self.state,
+            'pending': self.pending,
+            'next_run': format_datetime(self.next_run),
+            'runs': self.runs,
+            'failures': self.failures,
+            'coalesced': self.coalesced,
+            'last_start': format_datetime(self.last_start),
+            'last_end': format_datetime(self.last_end),
+            'last_duration': self.last_duration,
+            'last_result': self.last_result,
+        }
+
+
+class StatusHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        self.request.sendall(json.dumps(self.server.backupd.status(), indent=2) + '\n')
+
+
+class StatusServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class Command(BaseCommand):
+    help = "Runs the backup jobs in BACKUP_DAEMON_JOBS on their cron schedules."
+    option_list = BaseCommand.option_list + (
+        make_option('--status', action='store_true', default=False, dest='status',
+            help='Print the status of a running daemon and exit'),
+    )
+
+    def handle(self, *args, **options):
+        self.backup_dir = getattr(settings, 'BACKUP_LOCAL_DIRECTORY', os.getcwd())
+        self.status_file = getattr(settings, 'BACKUP_DAEMON_STATUS_FILE',
+                                   os.path.join(self.backup_dir, 'backupd.status'))
+        self.socket_path = getattr(settings, 'BACKUP_DAEMON_SOCKET', None)
+
+        if options.get('status'):
+            self.print_status()
+            return
+
+        jobs = getattr(settings, 'BACKUP_DAEMON_JOBS', {})
+        if not jobs:
+            raise CommandError('BACKUP_DAEMON_JOBS is not defined')
+        if not os.path.exists(self.backup_dir):
+            os.makedirs(self.backup_dir)
+
+        now = datetime.now()
+        self.started = now
+        self.jobs = {}
+        for name, config in jobs.items():
+            try:
+                self.jobs[name] = Job(name, config, now)
+            except (KeyError, ValueError), e:
+                raise CommandError('Invalid backup job %s: %s' % (name, e))
+
+        # reentrant, as the signal handler may interrupt the scheduler holding it
+        self.lock = threading.RLock()
+        self.status_lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.queue = deque()
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        connection_pool.enabled = True
+        self.server = self.start_status_server()
+        worker = threading.Thread(target=self.worker)
+        worker.daemon = True
+        worker.start()
+
+        print 'backupd started with jobs: %s' % ', '.join(sorted(self.jobs))
+        self.write_status()
+        try:
+            self.scheduler()
+        finally:
+            worker.join()
+            connection_pool.close_all()
+            if self.server is not None:
+                self.server.shutdown()
+                os.unlink(self.socket_path)
+            print 'backupd stopped'
+
+    def stop(self, signum, frame):
+        print 'backupd stopping after the running job'
+        with self.lock:
+            self.stopping = True
+            self.wakeup.notify_all()
+
+    def scheduler(self):
+        '''
+        queue the jobs that are due. A job that is already queued or running
+        is marked pending once however many of its runs were missed, and
+        requeued when the running one finishes.
+        '''
+        while True:
+            with self.lock:
+                if self.stopping:
+                    return
+                now = datetime.now()
+                for job in self.jobs.values():
+                    if job.next_run > now:
+                        continue
+                    if job.state == 'idle':
+                        job.state = 'queued'
+                        self.queue.append(job)
+                    elif job.pending:
+                        job.coalesced += 1
+                    else:
+                        job.pending = True
+                    job.next_run = job.schedule.next_after(now)
+                self.wakeup.notify_all()
+                timeout = min(job.next_run for job in self.jobs.values()) - now
+                self.wakeup.wait(max(1, min(60, timeout.total_seconds())))
+            self.write_status()
+
+    def worker(self):
+        '''
+        run queued jobs one at a time, so runs never compete for I/O.
+        '''
+        while True:
+            with self.lock:
+                while not self.queue and not self.stopping:
+                    self.wakeup.wait()
+                if self.stopping:
+                    return
+                job = self.queue.popleft()
+                job.state = 'running'
+            try:
+                self.run(job)
+            except (Exception, SystemExit), e:
+                # a failure outside the backup itself (the job lock, the
+                # status file) must not take the worker thread down with it
+                job.failures += 1
+                job.last_result = 'error: %s' % e
+                job.last_end = datetime.now()
+                traceback.print_exc()
+            with self.lock:
+                if job.pending:
+                    job.pending = False
+                    job.state = 'queued'
+                    self.queue.append(job)
+                else:
+                    job.state = 'idle'
+            self.write_status()
+
+    def run(self, job):
+        job.last_start = datetime.now()
+        job.runs += 1
+        self.write_status()
+        print '=' * 70
+        print 'backupd running job %s at %s' % (job.name, format_datetime(job.last_start))
+        started = time.time()
+        lock_file = self.acquire_job_lock(job)
+        if lock_file is None:
+            job.last_result = 'skipped: already running in another process'
+        else:
+            try:
+                call_command('backup', **job.options)
+                job.last_result = 'ok'
+            except SystemExit, e:
+                # call_command turns the CommandError of a failed backup
+                # into sys.exit, after printing it
+                job.failures += 1
+                job.last_result = 'error: backup exited with status %s' % e.code
+            except Exception, e:
+                job.failures += 1
+                job.last_result = 'error: %s' % e
+                traceback.print_exc()
+            finally:
+                lock_file.close()
+                # the next run may come after the server dropped the connection
+                connection.close()
+        job.last_end = datetime.now()
+        job.last_duration = round(time.time() - started, 3)
+        print 'backupd job %s finished in %ss: %s' % (job.name, job.last_duration, job.last_result)
+
+    def acquire_job_lock(self, job):
+        '''
+        guard against a second daemon running the same job.
+        '''
+        lock_file = open(os.path.join(self.backup_dir, '.backupd_%s.lock' % job.name), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            lock_file.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return lock_file
+
+    def status(self):
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'started': format_datetime(self.started),
+                'updated': format_datetime(datetime.now()),
+                'queue': [job.name for job in self.queue],
+                'jobs': dict((name, job.status()) for name, job in self.jobs.items()),
+            }
+
+    def write_status(self):
+        status = self.status()
+        with self.status_lock:
+            tmp = self.status_file + '.tmp'
+            try:
+                f = open(tmp, 'w')
+                try:
+                    json.dump(status, f, indent=2)
+                finally:
+                    f.close()
+                os.rename(tmp, self.status_file)
+            except (IOError, OSError), e:
+                print 'backupd could not write status file %s: %s' % (self.status_file, e)
+
+    def start_status_server(self):
+        if not self.socket_path:
+            return None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = StatusServer(self.socket_path, StatusHandler)
+        server.backupd = self
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def print_status(self):
+        if self.socket_path and os.path.exists(self.socket_path):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+                chunks = []
+                while True:
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                print ''.join(chunks)
+                return
+            except socket.error:
+                pass
+            finally:
+                sock.close()
+        if not os.path.exists(self.status_file):
+            raise CommandError('No backupd status found in %s' % self.status_file)
+        print open(self.status_file).read()
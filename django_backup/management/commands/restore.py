@@ -1,14 +1,25 @@
 import os
+import subprocess
 import time
+from datetime import datetime
 from optparse import make_option
 from tempfile import gettempdir
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
-import pysftp as ssh
-
+from django_backup import cas
+from django_backup import crypto
+from django_backup import delta
+from django_backup import drill
+from django_backup import fastload
+from django_backup import incremental
+from django_backup.db import ClientError, DatabaseClient
+from django_backup.plan import walk_sizes
+from django_backup.report import RunReport
+from django_backup.storage import LocalStorage, SFTPStorage, StorageError, get_default_storage
 from backup import TIME_FORMAT
+from backup import get_date
 from backup import is_db_backup
 from backup import is_media_backup
 
@@ -18,6 +29,14 @@ class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option('--media', '-m', action='store_true', default=False, dest='media',
             help='Restore media dir'),
+        make_option('--fast', action='store_true', default=False, dest='fast',
+            help='Load the database with bulk settings and check the row counts'),
+        make_option('--drill', action='store_true', default=False, dest='drill',
+            help='Restore into a scratch database and media directory and check the tables'),
+        make_option('--allow-unchecked', action='store_true', default=False, dest='allow_unchecked',
+            help='Let a drill pass when the backup has no recorded table checks'),
+        make_option('--backup', dest='backup', metavar='TIME',
+            help='Restore the newest backup taken at or before TIME (YYYYmmdd-HHMMSS)'),
     )
 
     def _time_suffix(self):
@@ -41,56 +60,125 @@ class Command(BaseCommand):
 
         self.backup_dir = settings.BACKUP_LOCAL_DIRECTORY
         self.remote_dir = settings.RESTORE_FROM_FTP_DIRECTORY or ''
-        self.ftp_server = settings.BACKUP_FTP_SERVER
-        self.ftp_username = settings.BACKUP_FTP_USERNAME
-        self.ftp_password = settings.BACKUP_FTP_PASSWORD
         self.restore_media = options.get('media')
+        self.drill = options.get('drill')
+        self.fast = options.get('fast') or self.drill
+        self.allow_unchecked = options.get('allow_unchecked')
+        self.tempdir = gettempdir()
+        self.media_root = settings.MEDIA_ROOT
+        if self.drill:
+            self.set_drill_targets()
 
-        print 'Connecting to %s...' % self.ftp_server
-        sftp = self.get_connection()
-        print 'Connected.'
-        backups = [i.strip() for i in sftp.execute('ls %s' % (self.remote_dir))]
+        try:
+            self.storage = get_default_storage(settings, directory=self.remote_dir)
+        except StorageError, e:
+            raise CommandError(str(e))
+        print 'Listing backups on %s...' % self.storage
+        backups = dict((entry.name, entry) for entry in self.storage.list())
         db_backups = filter(is_db_backup, backups)
         db_backups.sort()
-        if self.restore_media:
-            media_backups = filter(is_media_backup, backups)
-            media_backups.sort()
-
-        self.tempdir = gettempdir()
+        media_backups = filter(is_media_backup, backups)
+        media_backups.sort()
+        if options.get('backup'):
+            try:
+                limit = datetime.strptime(options['backup'], TIME_FORMAT)
+            except ValueError:
+                raise CommandError('--backup takes a time like %s' % self._time_suffix())
+            db_backups = [i for i in db_backups if get_date(i) <= limit]
+            media_backups = [i for i in media_backups if get_date(i) <= limit]
+        if not db_backups:
+            raise CommandError('No database backup found on %s' % self.storage)
+        if self.restore_media and not media_backups:
+            raise CommandError('No media backup found on %s' % self.storage)
 
         db_remote = db_backups[-1]
         if self.restore_media:
             media_remote = media_backups[-1]
 
+        self.report = RunReport(drill.get_drill_report_file(settings, self.backup_dir),
+                                backup=db_remote, database=self.db, fast=self.fast)
+        if self.drill:
+            self.report.data['verified'] = False
+        try:
+            recorded = None
+            if self.drill:
+                recorded = self.read_recorded_checks(db_remote, backups)
+            with self.report.stage('fetch'):
+                sql_local = self.fetch_database(db_remote, backups)
+            if self.restore_media:
+                with self.report.stage('media') as record:
+                    self.fetch_media(media_remote, backups)
+                    record['files'], record['bytes'], changed = walk_sizes(self.media_root)
+            self.storage.close()
+            if self.drill:
+                self.recreate_drill_database()
+            with self.report.stage('load'):
+                self.load_database(sql_local)
+            if self.drill:
+                self.check_drill(recorded)
+        except Exception, e:
+            self.report.fail(e)
+            raise
+        finally:
+            if self.drill:
+                self.save_drill_report()
+
+    def fetch_database(self, db_remote, backups):
+        '''
+        fetch the database backup into tempdir, returning the plain script.
+        '''
         db_local = os.path.join(self.tempdir, db_remote)
         print 'Fetching database %s...' % db_remote
-        sftp.get(os.path.join(self.remote_dir, db_remote), db_local)
+        if incremental.is_incremental(db_remote):
+            sql_local = db_local[:-len(incremental.TABLES_SUFFIX)] + '.sql'
+            print 'Assembling database from table backups...'
+            self.fetch_tables(db_remote, sql_local)
+            return sql_local
+        if delta.is_delta(db_remote):
+            db_local = os.path.join(self.tempdir, delta.logical_name(db_remote))
+            print 'Rebuilding database from deltas...'
+            self.fetch_delta_chain(db_remote, db_local, backups)
+        elif crypto.is_encrypted(db_remote):
+            db_local = db_local[:-len(crypto.ENCRYPTED_SUFFIX)]
+            print 'Decrypting database while fetching...'
+            self.fetch_decrypted(db_remote, db_local)
+        else:
+            self.storage.get_file(db_remote, db_local)
         print 'Uncompressing database...'
         uncompressed = self.uncompress(db_local)
         if uncompressed is 0:
-            sql_local = db_local[:-3]
+            return db_local[:-3]
+        return db_local
+
+    def fetch_media(self, media_remote, backups):
+        print 'Fetching media %s...' % media_remote
+        media_local = os.path.join(self.tempdir, media_remote)
+        #check if the media is compressed or a folder
+        if backups[media_remote].is_dir:
+            self.rsync_restore_media(media_remote)
+        elif cas.is_cas_backup(media_remote):
+            print 'Restoring media files in parallel...'
+            store = cas.ContentStore(self.storage, getattr(settings, 'BACKUP_CAS_WORKERS', cas.DEFAULT_WORKERS))
+            try:
+                total, restored = store.restore(media_remote, self.media_root,
+                                                os.path.basename(os.path.normpath(settings.MEDIA_ROOT)))
+            except cas.CASError, e:
+                raise CommandError(str(e))
+            print 'restored %d of %d media files' % (restored, total)
+        elif crypto.is_encrypted(media_remote):
+            print 'Decrypting and uncompressing media while fetching...'
+            self.restore_encrypted_media(media_remote)
         else:
-            sql_local = db_local
-        if self.restore_media:
-            print 'Fetching media %s...' % media_remote
-            media_local = os.path.join(self.tempdir, media_remote)
-            media_remote_full_path = os.path.join(self.remote_dir, media_remote)
-            #check if the media is compressed or a folder
-            cmd = 'if [[ -d "%s" ]]; then echo 1; else echo 0; fi'
-            is_folder = int(sftp.execute(cmd % media_remote_full_path)[0])
-            if is_folder == 1:
-                media_dir = os.path.join(media_remote_full_path, "media")
-                #A trailing slash to transfer only the contents of the folder
-                remote_rsync = '%s@%s:%s/' % (self.ftp_username, self.ftp_server, media_dir)
-                rsync_restore_cmd = 'rsync -az %s %s' % (remote_rsync, settings.MEDIA_ROOT)
-                print 'Running rsync restore command: ', rsync_restore_cmd
-                os.system(rsync_restore_cmd)
-            else:
-                sftp.get(media_remote_full_path, media_local)
-                print 'Uncompressing media...'
-                self.uncompress_media(media_local)
+            self.storage.get_file(media_remote, media_local)
+            print 'Uncompressing media...'
+            self.uncompress_media(media_local)
+
+    def load_database(self, sql_local):
         # Doing restore
-        if self.engine == 'django.db.backends.mysql':
+        if self.fast:
+            print 'Doing fast restore to database %s from %s...' % (self.db, sql_local)
+            self.fast_restore(sql_local)
+        elif self.engine == 'django.db.backends.mysql':
             print 'Doing Mysql restore to database %s from %s...' % (self.db, sql_local)
             self.mysql_restore(sql_local)
         # TODO reinstate postgres support
@@ -100,11 +188,209 @@ class Command(BaseCommand):
         else:
             raise CommandError('Backup in %s engine not implemented' % self.engine)
 
-    def get_connection(self):
+    def get_client(self):
+        return DatabaseClient(self.engine, self.db, self.user, self.passwd, self.host, self.port)
+
+    def set_drill_targets(self):
+        '''
+        point the restore at BACKUP_DRILL_DATABASE and a directory below
+        BACKUP_DRILL_MEDIA_ROOT, never at the configured database and media.
+        '''
+        production_db = self.db
+        self.db = getattr(settings, 'BACKUP_DRILL_DATABASE', None) or '%s_drill' % production_db
+        drill_root = getattr(settings, 'BACKUP_DRILL_MEDIA_ROOT', None) or self.tempdir
+        if self.db == production_db:
+            raise CommandError('BACKUP_DRILL_DATABASE is the database in use')
+        self.media_root = os.path.join(drill_root, drill.DRILL_MEDIA_DIRNAME)
+        if self.restore_media:
+            try:
+                self.media_root = drill.prepare_media_root(drill_root, settings.MEDIA_ROOT)
+            except (drill.DrillError, OSError, IOError), e:
+                raise CommandError('Could not prepare the drill media directory: %s' % e)
+        print 'Drill: restoring into database %s and %s' % (self.db, self.media_root)
+
+    def read_recorded_checks(self, db_remote, backups):
+        name = drill.checks_name(get_date(db_remote).strftime(TIME_FORMAT))
+        if name not in backups:
+            if not self.allow_unchecked:
+                raise CommandError('No table checks were recorded with %s, see backup --checks, '
+                                   'or pass --allow-unchecked' % db_remote)
+            print 'no table checks were recorded with %s, the tables are not verified' % db_remote
+            return None
+        try:
+            return drill.read_checks(self.storage, name)
+        except (IOError, ValueError), e:
+            raise CommandError('Could not read %s: %s' % (name, e))
+
+    def recreate_drill_database(self):
+        client = self.get_client()
+        print 'Recreating database %s...' % self.db
+        try:
+            # one statement per call, postgres won't drop a database in a transaction
+            client.execute('DROP DATABASE IF EXISTS %s' % client.quote_name(self.db), database=False)
+            client.execute('CREATE DATABASE %s' % client.quote_name(self.db), database=False)
+        except (ClientError, OSError), e:
+            raise CommandError('Could not recreate %s: %s' % (self.db, e))
+
+    def check_drill(self, recorded):
         '''
-        get the ssh connection to the remote server.
+        compare the row counts and checksums of the restored tables with
+        the ones recorded at backup time.
         '''
-        return ssh.Connection(host=self.ftp_server, username=self.ftp_username, password=self.ftp_password)
+        print 'Checking the restored tables...'
+        with self.report.stage('checks') as record:
+            try:
+                restored = drill.table_checks(self.get_client(),
+                                              workers=getattr(settings, 'BACKUP_DRILL_WORKERS',
+                                                              drill.DEFAULT_WORKERS))
+            except (ClientError, OSError), e:
+                raise CommandError('Could not check the restored tables: %s' % e)
+            record['tables'] = len(restored)
+        if recorded is None:
+            return
+        compared = drill.compared_tables(recorded)
+        mismatches = drill.compare(recorded, restored)
+        record['compared'] = len(compared)
+        record['mismatches'] = len(mismatches)
+        describe = lambda check: '%d rows, checksum %s' % tuple(check) if check else 'missing'
+        for table, (expected, actual) in sorted(mismatches.items()):
+            print '\t%s: %s recorded, %s restored' % (table, describe(expected), describe(actual))
+        print '%d tables checked, %d written during the backup or without a change signal and skipped' % (
+            len(compared), len(recorded['tables']) - len(compared))
+        if mismatches:
+            raise CommandError('%d tables do not match the backup' % len(mismatches))
+        if not compared:
+            raise CommandError('No table was compared: every table changed during the backup '
+                               'or has no change signal')
+        self.report.data['verified'] = True
+
+    def save_drill_report(self):
+        stages = self.report.data['stages']
+        restore_seconds = sum(stages[i]['seconds'] for i in ('fetch', 'media', 'load') if i in stages)
+        self.report.data['restore_seconds'] = round(restore_seconds, 3)
+        directory = os.path.dirname(self.report.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.report.save()
+        print '=' * 70
+        print self.report.summary()
+        print 'time to restore: %.1fs' % restore_seconds
+        print 'tables verified: %s' % ('yes' if self.report.data.get('verified') else 'no')
+
+    def fast_restore(self, infile):
+        workers = getattr(settings, 'BACKUP_RESTORE_WORKERS', fastload.DEFAULT_WORKERS)
+        started = time.time()
+        try:
+            client = self.get_client()
+            if client.is_mysql:
+                counts = fastload.mysql_fast_load(
+                    client, infile, batch=getattr(settings, 'BACKUP_RESTORE_BATCH', fastload.DEFAULT_BATCH))
+            else:
+                counts = fastload.postgresql_fast_load(
+                    client, infile, workers, log=os.path.join(self.tempdir, 'dump.log'),
+                    maintenance_work_mem=getattr(settings, 'BACKUP_RESTORE_MAINTENANCE_WORK_MEM',
+                                                 fastload.DEFAULT_MAINTENANCE_WORK_MEM),
+                    clean=not self.drill)
+            print 'loaded in %.1fs, checking row counts of %d tables...' % (time.time() - started, len(counts))
+            mismatches = fastload.check_row_counts(client, counts, workers)
+        except ClientError, e:
+            raise CommandError(str(e))
+        for table, (expected, restored) in sorted(mismatches.items()):
+            print '\t%s: %s rows in the dump, %s restored' % (table, expected, restored)
+        if mismatches:
+            raise CommandError('%d tables do not match the dump' % len(mismatches))
+
+    def fetch_tables(self, name, local_path):
+        '''
+        write the script of an incremental backup: the schema and the data
+        of every table, from whichever backup last dumped it.
+        '''
+        out = open(local_path, 'wb')
+        try:
+            manifest = incremental.assemble(self.storage, name, out)
+        except (IOError, KeyError, ValueError), e:
+            raise CommandError('Could not assemble %s: %s' % (name, e))
+        finally:
+            out.close()
+        print '\t%d tables' % len(manifest['tables'])
+
+    def fetch_delta_chain(self, name, local_path, backups):
+        '''
+        fetch the full dump a delta is based on and apply the deltas on top
+        of it, oldest first.
+        '''
+        try:
+            chain = delta.resolve_chain(self.storage, name, backups)
+        except delta.DeltaError, e:
+            raise CommandError(str(e))
+        print '\t', ' <- '.join(chain)
+        self.storage.get_file(chain[-1], local_path)
+        for patch in reversed(chain[:-1]):
+            rebuilt = local_path + '.rebuilt'
+            base = open(local_path, 'rb')
+            stream = self.storage.get_stream(patch)
+            out = open(rebuilt, 'wb')
+            try:
+                delta.apply_delta(base, stream, out)
+            except delta.DeltaError, e:
+                raise CommandError('Could not apply %s: %s' % (patch, e))
+            finally:
+                out.close()
+                stream.close()
+                base.close()
+            os.rename(rebuilt, local_path)
+
+    def rsync_restore_media(self, media_remote):
+        if isinstance(self.storage, LocalStorage):
+            media_dir = os.path.join(self.storage.path(media_remote), "media")
+            source = media_dir
+        elif isinstance(self.storage, SFTPStorage):
+            media_dir = os.path.join(self.storage.path(media_remote), "media")
+            source = '%s@%s:%s' % (self.storage.username, self.storage.server, media_dir)
+        else:
+            raise CommandError('rsync media backups cannot be restored from %s' % self.storage)
+        #A trailing slash to transfer only the contents of the folder
+        rsync_restore_cmd = 'rsync -az %s/ %s' % (source, self.media_root)
+        print 'Running rsync restore command: ', rsync_restore_cmd
+        os.system(rsync_restore_cmd)
+
+    def get_encryption_key(self):
+        if not hasattr(self, 'encryption_key'):
+            try:
+                self.encryption_key = crypto.load_key(settings)
+            except crypto.EncryptionError, e:
+                raise CommandError(str(e))
+        return self.encryption_key
+
+    def decrypt_remote(self, remote_path, out):
+        '''
+        decrypt a remote file into out as it is downloaded.
+        '''
+        remote = self.storage.get_stream(remote_path)
+        try:
+            crypto.decrypt_stream(remote, out, self.get_encryption_key(),
+                workers=getattr(settings, 'BACKUP_ENCRYPTION_WORKERS', crypto.DEFAULT_WORKERS))
+        except crypto.EncryptionError, e:
+            raise CommandError('Could not decrypt %s: %s' % (remote_path, e))
+        finally:
+            remote.close()
+
+    def fetch_decrypted(self, remote_path, local_path):
+        out = open(local_path, 'wb')
+        try:
+            self.decrypt_remote(remote_path, out)
+        finally:
+            out.close()
+
+    def restore_encrypted_media(self, remote_path):
+        cmd = ['tar', '-C', self.media_root, '-xzf', '-']
+        print '\t', ' '.join(cmd)
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        try:
+            self.decrypt_remote(remote_path, process.stdin)
+        finally:
+            process.stdin.close()
+            process.wait()
 
     def uncompress(self, file):
         cmd = 'cd %s;gzip -df %s' % (self.tempdir, file)
@@ -112,7 +398,7 @@ class Command(BaseCommand):
         return os.system(cmd)
 
     def uncompress_media(self, file):
-        cmd = u'tar -C %s -xzf %s' % (settings.MEDIA_ROOT, file)
+        cmd = u'tar -C %s -xzf %s' % (self.media_root, file)
         print u'\t', cmd
         os.system(cmd)
 
@@ -0,0 +1,292 @@
+'''
+Estimates of how large and how long a backup run will be.
+
+Sizes come from the database's own statistics (information_schema or
+pg_class) and a stat walk of the media directories; the ratios between
+those and the files a run really writes, and the throughput of every stage,
+come from the run reports of earlier runs (see django_backup.report).
+Without history the defaults below are used, so the first estimates are
+rough.
+'''
+import os
+import stat
+from multiprocessing.pool import ThreadPool
+
+from django_backup.snapshots import format_size
+
+DEFAULT_WORKERS = 8
+HISTORY_RUNS = 10
+# used until there is history to measure them
+DUMP_RATIO = 1.0            # text dump bytes per byte of table data
+COMPRESS_RATIO = 0.25       # gzip output per dump byte
+MEDIA_RATIO = 1.0           # media archive bytes per byte of media
+SPACE_MARGIN = 1.1
+
+MYSQL_TABLES = '''SELECT table_name, data_length, table_rows FROM information_schema.tables
+WHERE table_schema = DATABASE() AND table_type = 'BASE TABLE' '''
+POSTGRESQL_TABLES = '''SELECT c.relname, pg_table_size(c.oid), c.reltuples::bigint FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind = 'r' AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+AND n.nspname NOT LIKE 'pg_toast%' '''
+
+
+def database_stats(client, exclude=()):
+    '''
+    (bytes, rows, tables) of the data the dump will hold, leaving out the
+    tables dumped without data.
+    '''
+    rows = client.query(MYSQL_TABLES if client.is_mysql else POSTGRESQL_TABLES)
+    size = count = tables = 0
+    for name, table_bytes, table_rows in rows:
+        if name in exclude:
+            continue
+        size += int(table_bytes or 0)
+        count += max(int(table_rows or 0), 0)
+        tables += 1
+    return size, count, tables
+
+
+def walk_sizes(top, since=None):
+    files = size = changed = 0
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            files += 1
+            size += st.st_size
+            if since is not None and st.st_mtime >= since:
+                changed += st.st_size
+    return files, size, changed
+
+
+def media_stats(directories, workers=DEFAULT_WORKERS, since=None):
+    '''
+    (files, bytes, bytes changed since the since timestamp) below the
+    directories, walking their subdirectories in parallel.
+    '''
+    tops = []
+    files = size = changed = 0
+    for directory in directories:
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                tops.append(path)
+                continue
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files += 1
+                size += st.st_size
+                if since is not None and st.st_mtime >= since:
+                    changed += st.st_size
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(lambda top: walk_sizes(top, since), tops, chunksize=1)
+    finally:
+        pool.terminate()
+    for top_files, top_size, top_changed in results:
+        files += top_files
+        size += top_size
+        changed += top_changed
+    return files, size, changed
+
+
+def free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def stage_rate(runs, name, key='bytes', seconds_key='seconds'):
+    '''
+    the median bytes per second stage name managed in earlier runs.
+    '''
+    rates = []
+    for run in runs:
+        record = run.get('stages', {}).get(name)
+        if record and record.get('streamed'):
+            # a streamed dump's time includes compressing it
+            continue
+        if record and record.get(key) and record.get(seconds_key):
+            rates.append(record[key] / record[seconds_key])
+    return median(rates)
+
+
+def upload_rate(runs):
+    '''
+    the median bytes per second earlier uploads were sent at, by the
+    slowest destination with --fanout. Runs from before the uploads were
+    timed on their own fall back to the upload stage's time.
+    '''
+    return stage_rate(runs, 'upload', 'sent_bytes', 'send_seconds') or stage_rate(runs, 'upload')
+
+
+def dump_size(run):
+    '''
+    the size of the plain dump of an earlier run, None when it is unknown.
+    '''
+    dump = run['stages']['dump']
+    if 'dump_bytes' in dump:
+        return dump['dump_bytes']
+    if dump.get('streamed') or dump.get('incremental'):
+        return None
+    return dump.get('bytes')
+
+
+def compressed_ratio(run):
+    dump = run['stages']['dump']
+    if dump.get('streamed'):
+        return float(dump['bytes']) / dump['dump_bytes']
+    return float(run['stages']['compress']['bytes']) / dump['bytes']
+
+
+def run_ratio(runs, get, default):
+    ratios = []
+    for run in runs:
+        try:
+            value = get(run)
+        except (KeyError, TypeError, ZeroDivisionError):
+            continue
+        if value:
+            ratios.append(value)
+    return median(ratios) or default
+
+
+class BackupPlan(object):
+    '''
+    the estimated sizes and durations of a run.
+
+    database is (bytes, rows, tables) and media (files, bytes, changed
+    bytes), either may be None. mode is how the media is stored: 'tar',
+    'rsync' or 'cas'; rsync and cas only store what changed.
+    '''
+
+    def __init__(self, runs, database=None, media=None, compress=False, mode='tar',
+                 upload=False, stream=False):
+        self.runs = runs
+        self.database = database
+        self.media = media
+        self.compress = compress
+        self.mode = mode
+        self.upload = upload
+        self.stream = stream
+        self.estimate()
+
+    def estimate(self):
+        runs = self.runs
+        self.dump_bytes = self.compressed_bytes = self.media_bytes = 0
+        if self.database:
+            ratio = run_ratio(runs, lambda run: float(dump_size(run)) / run['database_bytes'], DUMP_RATIO)
+            self.dump_bytes = int(self.database[0] * ratio)
+        else:
+            # without statistics, expect the size of the last dump
+            dumps = [dump_size(run) for run in runs if 'dump' in run.get('stages', {})]
+            dumps = [i for i in dumps if i]
+            if dumps:
+                self.dump_bytes = dumps[-1]
+        if self.dump_bytes:
+            if self.compress:
+                ratio = run_ratio(runs, compressed_ratio, COMPRESS_RATIO)
+                self.compressed_bytes = int(self.dump_bytes * ratio)
+        if self.media:
+            files, size, changed = self.media
+            if self.mode in ('rsync', 'cas'):
+                self.media_bytes = changed
+            else:
+                ratio = run_ratio(runs, lambda run: float(run['stages']['media']['bytes']) /
+                                  run['stages']['media']['source_bytes'], MEDIA_RATIO)
+                self.media_bytes = int(size * ratio)
+
+        self.seconds = {}
+        rate = stage_rate(runs, 'dump')
+        if self.dump_bytes and rate:
+            self.seconds['dump'] = self.dump_bytes / rate
+        rate = stage_rate(runs, 'compress', 'bytes_in')
+        if self.compressed_bytes and rate:
+            self.seconds['compress'] = self.dump_bytes / rate
+        rate = stage_rate(runs, 'media')
+        if self.media_bytes and rate:
+            self.seconds['media'] = self.media_bytes / rate
+        rate = upload_rate(runs)
+        if self.upload and rate:
+            self.seconds['upload'] = self.upload_bytes / rate
+
+    @property
+    def stored_dump_bytes(self):
+        return self.compressed_bytes or self.dump_bytes
+
+    @property
+    def upload_bytes(self):
+        return self.stored_dump_bytes + self.media_bytes
+
+    def local_bytes(self, stream=None):
+        '''
+        the most local space the run needs at once. A plain dump is on disk
+        next to its compressed copy until compression ends; a streamed dump
+        is compressed as it is written.
+        '''
+        if stream is None:
+            stream = self.stream
+        if stream or not self.compress:
+            return self.stored_dump_bytes + self.media_bytes
+        return self.dump_bytes + self.compressed_bytes + self.media_bytes
+
+    @property
+    def total_seconds(self):
+        return sum(self.seconds.values())
+
+    def check_space(self, free):
+        '''
+        'ok' when the run fits in free bytes as planned, 'stream' when it
+        only fits with the dump streamed into the compressor, or None.
+        '''
+        if self.local_bytes() * SPACE_MARGIN <= free:
+            return 'ok'
+        if self.compress and self.local_bytes(stream=True) * SPACE_MARGIN <= free:
+            return 'stream'
+        return None
+
+    def lines(self):
+        lines = []
+        if self.database:
+            size, rows, tables = self.database
+            lines.append('database: %d tables, ~%d rows, %s of data' % (tables, rows, format_size(size)))
+        if self.dump_bytes:
+            lines.append('dump: %s' % format_size(self.dump_bytes))
+            if self.compress:
+                lines.append('compressed dump: %s' % format_size(self.compressed_bytes))
+        if self.media:
+            files, size, changed = self.media
+            lines.append('media: %d files, %s, %s changed since the last run' % (
+                files, format_size(size), format_size(changed)))
+            lines.append('media backup (%s): %s' % (self.mode, format_size(self.media_bytes)))
+        if self.upload:
+            lines.append('upload: %s' % format_size(self.upload_bytes))
+        lines.append('local space needed: %s' % format_size(self.local_bytes()))
+        for name in ('dump', 'compress', 'media', 'upload'):
+            if name in self.seconds:
+                lines.append('%s: ~%ds' % (name, self.seconds[name]))
+        if self.seconds:
+            lines.append('expected duration: ~%ds' % self.total_seconds)
+        if not self.runs:
+            lines.append('no earlier runs recorded, durations unknown and sizes rough')
+        return lines
@@ -0,0 +1,100 @@
+'''
+Run reports.
+
+Every backup run records how long each stage took and how much data it
+handled, and appends the report as one JSON line to BACKUP_REPORT_FILE
+(``.backup_runs`` in BACKUP_LOCAL_DIRECTORY by default). The history shows
+where a run spends its time and gives later runs the throughput to expect.
+'''
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from django_backup.snapshots import format_size
+
+REPORT_FILENAME = '.backup_runs'
+
+
+def get_report_file(settings, backup_dir):
+    return getattr(settings, 'BACKUP_REPORT_FILE', None) or os.path.join(backup_dir, REPORT_FILENAME)
+
+
+class RunReport(object):
+
+    def __init__(self, path, **info):
+        self.path = path
+        self.started = time.time()
+        self.data = dict(info)
+        self.data['started'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.data['stages'] = {}
+        self.order = []
+
+    @contextmanager
+    def stage(self, name, **info):
+        '''
+        time the body as stage name. It gets the stage's dict, to add sizes
+        and anything else worth keeping.
+        '''
+        record = dict(info)
+        started = time.time()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.time() - started, 3)
+            self.data['stages'][name] = record
+            self.order.append(name)
+
+    def fail(self, error):
+        self.data['error'] = str(error) or error.__class__.__name__
+
+    def save(self):
+        self.data['seconds'] = round(time.time() - self.started, 3)
+        f = open(self.path, 'a')
+        try:
+            f.write(json.dumps(self.data, sort_keys=True) + '\n')
+        finally:
+            f.close()
+
+    def summary(self):
+        lines = []
+        for name in self.order:
+            record = self.data['stages'][name]
+            line = '%-10s %8.1fs' % (name, record['seconds'])
+            if record.get('bytes'):
+                line += '  %s' % format_size(record['bytes'])
+            if record.get('sent_bytes') and record.get('send_seconds'):
+                line += '  sent at %s/s' % format_size(record['sent_bytes'] / record['send_seconds'])
+            if record.get('levels'):
+                line += '  gzip levels %s' % ', '.join(
+                    '%s x%d' % i for i in sorted(record['levels'].items()))
+            if record.get('errors'):
+                line += '  %d unreadable directories' % len(record['errors'])
+            lines.append(line)
+        lines.append('%-10s %8.1fs' % ('total', time.time() - self.started))
+        return '\n'.join(lines)
+
+
+def read_history(path, limit=None):
+    '''
+    the reports of earlier runs, oldest first, skipping failed runs.
+    '''
+    runs = []
+    try:
+        f = open(path)
+    except IOError:
+        return runs
+    try:
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            if 'error' not in run:
+                runs.append(run)
+    finally:
+        f.close()
+    if limit:
+        runs = runs[-limit:]
+    return runs
@@ -0,0 +1,84 @@
+'''
+A small cron expression parser for the ``backupd`` scheduler.
+
+Supports the five standard fields (minute, hour, day of month, month, day of
+week) with ``*``, lists, ranges and steps, e.g. ``*/15 1-5 * * 1,3,5``.
+'''
+from datetime import timedelta
+
+FIELDS = (
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day', 1, 31),
+    ('month', 1, 12),
+    ('weekday', 0, 7),
+)
+
+
+def parse_field(spec, low, high):
+    '''
+    given one cron field and its bounds, return the set of values it allows.
+    '''
+    values = set()
+    for part in spec.split(','):
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        else:
+            step = 1
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(i) for i in part.split('-', 1)]
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError('invalid cron field %r' % spec)
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule(object):
+
+    def __init__(self, expression):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError('cron expression needs 5 fields: %r' % expression)
+        self.expression = expression
+        for (name, low, high), spec in zip(FIELDS, parts):
+            setattr(self, name + 's', parse_field(spec, low, high))
+        # 7 is an alias for sunday
+        if 7 in self.weekdays:
+            self.weekdays.discard(7)
+            self.weekdays.add(0)
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    def __str__(self):
+        return self.expression
+
+    def match_day(self, d):
+        # cron weekdays start on sunday, python's on monday
+        weekday = (d.weekday() + 1) % 7
+        if self.any_day or self.any_weekday:
+            return d.day in self.days and weekday in self.weekdays
+        # when both are restricted cron runs on either
+        return d.day in self.days or weekday in self.weekdays
+
+    def next_after(self, after):
+        '''
+        return the first datetime strictly after `after` matching the schedule.
+        '''
+        d = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = d + timedelta(days=366 * 4)
+        while d < limit:
+            if d.month not in self.months or not self.match_day(d):
+                d = d.replace(hour=0, minute=0) + timedelta(days=1)
+            elif d.hour not in self.hours:
+                d = d.replace(minute=0) + timedelta(hours=1)
+            elif d.minute not in self.minutes:
+                d += timedelta(minutes=1)
+            else:
+                return d
+        raise ValueError('cron expression never matches: %r' % self.expression)
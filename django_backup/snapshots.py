@@ -0,0 +1,234 @@
+'''
+Hardlink-aware space accounting and pruning for the ``dir_<ts>`` snapshot
+trees built by ``backup --rsync`` with ``--link-dest``.
+
+Every snapshot shares unchanged files with its neighbours through hardlinks,
+so ``du`` on a single snapshot says nothing about what deleting it frees.
+The scanner below indexes every snapshot by inode, which lets us tell the
+bytes held by one snapshot alone from the bytes shared with others.
+'''
+import cPickle as pickle
+import os
+import Queue
+import threading
+
+INDEX_FILENAME = '.snapshot_index'
+INDEX_VERSION = 3
+DEFAULT_WORKERS = 8
+
+
+def _signature(path, flag):
+    '''
+    cheap fingerprint of a snapshot directory. Snapshots are written once by
+    rsync and then only ever marked good or deleted, so the mtime of the root
+    plus the presence of the good flag is enough to tell if it changed.
+    '''
+    st = os.lstat(path)
+    return (st.st_mtime, st.st_ino, os.path.exists(os.path.join(path, flag)))
+
+
+def scan_snapshot(path):
+    '''
+    walk a snapshot and return {(st_dev, st_ino): [size, nlink, links_seen]}.
+    '''
+    inodes = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            full_path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(full_path)
+            except OSError:
+                continue
+            key = (st.st_dev, st.st_ino)
+            entry = inodes.get(key)
+            if entry is None:
+                inodes[key] = [st.st_size, st.st_nlink, 1]
+            else:
+                entry[2] += 1
+    return inodes
+
+
+class SnapshotIndex(object):
+    '''
+    inode index over all the snapshots in a backup directory, persisted in
+    ``INDEX_FILENAME`` so only new or changed snapshots are walked again.
+
+    links holds, per inode, its size, its current nlink and the links to it
+    seen across all snapshots. They are kept up to date as snapshots come
+    and go: a scan reads the nlink of its inodes afresh, and a snapshot that
+    disappears takes its links off the inodes it held.
+    '''
+
+    def __init__(self, backup_dir, flag):
+        self.backup_dir = backup_dir
+        self.flag = flag
+        self.index_file = os.path.join(backup_dir, INDEX_FILENAME)
+        self.snapshots = {}
+        self.links = {}
+        self.load()
+
+    def load(self):
+        try:
+            f = open(self.index_file, 'rb')
+            try:
+                data = pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, pickle.UnpicklingError, ValueError):
+            return
+        if data.get('version') == INDEX_VERSION:
+            self.snapshots = data['snapshots']
+            self.links = data['links']
+
+    def save(self):
+        tmp = self.index_file + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            pickle.dump({'version': INDEX_VERSION, 'snapshots': self.snapshots, 'links': self.links},
+                        f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, self.index_file)
+
+    def refresh(self, names):
+        '''
+        bring the index up to date for the given snapshot names, dropping
+        snapshots that no longer exist. Returns the names that were rescanned.
+        '''
+        scanned = []
+        removed = [name for name in self.snapshots if name not in names]
+        for name in removed:
+            self._unlink(self.snapshots.pop(name)['inodes'])
+        for name in names:
+            path = os.path.join(self.backup_dir, name)
+            signature = _signature(path, self.flag)
+            cached = self.snapshots.get(name)
+            if cached is not None and cached['signature'] == signature:
+                continue
+            if cached is not None:
+                # the links it no longer has are gone, the rest are read again
+                self._unlink(cached['inodes'])
+            inodes = scan_snapshot(path)
+            self._link(inodes)
+            self.snapshots[name] = {'signature': signature, 'inodes': inodes}
+            scanned.append(name)
+        if scanned or removed:
+            self.save()
+        return scanned
+
+    def _link(self, inodes):
+        for key, (size, nlink, seen) in inodes.iteritems():
+            entry = self.links.get(key)
+            if entry is None:
+                self.links[key] = [size, nlink, seen]
+            else:
+                # just read, so newer than what the index had
+                entry[1] = nlink
+                entry[2] += seen
+
+    def _unlink(self, inodes):
+        for key, (size, nlink, seen) in inodes.iteritems():
+            entry = self.links[key]
+            entry[1] -= seen
+            entry[2] -= seen
+            if entry[2] <= 0:
+                del self.links[key]
+
+    def usage(self):
+        '''
+        return {name: (apparent_bytes, unique_bytes)} for every snapshot.
+        unique bytes are held by files no other snapshot links to.
+        '''
+        result = {}
+        for name, snapshot in self.snapshots.iteritems():
+            apparent = unique = 0
+            for key, (size, nlink, seen) in snapshot['inodes'].iteritems():
+                apparent += size
+                total = self.links[key]
+                if total[2] == seen and seen >= total[1]:
+                    unique += size
+            result[name] = (apparent, unique)
+        return result
+
+    def reclaimable(self, remove_list):
+        '''
+        bytes freed by deleting every snapshot in remove_list together.
+        files still linked from a kept snapshot, or from anywhere outside the
+        indexed snapshots, are not counted.
+        '''
+        remove = set(remove_list)
+        removed_links = {}
+        for name in remove:
+            snapshot = self.snapshots.get(name)
+            if snapshot is None:
+                continue
+            for key, (size, nlink, seen) in snapshot['inodes'].iteritems():
+                removed_links[key] = removed_links.get(key, 0) + seen
+        freed = 0
+        for key, seen in removed_links.iteritems():
+            size, nlink, total = self.links[key]
+            if seen == total and seen >= nlink:
+                freed += size
+        return freed
+
+
+def format_size(num):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(num) < 1024.0:
+            return '%3.1f%s' % (num, unit)
+        num /= 1024.0
+    return '%3.1f%s' % (num, 'TB')
+
+
+def remove_tree(path, workers=DEFAULT_WORKERS):
+    '''
+    delete a directory tree, unlinking files from a pool of worker threads
+    while the tree is still being walked. Directories are removed bottom-up
+    once all their files are gone.
+    '''
+    if os.path.islink(path) or not os.path.isdir(path):
+        os.unlink(path)
+        return
+    queue = Queue.Queue(maxsize=workers * 256)
+    errors = []
+
+    def worker():
+        while True:
+            item = queue.get()
+            try:
+                if item is None:
+                    return
+                try:
+                    os.unlink(item)
+                except OSError, e:
+                    errors.append((item, e))
+            finally:
+                queue.task_done()
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, workers))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    directories = []
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for name in filenames:
+            queue.put(os.path.join(dirpath, name))
+        for name in dirnames:
+            # os.walk does not descend into symlinked directories
+            full_path = os.path.join(dirpath, name)
+            if os.path.islink(full_path):
+                queue.put(full_path)
+        directories.append(dirpath)
+    for t in threads:
+        queue.put(None)
+    queue.join()
+    if errors:
+        raise OSError('could not remove %s: %s' % errors[0])
+    for directory in directories:
+        os.rmdir(directory)
+
+
+def remove_snapshots(paths, workers=DEFAULT_WORKERS):
+    for path in paths:
+        print 'Removing %s' % path
+        remove_tree(path, workers)
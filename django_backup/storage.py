@@ -0,0 +1,603 @@
+'''
+Storage backends for backup artifacts.
+
+Every backend stores named artifacts below a root (a local directory, a
+directory on an SFTP server or a prefix in an S3 bucket) and implements:
+
+* ``open_writer(name)``: a file-like writer, stored on ``close()`` and
+  discarded on ``abort()``; ``put_stream`` and ``put_file`` are built on it
+* ``get_stream(name)``: a file-like reader
+* ``list(path='')``: the entries directly below path, with size and mtime
+  (seconds since the epoch, None for S3 prefixes which have none), leaving
+  out the ``.part`` files of uploads in progress or interrupted
+* ``delete_batch(names)``: delete several artifacts (or directories) at once
+* ``read_range(name, start, length)``: read part of an artifact
+
+The backend is chosen with BACKUP_STORAGE, e.g.::
+
+    BACKUP_STORAGE = {
+        'backend': 's3',
+        'bucket': 'backups',
+        'prefix': 'example.com',
+        'endpoint_url': 'http://localhost:9000',
+        'access_key': '...',
+        'secret_key': '...',
+    }
+
+``backend`` is ``local``, ``sftp``, ``s3`` or the dotted path of a
+BaseStorage subclass. Without BACKUP_STORAGE the BACKUP_FTP_* settings are
+used for SFTP storage.
+'''
+import calendar
+import os
+import pipes
+import stat
+import threading
+from collections import deque, namedtuple
+from importlib import import_module
+from multiprocessing.pool import ThreadPool
+
+from django_backup import connections
+from django_backup.snapshots import remove_tree
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+COPY_CHUNK_SIZE = 1024 * 1024
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+DEFAULT_WORKERS = 8
+PART_SUFFIX = '.part'
+
+StorageEntry = namedtuple('StorageEntry', 'name size mtime is_dir')
+
+
+class StorageError(Exception):
+    pass
+
+
+def epoch(value):
+    '''
+    seconds since the epoch of an aware datetime, as st_mtime would be.
+    '''
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def is_partial(name):
+    '''
+    whether name is an upload that never completed.
+    '''
+    return name.endswith(PART_SUFFIX)
+
+
+def copy_stream(source, target, chunk_size=COPY_CHUNK_SIZE):
+    total = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            return total
+        target.write(chunk)
+        total += len(chunk)
+
+
+class BaseStorage(object):
+
+    def __init__(self, **options):
+        self.options = options
+
+    def __str__(self):
+        return self.__class__.__name__
+
+    def ensure(self):
+        '''
+        create the storage root if it doesn't exist yet.
+        '''
+
+    def open_writer(self, name):
+        raise NotImplementedError
+
+    def get_stream(self, name):
+        raise NotImplementedError
+
+    def list(self, path=''):
+        raise NotImplementedError
+
+    def delete_batch(self, names):
+        raise NotImplementedError
+
+    def read_range(self, name, start, length):
+        stream = self.get_stream(name)
+        try:
+            stream.seek(start)
+            return stream.read(length)
+        finally:
+            stream.close()
+
+    def close(self):
+        pass
+
+    def for_worker(self, index):
+        '''
+        the storage worker thread number index should use. Backends whose
+        connections can't be shared between threads return a copy with a
+        connection of its own, which the caller closes.
+        '''
+        return self
+
+    def put_stream(self, name, stream):
+        writer = self.open_writer(name)
+        try:
+            total = copy_stream(stream, writer)
+        except:
+            writer.abort()
+            raise
+        writer.close()
+        return total
+
+    def put_file(self, name, path):
+        f = open(path, 'rb')
+        try:
+            return self.put_stream(name, f)
+        finally:
+            f.close()
+
+    def get_file(self, name, path):
+        stream = self.get_stream(name)
+        try:
+            f = open(path, 'wb')
+            try:
+                return copy_stream(stream, f)
+            finally:
+                f.close()
+        finally:
+            stream.close()
+
+    def listdir(self, path=''):
+        return [entry.name for entry in self.list(path)]
+
+    def exists(self, name):
+        path, filename = os.path.split(name)
+        try:
+            return filename in self.listdir(path)
+        except (IOError, OSError):
+            return False
+
+
+class LocalWriter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path + PART_SUFFIX, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        os.rename(self.path + PART_SUFFIX, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.path + PART_SUFFIX):
+            os.remove(self.path + PART_SUFFIX)
+
+
+class LocalStorage(BaseStorage):
+    '''
+    a directory on a local (or mounted) filesystem.
+    '''
+
+    def __init__(self, directory, **options):
+        BaseStorage.__init__(self, **options)
+        self.directory = directory
+
+    def __str__(self):
+        return 'local:%s' % self.directory
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def ensure(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def open_writer(self, name):
+        parent = os.path.dirname(self.path(name))
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        return LocalWriter(self.path(name))
+
+    def get_stream(self, name):
+        return open(self.path(name), 'rb')
+
+    def list(self, path=''):
+        entries = []
+        directory = self.path(path)
+        for name in os.listdir(directory):
+            if is_partial(name):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # a dangling symlink, like an rsync current link
+                st = os.lstat(path)
+            entries.append(StorageEntry(name, st.st_size, st.st_mtime, stat.S_ISDIR(st.st_mode)))
+        return entries
+
+    def delete_batch(self, names):
+        for name in names:
+            remove_tree(self.path(name), self.options.get('workers', DEFAULT_WORKERS))
+
+
+class SFTPWriter(object):
+    '''
+    writes to ``<path>.part`` and renames it on close, like LocalWriter, so
+    an interrupted upload never leaves a truncated artifact under its name.
+    '''
+
+    def __init__(self, storage, path):
+        self.storage = storage
+        self.path = path
+        self.file = connections.open_remote(storage.connect(), path + PART_SUFFIX, 'wb')
+        if hasattr(self.file, 'set_pipelined'):
+            self.file.set_pipelined(True)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        client = self.storage.client()
+        try:
+            # replaces path atomically where the server supports it
+            client.posix_rename(self.path + PART_SUFFIX, self.path)
+        except (AttributeError, IOError):
+            try:
+                client.remove(self.path)
+            except IOError:
+                pass
+            client.rename(self.path + PART_SUFFIX, self.path)
+
+    def abort(self):
+        try:
+            self.file.close()
+            self.storage.connect().execute('rm -f %s' % pipes.quote(self.path + PART_SUFFIX))
+        except Exception:
+            # the connection may be what failed, start over next time
+            self.storage.close()
+
+
+class SFTPStorage(BaseStorage):
+    '''
+    a directory on an SFTP server.
+    '''
+
+    def __init__(self, server, username=None, password=None, directory='', slot=0, **options):
+        BaseStorage.__init__(self, **options)
+        self.server = server
+        self.username = username
+        self.password = password
+        self.directory = directory or ''
+        self.slot = slot
+        self.connection = None
+        self.made_dirs = set()
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return 'sftp:%s:%s' % (self.server, self.directory)
+
+    def connect(self):
+        with self.lock:
+            if self.connection is None:
+                self.connection = connections.get_connection(self.server, self.username, self.password,
+                                                             self.slot)
+            return self.connection
+
+    def client(self):
+        '''
+        the paramiko SFTP client behind the pysftp connection.
+        '''
+        connection = self.connect()
+        return getattr(connection, 'sftp_client', None) or connection._sftp
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def for_worker(self, index):
+        if index == 0:
+            return self
+        storage = SFTPStorage(self.server, self.username, self.password, self.directory,
+                              slot=index, **self.options)
+        storage.made_dirs = self.made_dirs
+        return storage
+
+    def mkdirs(self, path):
+        parts = [i for i in path.split('/') if i]
+        current = '/' if path.startswith('/') else ''
+        for part in parts:
+            current = os.path.join(current, part)
+            if current in self.made_dirs:
+                continue
+            try:
+                self.client().mkdir(current)
+            except IOError:
+                pass
+            self.made_dirs.add(current)
+
+    def ensure(self):
+        if self.directory:
+            self.mkdirs(self.directory)
+
+    def open_writer(self, name):
+        self.mkdirs(os.path.dirname(self.path(name)))
+        return SFTPWriter(self, self.path(name))
+
+    def get_stream(self, name):
+        return connections.open_remote(self.connect(), self.path(name), 'rb')
+
+    def list(self, path=''):
+        return [StorageEntry(attr.filename, attr.st_size, attr.st_mtime, stat.S_ISDIR(attr.st_mode))
+                for attr in self.client().listdir_attr(self.path(path) or '.')
+                if not is_partial(attr.filename)]
+
+    def delete_batch(self, names):
+        # one remote command, it also removes rsync backup directories
+        if names:
+            self.connect().execute('rm -rf %s' % ' '.join(pipes.quote(self.path(i)) for i in names))
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+class S3Writer(object):
+    '''
+    multipart upload, sending parts from a thread pool while the next part
+    is being filled. Artifacts smaller than one part are sent in one request.
+    '''
+
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.buffer = []
+        self.buffered = 0
+        self.upload_id = None
+        self.part_number = 0
+        self.pending = deque()
+        self.parts = []
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.storage.part_size:
+            self.flush()
+
+    def flush(self):
+        s3 = self.storage.client
+        if self.upload_id is None:
+            self.upload_id = s3.create_multipart_upload(
+                Bucket=self.storage.bucket, Key=self.key)['UploadId']
+        self.part_number += 1
+        body = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.storage.pool.apply_async(self.upload_part, (self.part_number, body)))
+        while len(self.pending) > self.storage.workers:
+            self.parts.append(self.pending.popleft().get())
+
+    def upload_part(self, part_number, body):
+        response = self.storage.client.upload_part(
+            Bucket=self.storage.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=body)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def close(self):
+        if self.upload_id is None:
+            self.storage.client.put_object(Bucket=self.storage.bucket, Key=self.key,
+                                           Body=''.join(self.buffer))
+            return
+        try:
+            if self.buffered:
+                self.flush()
+            while self.pending:
+                self.parts.append(self.pending.popleft().get())
+        except:
+            self.abort()
+            raise
+        self.storage.client.complete_multipart_upload(
+            Bucket=self.storage.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': sorted(self.parts, key=lambda part: part['PartNumber'])})
+
+    def abort(self):
+        if self.upload_id is not None:
+            for result in self.pending:
+                result.wait()
+            self.storage.client.abort_multipart_upload(
+                Bucket=self.storage.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+
+class S3Reader(object):
+    '''
+    reads an object with parallel ranged GETs, keeping a bounded number of
+    ranges in flight ahead of the reader.
+    '''
+
+    def __init__(self, storage, key, size):
+        self.storage = storage
+        self.key = key
+        self.size = size
+        self.next_offset = 0
+        self.pending = deque()
+        self.buffer = ''
+        # read up to here, slicing the buffer on every read copies it
+        self.offset = 0
+        self.fill()
+
+    def fill(self):
+        while self.next_offset < self.size and len(self.pending) < self.storage.workers:
+            end = min(self.next_offset + self.storage.part_size, self.size)
+            self.pending.append(self.storage.pool.apply_async(
+                self.storage.get_range, (self.key, self.next_offset, end - self.next_offset)))
+            self.next_offset = end
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.offset >= len(self.buffer):
+                if not self.pending:
+                    break
+                self.buffer = self.pending.popleft().get()
+                self.offset = 0
+                self.fill()
+                continue
+            end = len(self.buffer) if size < 0 else min(len(self.buffer), self.offset + size)
+            parts.append(self.buffer[self.offset:end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+        return ''.join(parts)
+
+    def close(self):
+        self.pending.clear()
+        self.buffer = ''
+        self.offset = 0
+
+
+class S3Storage(BaseStorage):
+    '''
+    a prefix in an S3 compatible bucket (AWS, MinIO, moto...). Requires
+    boto3.
+    '''
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, access_key=None, secret_key=None,
+                 region=None, part_size=DEFAULT_PART_SIZE, workers=DEFAULT_WORKERS, **options):
+        BaseStorage.__init__(self, **options)
+        if boto3 is None:
+            raise StorageError('the boto3 package is required for S3 storage')
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.part_size = part_size
+        self.workers = workers
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region,
+                                   aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+        self._pool = None
+
+    def __str__(self):
+        return 's3:%s/%s' % (self.bucket, self.prefix)
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        return self._pool
+
+    def key(self, name):
+        return '/'.join(i for i in [self.prefix, name.strip('/')] if i)
+
+    def ensure(self):
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+        except Exception:
+            self.client.create_bucket(Bucket=self.bucket)
+
+    def open_writer(self, name):
+        return S3Writer(self, self.key(name))
+
+    def get_stream(self, name):
+        key = self.key(name)
+        size = self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+        return S3Reader(self, key, size)
+
+    def read_range(self, name, start, length):
+        return self.get_range(self.key(name), start, length)
+
+    def get_range(self, key, start, length):
+        if length <= 0:
+            return ''
+        response = self.client.get_object(Bucket=self.bucket, Key=key,
+                                          Range='bytes=%d-%d' % (start, start + length - 1))
+        return response['Body'].read()
+
+    def list(self, path=''):
+        prefix = self.key(path)
+        prefix = prefix + '/' if prefix else ''
+        entries = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            for obj in page.get('Contents', []):
+                entries.append(StorageEntry(obj['Key'][len(prefix):], obj['Size'],
+                                            epoch(obj['LastModified']), False))
+            for common in page.get('CommonPrefixes', []):
+                entries.append(StorageEntry(common['Prefix'][len(prefix):].rstrip('/'), 0, None, True))
+        return entries
+
+    def delete_batch(self, names):
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for name in names:
+            key = self.key(name)
+            keys.append(key)
+            # directories are prefixes, delete everything below them
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=key + '/'):
+                keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        for i in range(0, len(keys), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True})
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+BACKENDS = {
+    'local': LocalStorage,
+    'sftp': SFTPStorage,
+    's3': S3Storage,
+}
+
+
+def get_storage_class(backend):
+    if backend in BACKENDS:
+        return BACKENDS[backend]
+    module, _, name = backend.rpartition('.')
+    try:
+        return getattr(import_module(module), name)
+    except (ImportError, AttributeError, ValueError):
+        raise StorageError('unknown storage backend: %r' % backend)
+
+
+def get_storage(config):
+    '''
+    build a storage backend from a config dict with a 'backend' key.
+    '''
+    config = dict(config)
+    cls = get_storage_class(config.pop('backend'))
+    try:
+        return cls(**config)
+    except TypeError, e:
+        raise StorageError('invalid %s storage settings: %s' % (cls.__name__, e))
+
+
+def get_default_storage(settings, directory=None):
+    '''
+    the storage configured in BACKUP_STORAGE, or SFTP storage on
+    BACKUP_FTP_SERVER. directory overrides BACKUP_FTP_DIRECTORY.
+    '''
+    config = getattr(settings, 'BACKUP_STORAGE', None)
+    if config is None:
+        if directory is None:
+            directory = getattr(settings, 'BACKUP_FTP_DIRECTORY', '') or ''
+        config = {
+            'backend': 'sftp',
+            'server': getattr(settings, 'BACKUP_FTP_SERVER', ''),
+            'username': getattr(settings, 'BACKUP_FTP_USERNAME', ''),
+            'password': getattr(settings, 'BACKUP_FTP_PASSWORD', ''),
+            'directory': directory,
+        }
+    return get_storage(config)
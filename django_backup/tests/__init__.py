@@ -0,0 +1,16 @@
+# imported here so ``manage.py test django_backup`` finds them too
+from django_backup.tests.test_adaptive import *
+from django_backup.tests.test_archive import *
+from django_backup.tests.test_backupd import *
+from django_backup.tests.test_cas import *
+from django_backup.tests.test_crypto import *
+from django_backup.tests.test_delta import *
+from django_backup.tests.test_drill import *
+from django_backup.tests.test_fanout import *
+from django_backup.tests.test_fastload import *
+from django_backup.tests.test_incremental import *
+from django_backup.tests.test_plan import *
+from django_backup.tests.test_report import *
+from django_backup.tests.test_schedule import *
+from django_backup.tests.test_snapshots import *
+from django_backup.tests.test_storage import *
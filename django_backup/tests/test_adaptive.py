@@ -0,0 +1,133 @@
+import Queue
+import gzip
+import random
+import unittest
+from cStringIO import StringIO
+
+from django_backup import adaptive
+from django_backup import plan
+
+
+def sample_data(size):
+    # compressible but not trivially so, like a dump
+    rng = random.Random(42)
+    words = ['INSERT', 'INTO', 'VALUES', 'NULL', "'example'", '(', ')', ',', '1024', 'user_%d']
+    out = []
+    total = 0
+    while total < size:
+        word = rng.choice(words)
+        if '%d' in word:
+            word = word % rng.randint(0, 100000)
+        out.append(word)
+        total += len(word) + 1
+    return ' '.join(out)[:size]
+
+
+class FakeWriter(object):
+
+    def __init__(self, rate=None, backlog=0):
+        self.rate = rate
+        self.queue = Queue.Queue()
+        for i in range(backlog):
+            self.queue.put('block')
+
+
+class FailingSink(object):
+
+    def write(self, data):
+        raise IOError('disk full')
+
+
+class LevelTest(unittest.TestCase):
+
+    def compressor(self, **options):
+        compressor = adaptive.AdaptiveCompressor([], buffer=4, **options)
+        # level 6 compresses 20MB/s to 30%, 7 10MB/s to 20% and 5 40MB/s to 40%
+        compressor.speed = {5: 40e6, 6: 20e6, 7: 10e6}
+        compressor.ratio = {5: 0.4, 6: 0.3, 7: 0.2}
+        return compressor
+
+    def test_predict_is_bounded_by_the_writer(self):
+        compressor = self.compressor()
+        self.assertEqual(compressor.predict(6, None), 20e6)
+        self.assertAlmostEqual(compressor.predict(6, 3e6), 10e6)
+        self.assertEqual(compressor.predict(8, 3e6), None)
+
+    def test_full_queue_raises_the_level(self):
+        compressor = self.compressor()
+        self.assertEqual(compressor.next_level(FakeWriter(rate=1e6, backlog=3)), 7)
+
+    def test_empty_queue_lowers_the_level(self):
+        compressor = self.compressor()
+        self.assertEqual(compressor.next_level(FakeWriter(rate=100e6)), 5)
+
+    def test_untried_level_is_tried(self):
+        compressor = self.compressor()
+        compressor.level = 7
+        self.assertEqual(compressor.next_level(FakeWriter(rate=1e6, backlog=3)), 8)
+
+    def test_bounds(self):
+        compressor = self.compressor(min_level=6, max_level=6)
+        self.assertEqual(compressor.next_level(FakeWriter(rate=1e6, backlog=3)), 6)
+        self.assertEqual(compressor.next_level(FakeWriter(rate=100e6)), 6)
+
+    def test_slow_later_upload_raises_the_level(self):
+        # the local file is written fast, the upload afterwards is slow
+        compressor = self.compressor(upload_rate=1e6)
+        self.assertTrue(compressor.predict(7, 100e6) > compressor.predict(6, 100e6))
+        self.assertEqual(compressor.next_level(FakeWriter(rate=100e6)), 7)
+
+    def test_fast_later_upload_lowers_the_level(self):
+        compressor = self.compressor(upload_rate=1e9)
+        self.assertEqual(compressor.next_level(FakeWriter(rate=100e6)), 5)
+
+
+class CompressTest(unittest.TestCase):
+
+    def test_output_is_one_gzip_stream(self):
+        data = sample_data(300 * 1024)
+        out = StringIO()
+        compressor = adaptive.AdaptiveCompressor([out], block_size=16 * 1024)
+        stats = compressor.run(StringIO(data))
+        self.assertEqual(stats['bytes_in'], len(data))
+        self.assertEqual(stats['bytes_out'], len(out.getvalue()))
+        self.assertEqual(sum(stats['levels'].values()), 19)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(out.getvalue())).read(), data)
+
+    def test_every_sink_gets_the_same_bytes(self):
+        data = sample_data(100 * 1024)
+        first, second = StringIO(), StringIO()
+        adaptive.AdaptiveCompressor([first, second], block_size=8 * 1024).run(StringIO(data))
+        self.assertEqual(first.getvalue(), second.getvalue())
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(second.getvalue())).read(), data)
+
+    def test_empty_input_is_valid_gzip(self):
+        out = StringIO()
+        adaptive.AdaptiveCompressor([out]).run(StringIO(''))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(out.getvalue())).read(), '')
+
+    def test_writer_error_is_raised(self):
+        compressor = adaptive.AdaptiveCompressor([FailingSink()], block_size=1024)
+        self.assertRaises(IOError, compressor.run, StringIO(sample_data(10 * 1024)))
+
+    def test_timed_writer(self):
+        out = StringIO()
+        writer = adaptive.TimedWriter(out)
+        writer.write('abc')
+        writer.write('de')
+        self.assertEqual(writer.bytes, 5)
+        self.assertEqual(out.getvalue(), 'abcde')
+
+
+class UploadRateTest(unittest.TestCase):
+
+    def test_measured_sending_time_wins(self):
+        runs = [{'stages': {'upload': {'bytes': 100, 'seconds': 10.0, 'sent_bytes': 100, 'send_seconds': 4.0}}},
+                {'stages': {'upload': {'bytes': 100, 'seconds': 10.0, 'sent_bytes': 100, 'send_seconds': 5.0}}},
+                {'stages': {'upload': {'bytes': 100, 'seconds': 10.0, 'sent_bytes': 100, 'send_seconds': 5.0}}}]
+        self.assertEqual(plan.upload_rate(runs), 20.0)
+
+    def test_older_runs_use_the_stage_time(self):
+        runs = [{'stages': {'upload': {'bytes': 100, 'seconds': 10.0}}}]
+        self.assertEqual(plan.upload_rate(runs), 10.0)
+        self.assertEqual(plan.upload_rate([]), None)
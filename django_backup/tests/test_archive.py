@@ -0,0 +1,109 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from django_backup import archive
+
+
+def write(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    f = open(path, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+class FailingScanner(archive.DirectoryScanner):
+
+    def __init__(self, failing, *args, **kwargs):
+        super(FailingScanner, self).__init__(*args, **kwargs)
+        self.failing = failing
+
+    def list_directory(self, path, prefix):
+        if path == self.failing:
+            raise OSError(13, 'Permission denied')
+        return super(FailingScanner, self).list_directory(path, prefix)
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.media = os.path.join(self.root, 'media')
+        self.static = os.path.join(self.root, 'static')
+        write(os.path.join(self.media, 'a b.txt'), 'spaces')
+        write(os.path.join(self.media, 'caf\xc3\xa9', 'menu.txt'), 'utf-8 name')
+        write(os.path.join(self.media, 'empty'), '')
+        write(os.path.join(self.media, 'big.bin'), os.urandom(archive.PREFETCH_FILE_SIZE + 1000))
+        write(os.path.join(self.static, 'uploads', 'logo.png'), 'png')
+        os.makedirs(os.path.join(self.media, 'uploads'))
+        write(os.path.join(self.media, 'uploads', 'photo.jpg'), 'jpg')
+        os.symlink('a b.txt', os.path.join(self.media, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def archive(self, entries):
+        out = StringIO()
+        archiver = archive.Archiver(out, workers=2, prefetch_bytes=1024)
+        stats = archiver.write(entries)
+        out.seek(0)
+        return stats, tarfile.open(fileobj=out, mode='r|')
+
+    def test_round_trip(self):
+        entries = archive.DirectoryScanner(workers=3).scan([self.media, self.static])
+        stats, tar = self.archive(entries)
+        contents = {}
+        for info in tar:
+            if info.isreg():
+                contents[info.name] = tar.extractfile(info).read()
+            elif info.issym():
+                contents[info.name] = ('link', info.linkname)
+            else:
+                contents[info.name] = ('dir',)
+        self.assertEqual(contents['a b.txt'], 'spaces')
+        self.assertEqual(contents['caf\xc3\xa9/menu.txt'], 'utf-8 name')
+        self.assertEqual(contents['empty'], '')
+        self.assertEqual(len(contents['big.bin']), archive.PREFETCH_FILE_SIZE + 1000)
+        self.assertEqual(contents['link'], ('link', 'a b.txt'))
+        self.assertEqual(contents['uploads'], ('dir',))
+        self.assertEqual(contents['uploads/photo.jpg'], 'jpg')
+        self.assertEqual(contents['uploads/logo.png'], 'png')
+        self.assertEqual(stats['files'], 6)
+        self.assertEqual(stats['links'], 1)
+        self.assertEqual(stats['directories'], 2)
+
+    def test_duplicate_names_fail(self):
+        write(os.path.join(self.static, 'a b.txt'), 'other')
+        scanner = archive.DirectoryScanner()
+        self.assertRaises(archive.ArchiveError, scanner.scan, [self.media, self.static])
+
+    def test_file_and_directory_with_the_same_name_fail(self):
+        write(os.path.join(self.static, 'caf\xc3\xa9'), 'a file')
+        scanner = archive.DirectoryScanner()
+        self.assertRaises(archive.ArchiveError, scanner.scan, [self.media, self.static])
+
+    def test_missing_directory_fails(self):
+        scanner = archive.DirectoryScanner()
+        self.assertRaises(archive.ArchiveError, scanner.scan, [self.media, os.path.join(self.root, 'missing')])
+        write(os.path.join(self.root, 'file'), '')
+        self.assertRaises(archive.ArchiveError, scanner.scan, [os.path.join(self.root, 'file')])
+
+    def test_unreadable_subdirectory_is_reported(self):
+        scanner = FailingScanner(os.path.join(self.media, 'uploads'))
+        entries = scanner.scan([self.media])
+        names = [entry.arcname for entry in entries]
+        self.assertIn('uploads', names)
+        self.assertNotIn('uploads/photo.jpg', names)
+        self.assertEqual(len(scanner.errors), 1)
+        self.assertTrue(scanner.errors[0].startswith(os.path.join(self.media, 'uploads')))
+
+    def test_unreadable_root_fails(self):
+        scanner = FailingScanner(self.static)
+        self.assertRaises(archive.ArchiveError, scanner.scan, [self.media, self.static])
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from collections import deque
+from datetime import datetime
+
+try:
+    from django_backup.management.commands import backupd
+except ImportError:
+    # needs Django, run with manage.py test
+    backupd = None
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.closed = 0
+
+    def close(self):
+        self.closed += 1
+
+
+@unittest.skipIf(backupd is None, 'Django is not installed')
+class WorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backup_dir = tempfile.mkdtemp()
+        self.connection = FakeConnection()
+        self.calls = []
+        self.saved = backupd.call_command, backupd.connection
+        backupd.call_command = self.call_command
+        backupd.connection = self.connection
+
+    def tearDown(self):
+        backupd.call_command, backupd.connection = self.saved
+        shutil.rmtree(self.backup_dir)
+
+    def call_command(self, name, **options):
+        self.calls.append(options['job'])
+        if options['job'] == 'failing':
+            # what Django 1.4 does with the CommandError of a command
+            raise SystemExit(1)
+        if options['job'] == 'broken':
+            raise ValueError('broken')
+
+    def make_daemon(self, names):
+        command = backupd.Command()
+        command.backup_dir = self.backup_dir
+        command.status_file = os.path.join(self.backup_dir, 'backupd.status')
+        command.started = datetime.now()
+        command.jobs = dict((name, backupd.Job(name, {'schedule': '0 0 * * *', 'options': {'job': name}},
+                                               command.started)) for name in names)
+        command.lock = threading.RLock()
+        command.status_lock = threading.Lock()
+        command.wakeup = threading.Condition(command.lock)
+        command.queue = deque()
+        command.stopping = False
+        return command
+
+    def run_jobs(self, command, names):
+        worker = threading.Thread(target=command.worker)
+        worker.daemon = True
+        worker.start()
+        with command.lock:
+            for name in names:
+                command.jobs[name].state = 'queued'
+                command.queue.append(command.jobs[name])
+            command.wakeup.notify_all()
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            with command.lock:
+                if not command.queue and all(job.state == 'idle' for job in command.jobs.values()):
+                    break
+            time.sleep(0.01)
+        with command.lock:
+            command.stopping = True
+            command.wakeup.notify_all()
+        worker.join(10)
+        return worker
+
+    def test_failed_job_keeps_the_worker_alive(self):
+        command = self.make_daemon(['failing', 'broken', 'ok'])
+        self.run_jobs(command, ['failing', 'broken', 'ok'])
+        self.assertEqual(self.calls, ['failing', 'broken', 'ok'])
+        failing, broken, ok = [command.jobs[name] for name in ('failing', 'broken', 'ok')]
+        self.assertEqual(failing.state, 'idle')
+        self.assertEqual(failing.failures, 1)
+        self.assertTrue(failing.last_result.startswith('error'))
+        self.assertEqual(broken.last_result, 'error: broken')
+        self.assertEqual(ok.failures, 0)
+        self.assertEqual(ok.last_result, 'ok')
+        self.assertEqual(self.connection.closed, 3)
+
+    def test_failed_job_runs_again(self):
+        command = self.make_daemon(['failing'])
+        self.run_jobs(command, ['failing'])
+        command.stopping = False
+        self.run_jobs(command, ['failing'])
+        self.assertEqual(self.calls, ['failing', 'failing'])
+        self.assertEqual(command.jobs['failing'].runs, 2)
+        self.assertEqual(command.jobs['failing'].failures, 2)
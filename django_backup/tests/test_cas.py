@@ -0,0 +1,202 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from django_backup import cas
+from django_backup.storage import LocalStorage
+
+
+class ThreadCheckingStorage(LocalStorage):
+    '''
+    a local storage that fails if a worker copy is used from two threads,
+    like an SFTP session would.
+    '''
+
+    def __init__(self, directory, **options):
+        LocalStorage.__init__(self, directory, **options)
+        self.workers = []
+        self.owner = None
+        self.closed = False
+
+    def for_worker(self, index):
+        storage = ThreadCheckingStorage(self.directory)
+        self.workers.append(storage)
+        return storage
+
+    def check(self):
+        if self.owner is None:
+            self.owner = threading.current_thread()
+        assert self.owner is threading.current_thread()
+
+    def open_writer(self, name):
+        self.check()
+        return LocalStorage.open_writer(self, name)
+
+    def get_stream(self, name):
+        self.check()
+        return LocalStorage.get_stream(self, name)
+
+    def close(self):
+        self.closed = True
+
+
+class ContentStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.media = self.path('site', 'media')
+        self.static = self.path('site', 'static')
+        self.write(self.media, 'a.txt', 'alpha')
+        self.write(self.media, 'sub/b.txt', 'beta')
+        self.write(self.media, 'sub/copy.txt', 'alpha')
+        self.write(self.static, 'a.txt', 'static alpha')
+        self.cache = cas.HashCache(self.path('cache'))
+        self.storage = LocalStorage(self.path('storage'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def write(self, root, name, content):
+        path = os.path.join(root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def read_tree(self, root):
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                files[os.path.relpath(path, root)] = open(path, 'rb').read()
+        return files
+
+    def backup(self, directories, name='dir_1.cas', storage=None):
+        entries = cas.scan(directories, self.cache, 2)
+        store = cas.ContentStore(storage or self.storage, 2)
+        return store.backup(entries, name, cas.root_names(directories))
+
+    def test_manifest_round_trip(self):
+        entries = [('ab' * 32, 5, 0644, 1000, u'dir/caf\xe9 with spaces.txt', '/abs'),
+                   ('cd' * 32, 0, 0600, 0, u'new\nline', '/abs2')]
+        self.assertEqual(cas.parse_manifest(cas.write_manifest(entries)),
+                         (None, [entry[:5] for entry in entries]))
+        self.assertEqual(cas.parse_manifest(cas.write_manifest(entries, ['media', 'static']))[0],
+                         ['media', 'static'])
+
+    def test_backup_and_restore(self):
+        self.assertEqual(self.backup([self.media]), (2, 9))
+        target = self.path('restored')
+        total, restored = cas.ContentStore(self.storage, 2).restore('dir_1.cas', target)
+        self.assertEqual((total, restored), (3, 3))
+        self.assertEqual(self.read_tree(target), self.read_tree(self.media))
+        # unchanged files are left alone
+        self.assertEqual(cas.ContentStore(self.storage, 2).restore('dir_1.cas', target), (3, 0))
+
+    def test_unchanged_files_are_not_uploaded_again(self):
+        self.backup([self.media])
+        self.write(self.media, 'c.txt', 'gamma')
+        self.assertEqual(self.backup([self.media], 'dir_2.cas'), (1, 5))
+
+    def test_lost_blob_is_uploaded_again(self):
+        self.backup([self.media])
+        entry = [e for e in cas.ContentStore(self.storage).read_manifest('dir_1.cas') if e[4] == 'a.txt'][0]
+        os.remove(self.storage.path(cas.blob_name(entry[0])))
+        self.assertEqual(self.backup([self.media], 'dir_2.cas'), (1, 5))
+
+    def test_several_directories_are_namespaced(self):
+        self.backup([self.media, self.static])
+        store = cas.ContentStore(self.storage, 2)
+        roots, entries = store.load_manifest('dir_1.cas')
+        self.assertEqual(roots, ['media', 'static'])
+        self.assertEqual(sorted(entry[4] for entry in entries),
+                         ['media/a.txt', 'media/sub/b.txt', 'media/sub/copy.txt', 'static/a.txt'])
+        target = self.path('restored')
+        self.assertEqual(store.restore('dir_1.cas', target, 'media'), (3, 3))
+        self.assertEqual(self.read_tree(target), self.read_tree(self.media))
+        self.assertRaises(cas.CASError, store.restore, 'dir_1.cas', target, 'uploads')
+
+    def test_directories_with_the_same_name(self):
+        other = self.path('other', 'media')
+        self.write(other, 'a.txt', 'other alpha')
+        self.assertRaises(cas.CASError, cas.root_names, [self.media, other])
+
+    def test_workers_get_their_own_storage(self):
+        storage = ThreadCheckingStorage(self.path('storage'))
+        for i in range(50):
+            self.write(self.media, 'many/%d.txt' % i, 'file %d' % i)
+        self.backup([self.media], storage=storage)
+        self.assertTrue(storage.workers)
+        self.assertTrue(all(worker.closed for worker in storage.workers))
+        storage = ThreadCheckingStorage(self.path('storage'))
+        cas.ContentStore(storage, 4).restore('dir_1.cas', self.path('restored'))
+        self.assertEqual(self.read_tree(self.path('restored')), self.read_tree(self.media))
+
+    def test_collect_garbage(self):
+        self.backup([self.media])
+        os.remove(os.path.join(self.media, 'sub/b.txt'))
+        self.backup([self.media], 'dir_2.cas')
+        os.remove(self.storage.path('dir_1.cas'))
+        self.assertEqual(cas.ContentStore(self.storage).collect_garbage(), 1)
+        self.assertEqual(cas.ContentStore(self.storage).restore('dir_2.cas', self.path('restored')), (2, 2))
+
+
+
+class FakeStat(object):
+
+    def __init__(self, dev, ino, size=5, mtime=1000.0):
+        self.st_dev, self.st_ino, self.st_size, self.st_mtime = dev, ino, size, mtime
+
+
+class HashCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.directory, 'cache')
+        for name in ('media', 'static'):
+            os.makedirs(os.path.join(self.directory, name))
+            for i in range(2):
+                with open(os.path.join(self.directory, name, '%d.txt' % i), 'wb') as f:
+                    f.write('%s %d' % (name, i))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_job(self, name):
+        cache = cas.HashCache(self.cache_file)
+        cas.scan([os.path.join(self.directory, name)], cache, 2)
+        cache.save()
+
+    def cached(self):
+        return sorted(os.path.relpath(path, self.directory) for path in cas.HashCache(self.cache_file).entries)
+
+    def test_inodes_of_other_filesystems_dont_match(self):
+        cache = cas.HashCache(self.cache_file)
+        cache.set('/mnt/a/file', FakeStat(1, 42), 'ab' * 32)
+        cache.save()
+        cache = cas.HashCache(self.cache_file)
+        self.assertEqual(cache.get('/mnt/a/moved', FakeStat(1, 42)), 'ab' * 32)
+        self.assertEqual(cache.get('/mnt/b/file', FakeStat(2, 42)), None)
+        self.assertEqual(cache.get('/mnt/a/file', FakeStat(1, 42, mtime=1001.0)), None)
+
+    def test_jobs_sharing_the_cache_keep_their_entries(self):
+        self.run_job('media')
+        self.run_job('static')
+        self.assertEqual(self.cached(), ['media/0.txt', 'media/1.txt', 'static/0.txt', 'static/1.txt'])
+        os.remove(os.path.join(self.directory, 'media', '1.txt'))
+        self.run_job('media')
+        self.assertEqual(self.cached(), ['media/0.txt', 'static/0.txt', 'static/1.txt'])
+
+    def test_old_cache_is_ignored(self):
+        with open(self.cache_file, 'wb') as f:
+            cas.pickle.dump({'/media/a': (5, 1000.0, 42, 'ab' * 32)}, f)
+        self.assertEqual(cas.HashCache(self.cache_file).entries, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import unittest
+from cStringIO import StringIO
+
+from django_backup import crypto
+
+
+class EncryptStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        if crypto.AESGCM is None:
+            self.skipTest('the cryptography package is not installed')
+        self.key = os.urandom(crypto.KEY_SIZE)
+
+    def encrypt(self, data, **kwargs):
+        out = StringIO()
+        self.assertEqual(crypto.encrypt_stream(StringIO(data), out, self.key, **kwargs), len(data))
+        return out.getvalue()
+
+    def decrypt(self, data, key=None):
+        out = StringIO()
+        crypto.decrypt_stream(StringIO(data), out, key or self.key)
+        return out.getvalue()
+
+    def test_round_trip(self):
+        for size in (0, 1, 100, 4096, 4097, 3 * 4096):
+            data = os.urandom(size)
+            self.assertEqual(self.decrypt(self.encrypt(data, chunk_size=4096)), data)
+
+    def test_files_use_their_own_key(self):
+        data = 'x' * 10000
+        first = self.encrypt(data, chunk_size=4096)
+        second = self.encrypt(data, chunk_size=4096)
+        self.assertNotEqual(first[8:crypto.HEADER.size], second[8:crypto.HEADER.size])
+        # same plaintext and chunk index, different ciphertext
+        self.assertNotEqual(first[crypto.HEADER.size:], second[crypto.HEADER.size:])
+
+    def test_wrong_key(self):
+        data = self.encrypt('secret')
+        self.assertRaises(crypto.EncryptionError, self.decrypt, data, os.urandom(crypto.KEY_SIZE))
+
+    def test_truncated(self):
+        data = self.encrypt('x' * 10000, chunk_size=4096)
+        frame = crypto.FRAME.size + 4096 + 16
+        self.assertRaises(crypto.EncryptionError, self.decrypt, data[:crypto.HEADER.size + frame])
+        self.assertRaises(crypto.EncryptionError, self.decrypt, data[:-1])
+        self.assertRaises(crypto.EncryptionError, self.decrypt, data[:4])
+
+    def test_reordered_frames(self):
+        data = self.encrypt('a' * 4096 + 'b' * 4096 + 'c', chunk_size=4096)
+        header, body = data[:crypto.HEADER.size], data[crypto.HEADER.size:]
+        frame = crypto.FRAME.size + 4096 + 16
+        swapped = header + body[frame:2 * frame] + body[:frame] + body[2 * frame:]
+        self.assertRaises(crypto.EncryptionError, self.decrypt, swapped)
+
+    def test_frame_from_another_file(self):
+        first = self.encrypt('a' * 5000, chunk_size=4096)
+        second = self.encrypt('b' * 5000, chunk_size=4096)
+        mixed = first[:crypto.HEADER.size] + second[crypto.HEADER.size:]
+        self.assertRaises(crypto.EncryptionError, self.decrypt, mixed)
+
+    def test_trailing_data(self):
+        data = self.encrypt('x' * 5000, chunk_size=4096)
+        self.assertRaises(crypto.EncryptionError, self.decrypt, data + 'x')
+        self.assertRaises(crypto.EncryptionError, self.decrypt, data + data)
+
+    def test_not_encrypted(self):
+        self.assertRaises(crypto.EncryptionError, self.decrypt, 'plain text, not a backup header')
+
+
+class DecodeKeyTest(unittest.TestCase):
+
+    def test_encodings(self):
+        key = os.urandom(crypto.KEY_SIZE)
+        self.assertEqual(crypto.decode_key('raw:' + key), key)
+        self.assertEqual(crypto.decode_key(key.encode('hex')), key)
+        self.assertEqual(crypto.decode_key(key.encode('hex').upper() + '\n'), key)
+        self.assertEqual(crypto.decode_key(key.encode('base64')), key)
+        self.assertRaises(crypto.EncryptionError, crypto.decode_key, 'too short')
+        self.assertRaises(crypto.EncryptionError, crypto.decode_key, 'raw:' + key[:-1])
+
+    def test_passphrase_is_not_a_key(self):
+        self.assertRaises(crypto.EncryptionError, crypto.decode_key, 'correct horse battery staple 32!')
+
+
+if __name__ == '__main__':
+    unittest.main()
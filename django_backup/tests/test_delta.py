@@ -0,0 +1,90 @@
+import os
+import random
+import unittest
+from cStringIO import StringIO
+
+from django_backup import delta
+
+BLOCK_SIZE = 1024
+
+
+def signature(data, block_size=BLOCK_SIZE):
+    out = StringIO()
+    delta.write_signature(StringIO(data), out, block_size)
+    out.seek(0)
+    return delta.read_signature(out)
+
+
+class DeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(0)
+        self.base = os.urandom(64 * BLOCK_SIZE + 100)
+
+    def make_delta(self, data, base=None, **kwargs):
+        out = StringIO()
+        writer = delta.write_delta(StringIO(data), signature(base or self.base), 'backup_1.gz', out, **kwargs)
+        return writer, out.getvalue()
+
+    def apply(self, patch, base=None):
+        out = StringIO()
+        delta.apply_delta(StringIO(base or self.base), StringIO(patch), out)
+        return out.getvalue()
+
+    def assertRoundTrip(self, data, base=None):
+        writer, patch = self.make_delta(data, base)
+        self.assertEqual(self.apply(patch, base), data)
+        return writer
+
+    def test_identical(self):
+        writer = self.assertRoundTrip(self.base)
+        self.assertEqual(writer.literal_bytes, 100)
+
+    def test_edits(self):
+        data = bytearray(self.base)
+        for i in range(5):
+            p = self.random.randrange(len(data) - 10)
+            data[p:p + 10] = os.urandom(10)
+        data = str(data[:5000]) + 'inserted' + str(data[5000:9000]) + str(data[9500:])
+        writer = self.assertRoundTrip(data)
+        self.assertTrue(writer.literal_bytes < 12 * BLOCK_SIZE)
+
+    def test_unrelated_and_empty(self):
+        self.assertRoundTrip(os.urandom(10 * BLOCK_SIZE))
+        self.assertRoundTrip('')
+        self.assertRoundTrip('short')
+        self.assertRoundTrip(self.base, base='x')
+
+    def test_across_reads(self):
+        # matches straddling the READ_SIZE refill of the rolling window
+        base = os.urandom(delta.READ_SIZE + 10 * BLOCK_SIZE)
+        data = os.urandom(delta.READ_SIZE - 100) + base[delta.READ_SIZE - 5 * BLOCK_SIZE:]
+        writer = self.assertRoundTrip(data, base)
+        self.assertTrue(writer.copied_bytes >= 14 * BLOCK_SIZE)
+
+    def test_stops_at_max_literal(self):
+        data = os.urandom(delta.READ_SIZE * 3)
+        stream = StringIO(data)
+        self.assertRaises(delta.DeltaTooLarge, delta.write_delta, stream, signature(self.base),
+                          'backup_1.gz', StringIO(), delta.READ_SIZE / 2)
+        # gave up without reading the whole dump
+        self.assertTrue(stream.tell() < len(data))
+        writer, patch = self.make_delta(self.base, max_literal=1000)
+        self.assertEqual(self.apply(patch), self.base)
+        self.assertRaises(delta.DeltaTooLarge, self.make_delta, self.base, max_literal=10)
+
+    def test_corrupt_base(self):
+        writer, patch = self.make_delta(self.base[:5000] + 'x' + self.base[5000:])
+        base = bytearray(self.base)
+        base[100] ^= 1
+        self.assertRaises(delta.DeltaError, self.apply, patch, str(base))
+        self.assertRaises(delta.DeltaError, self.apply, patch[:-5])
+
+    def test_header(self):
+        writer, patch = self.make_delta(self.base)
+        self.assertEqual(delta.read_delta_header(StringIO(patch)), (BLOCK_SIZE, 'backup_1.gz'))
+        self.assertRaises(delta.DeltaError, delta.read_delta_header, StringIO('x' * 20))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from django_backup import drill, incremental
+from django_backup.db import MYSQL
+from django_backup.tests.test_incremental import FakeClient
+
+
+class ChecksClient(FakeClient):
+    '''
+    a MySQL database with tables app_a and app_b, app_b written a second ago.
+    '''
+
+    def __init__(self, update_time, **kwargs):
+        super(ChecksClient, self).__init__(MYSQL, [], **kwargs)
+        self.update_time = update_time
+
+    def query(self, sql):
+        if sql == drill.MYSQL_COLUMNS:
+            return [['app_a', 'id'], ['app_b', 'id']]
+        if sql.startswith('SELECT COUNT(*)'):
+            return [[3, 1234]]
+        if sql.endswith(incremental.MYSQL_SIGNALS):
+            return [['app_a', '2026-01-01', self.update_time, '3600', 'c'],
+                    ['app_b', '2026-01-01', '2026-01-02', '1', 'c']]
+        return super(ChecksClient, self).query(sql)
+
+
+class DrillMediaRootTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.media = os.path.join(self.root, 'media')
+        os.makedirs(self.media)
+        open(os.path.join(self.media, 'keep.txt'), 'wb').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_refuses_overlapping_media_root(self):
+        for drill_root in (self.media, os.path.join(self.media, 'sub'), self.media + '/../media/.'):
+            self.assertRaises(drill.DrillError, drill.prepare_media_root, drill_root, self.media)
+        self.assertTrue(os.path.exists(os.path.join(self.media, 'keep.txt')))
+
+    def test_refuses_media_root_through_symlink(self):
+        link = os.path.join(self.root, 'link')
+        os.symlink(self.media, link)
+        self.assertRaises(drill.DrillError, drill.prepare_media_root, link, self.media)
+
+    def test_media_root_inside_drill_directory(self):
+        drill_root = os.path.join(self.root, 'drills')
+        media = os.path.join(drill_root, drill.DRILL_MEDIA_DIRNAME, 'media')
+        self.assertRaises(drill.DrillError, drill.prepare_media_root, drill_root, media)
+
+    def test_sibling_with_common_prefix_is_allowed(self):
+        path = drill.prepare_media_root(self.media + '_drills', self.media)
+        self.assertEqual(os.listdir(path), [drill.DRILL_MEDIA_MARKER])
+
+    def test_only_empties_marked_directory(self):
+        drill_root = os.path.join(self.root, 'drills')
+        path = drill.prepare_media_root(drill_root, self.media)
+        open(os.path.join(path, 'restored.txt'), 'wb').close()
+        self.assertEqual(drill.prepare_media_root(drill_root, self.media), path)
+        self.assertEqual(os.listdir(path), [drill.DRILL_MEDIA_MARKER])
+
+        os.unlink(os.path.join(path, drill.DRILL_MEDIA_MARKER))
+        open(os.path.join(path, 'precious.txt'), 'wb').close()
+        self.assertRaises(drill.DrillError, drill.prepare_media_root, drill_root, self.media)
+        self.assertTrue(os.path.exists(os.path.join(path, 'precious.txt')))
+
+
+class CompareTest(unittest.TestCase):
+
+    def test_changed_tables_are_not_compared(self):
+        recorded = {'tables': {'a': [1, 10], 'b': [2, 20], 'c': [3, 30]}, 'changed': ['c']}
+        self.assertEqual(drill.compared_tables(recorded), ['a', 'b'])
+        self.assertEqual(drill.compare(recorded, {'a': [1, 10], 'b': [2, 21], 'c': [0, 0]}),
+                         {'b': ([2, 20], [2, 21])})
+        self.assertEqual(drill.compare(recorded, {'a': [1, 10]}), {'b': ([2, 20], None)})
+
+    def test_tables_without_signal_are_not_compared(self):
+        recorded = drill.record_checks(ChecksClient('2026-01-01'), {'app_a': None, 'app_b': None},
+                                       checksum=False)
+        self.assertEqual(recorded['tables'], {'app_a': [3, 1234], 'app_b': [3, 1234]})
+        self.assertEqual(drill.compared_tables(recorded), [])
+
+    def test_tables_with_signal_are_compared(self):
+        client = ChecksClient('2026-01-01')
+        before = incremental.table_signals(client, checksum=False)
+        recorded = drill.record_checks(client, before, checksum=False)
+        # app_b was written too recently to trust its UPDATE_TIME
+        self.assertEqual(recorded['changed'], ['app_b'])
+        self.assertEqual(drill.compared_tables(recorded), ['app_a'])
+        # no UPDATE_TIME and no checksum: nothing left to compare
+        client = ChecksClient('NULL')
+        recorded = drill.record_checks(client, incremental.table_signals(client, checksum=False),
+                                       checksum=False)
+        self.assertEqual(drill.compared_tables(recorded), [])
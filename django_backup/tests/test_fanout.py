@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    from django_backup import fanout
+except ImportError:
+    # needs Django, run with manage.py test
+    fanout = None
+
+CHUNK_SIZE = 1024
+Destination = fanout.Destination if fanout is not None else object
+
+
+class MemoryWriter(object):
+
+    def __init__(self, destination, filename):
+        self.destination = destination
+        self.filename = filename
+        self.chunks = []
+
+    def write(self, data):
+        self.destination.before_write(self)
+        self.chunks.append(data)
+
+    def close(self):
+        self.destination.files[self.filename] = ''.join(self.chunks)
+
+    def abort(self):
+        self.destination.aborted.append(self.filename)
+
+
+class MemoryDestination(Destination):
+    '''
+    keeps what it is sent. The first fail_writes attempts fail, and every
+    write waits for the gate Event when there is one.
+    '''
+
+    def __init__(self, name, fail_writes=0, gate=None):
+        Destination.__init__(self, {'type': 'memory', 'name': name, 'retries': 2})
+        self.files = {}
+        self.aborted = []
+        self.attempts = 0
+        self.fail_writes = fail_writes
+        self.gate = gate
+
+    def open(self, filename):
+        self.attempts += 1
+        return MemoryWriter(self, filename)
+
+    def before_write(self, writer):
+        if self.gate is not None:
+            self.gate.wait()
+        if self.attempts <= self.fail_writes:
+            raise IOError('%s is down' % self.name)
+
+
+@unittest.skipIf(fanout is None, 'Django is not installed')
+class FanOutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'backup_1.gz')
+        self.data = os.urandom(CHUNK_SIZE * 40 + 10)
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_every_destination_gets_the_file(self):
+        destinations = [MemoryDestination('a'), MemoryDestination('b')]
+        self.assertEqual(fanout.tee_file(self.path, destinations, CHUNK_SIZE, 4), {})
+        for destination in destinations:
+            self.assertEqual(destination.files, {'backup_1.gz': self.data})
+            self.assertEqual(destination.bytes, len(self.data))
+
+    def test_failed_destination_doesnt_stop_the_others(self):
+        down, up = MemoryDestination('down', fail_writes=100), MemoryDestination('up')
+        failed = fanout.tee_file(self.path, [down, up], CHUNK_SIZE, 4)
+        self.assertEqual(failed.keys(), [down])
+        self.assertEqual(down.aborted, ['backup_1.gz'])
+        self.assertEqual(down.files, {})
+        self.assertEqual(up.files, {'backup_1.gz': self.data})
+
+    def test_retry(self):
+        flaky, down = MemoryDestination('flaky', fail_writes=1), MemoryDestination('down', fail_writes=100)
+        fanout.fan_out([self.path], [flaky, down], CHUNK_SIZE, 4)
+        self.assertEqual(flaky.files, {'backup_1.gz': self.data})
+        self.assertEqual((flaky.sent, flaky.failed), (['backup_1.gz'], []))
+        self.assertEqual(down.attempts, 3)
+        self.assertEqual((down.sent, down.failed), ([], ['backup_1.gz']))
+
+    def test_slow_destination_reads_on_its_own(self):
+        gate = threading.Event()
+        slow, fast = MemoryDestination('slow', gate=gate), MemoryDestination('fast')
+        queued = []
+        put = fanout.Writer.put
+
+        def watched_put(writer, chunk):
+            result = put(writer, chunk)
+            queued.append(writer.queue.qsize())
+            return result
+
+        fanout.Writer.put = watched_put
+        try:
+            done = threading.Thread(target=fanout.tee_file, args=(self.path, [slow, fast], CHUNK_SIZE, 4))
+            done.daemon = True
+            done.start()
+            # the fast one finishes while the slow one hasn't written a byte
+            for i in range(100):
+                if fast.files:
+                    break
+                done.join(0.1)
+            self.assertEqual(fast.files, {'backup_1.gz': self.data})
+            self.assertEqual(slow.files, {})
+            gate.set()
+            done.join(10)
+        finally:
+            gate.set()
+            fanout.Writer.put = put
+        self.assertFalse(done.is_alive())
+        self.assertEqual(slow.files, {'backup_1.gz': self.data})
+        # buffer chunks and the detach marker at most
+        self.assertTrue(max(queued) <= 4 + 1)
@@ -0,0 +1,223 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from django_backup import fastload
+from django_backup.db import ClientError, DatabaseClient, MYSQL, POSTGRESQL
+
+PG_DUMP = '''--
+-- PostgreSQL database dump
+--
+
+SET statement_timeout = 0;
+SELECT pg_catalog.set_config('search_path', '', false);
+
+--
+-- Name: app_author; Type: TABLE; Schema: public; Owner: app
+--
+
+CREATE TABLE public.app_author (
+    id integer NOT NULL,
+    name character varying(100) NOT NULL
+);
+
+--
+-- Name: app_book; Type: TABLE; Schema: public; Owner: app
+--
+
+CREATE TABLE public.app_book (
+    id integer NOT NULL,
+    author_id integer NOT NULL,
+    title text
+);
+
+--
+-- Data for Name: app_author; Type: TABLE DATA; Schema: public; Owner: app
+--
+
+COPY public.app_author (id, name) FROM stdin;
+1\tAda
+2\tGrace
+\\.
+
+--
+-- Data for Name: app_book; Type: TABLE DATA; Schema: public; Owner: app
+--
+
+COPY public.app_book (id, author_id, title) FROM stdin;
+1\t1\tNotes
+2\t2\tCOBOL
+3\t2\t\\\\.
+\\.
+
+--
+-- Name: app_author_id_seq; Type: SEQUENCE SET; Schema: public; Owner: app
+--
+
+SELECT pg_catalog.setval('public.app_author_id_seq', 2, true);
+
+--
+-- Name: app_author app_author_pkey; Type: CONSTRAINT; Schema: public; Owner: app
+--
+
+ALTER TABLE ONLY public.app_author
+    ADD CONSTRAINT app_author_pkey PRIMARY KEY (id);
+
+--
+-- Name: app_book_author_id; Type: INDEX; Schema: public; Owner: app
+--
+
+CREATE INDEX app_book_author_id ON public.app_book USING btree (author_id);
+
+--
+-- Name: app_book app_book_author_id_fk; Type: FK CONSTRAINT; Schema: public; Owner: app
+--
+
+ALTER TABLE ONLY public.app_book
+    ADD CONSTRAINT app_book_author_id_fk FOREIGN KEY (author_id) REFERENCES public.app_author(id);
+
+--
+-- Name: v; Type: VIEW; Schema: public; Owner: app
+--
+
+CREATE VIEW public.v AS SELECT 1;
+
+--
+-- PostgreSQL database dump complete
+--
+'''
+
+# pg_dump --clean without --if-exists, as older backups were made
+PG_CLEAN = '''ALTER TABLE ONLY public.app_book DROP CONSTRAINT app_book_author_id_fk;
+DROP INDEX public.app_book_author_id;
+ALTER TABLE ONLY public.app_author DROP CONSTRAINT app_author_pkey;
+DROP VIEW public.v;
+DROP TABLE public.app_book;
+DROP TABLE public.app_author;
+'''
+PG_CLEAN_DUMP = PG_DUMP.replace("false);\n", "false);\n\n" + PG_CLEAN, 1)
+
+FAKE_CLIENT = '''#!/bin/sh
+echo "$@" >> "%(log)s"
+cat >> "%(log)s"
+exit ${FAKE_CLIENT_EXIT:-0}
+'''
+
+
+class PostgresDumpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'dump.sql')
+        with open(self.path, 'wb') as f:
+            f.write(PG_DUMP)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_split(self):
+        dump = fastload.PostgresDump(self.path, self.directory, 2).split()
+        self.assertEqual(dump.counts, {'public.app_author': 2, 'public.app_book': 3})
+        pre = ''.join(dump.pre)
+        self.assertTrue('CREATE TABLE public.app_author' in pre)
+        self.assertTrue('CREATE TABLE public.app_book' in pre)
+        self.assertFalse('COPY' in pre or 'CREATE INDEX' in pre)
+        self.assertEqual(dump.session, ['SET statement_timeout = 0;\n',
+                                        "SELECT pg_catalog.set_config('search_path', '', false);\n"])
+        data = [open(path).read() for path, size in zip(dump.data_files, dump.data_sizes) if size]
+        self.assertEqual(len(data), 2)
+        for script in data:
+            self.assertTrue(script.startswith(''.join(dump.session + fastload.PG_LOAD_SETTINGS)))
+        data = ''.join(data)
+        self.assertTrue('2\t2\tCOBOL\n' in data and 'setval' in data)
+        self.assertEqual(len(dump.indexes), 2)
+        self.assertEqual(len(dump.foreign_keys), 1)
+        self.assertTrue('CREATE VIEW' in ''.join(dump.post))
+        self.assertFalse('FOREIGN KEY' in ''.join(dump.post))
+
+    def test_every_line_is_kept(self):
+        dump = fastload.PostgresDump(self.path, self.directory, 3).split()
+        lines = dump.pre + dump.post + sum(dump.indexes, []) + sum(dump.foreign_keys, [])
+        for path, size in zip(dump.data_files, dump.data_sizes):
+            if size:
+                lines += open(path).readlines()[len(dump.session + fastload.PG_LOAD_SETTINGS):]
+        self.assertEqual(sorted(lines), sorted(PG_DUMP.splitlines(True)))
+
+    def test_clean_statements(self):
+        with open(self.path, 'wb') as f:
+            f.write(PG_CLEAN_DUMP)
+        dump = fastload.PostgresDump(self.path, self.directory, 2).split()
+        self.assertEqual(''.join(dump.clean), PG_CLEAN)
+        self.assertFalse('DROP' in ''.join(dump.pre + dump.post + sum(dump.indexes, [])))
+        self.assertEqual(dump.schema(clean=False), dump.pre)
+        schema = ''.join(dump.schema())
+        # after the session settings, before the first item
+        self.assertTrue(schema.index('search_path') < schema.index(PG_CLEAN) < schema.index('CREATE TABLE'))
+
+    def test_group_by_table(self):
+        dump = fastload.PostgresDump(self.path, self.directory, 1).split()
+        groups = fastload.group_by_table(dump.indexes, 4)
+        self.assertEqual(len(groups), 2)
+
+    def test_count_mysql_rows(self):
+        self.assertEqual(fastload.count_mysql_rows("INSERT INTO `t` VALUES (1,'a'),(2,'b),(c'),(3,NULL);"), 3)
+
+
+class RunFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = os.path.join(self.directory, 'log')
+        for name in ('psql', 'mysql'):
+            path = os.path.join(self.directory, name)
+            with open(path, 'wb') as f:
+                f.write(FAKE_CLIENT % {'log': self.log})
+            os.chmod(path, stat.S_IRWXU)
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = self.directory + os.pathsep + os.environ['PATH']
+        self.script = os.path.join(self.directory, 'script.sql')
+        with open(self.script, 'wb') as f:
+            f.write('SELECT 1;\n')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def test_psql_stops_on_error_in_one_transaction(self):
+        DatabaseClient(POSTGRESQL, 'app').run_file(self.script)
+        args, script = open(self.log).read().split('\n', 1)
+        self.assertTrue('--single-transaction' in args.split())
+        self.assertTrue('ON_ERROR_STOP=1' in args.split())
+        self.assertEqual(script, 'SELECT 1;\n')
+
+    def test_exit_code_is_checked(self):
+        os.environ['FAKE_CLIENT_EXIT'] = '3'
+        for engine in (POSTGRESQL, MYSQL):
+            self.assertRaises(ClientError, DatabaseClient(engine, 'app').run_file, self.script)
+
+    def test_failed_phase_stops_the_load(self):
+        os.environ['FAKE_CLIENT_EXIT'] = '3'
+        path = os.path.join(self.directory, 'dump.sql')
+        with open(path, 'wb') as f:
+            f.write(PG_DUMP)
+        self.assertRaises(ClientError, fastload.postgresql_fast_load, DatabaseClient(POSTGRESQL, 'app'), path)
+        # only the schema was attempted
+        self.assertEqual(open(self.log).read().count('ON_ERROR_STOP'), 1)
+
+    def test_clean_only_into_existing_database(self):
+        path = os.path.join(self.directory, 'dump.sql')
+        with open(path, 'wb') as f:
+            f.write(PG_CLEAN_DUMP)
+        client = DatabaseClient(POSTGRESQL, 'app')
+        fastload.postgresql_fast_load(client, path, clean=False)
+        self.assertFalse('DROP' in open(self.log).read())
+        os.remove(self.log)
+        fastload.postgresql_fast_load(client, path)
+        self.assertEqual(open(self.log).read().count('DROP TABLE public.app_author;'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from django_backup import incremental
+from django_backup.db import MYSQL, POSTGRESQL
+from django_backup.storage import LocalStorage
+
+
+class FakeClient(object):
+    '''
+    answers the signal queries from rows set by the test.
+    '''
+
+    def __init__(self, engine, rows, stats_expiry=True):
+        self.engine = engine
+        self.rows = rows
+        self.stats_expiry = stats_expiry
+        self.queries = []
+        self.checksums = {}
+
+    @property
+    def is_mysql(self):
+        return self.engine == MYSQL
+
+    def quote_name(self, name):
+        return '`%s`' % name
+
+    def query(self, sql):
+        self.queries.append(sql)
+        if sql == incremental.MYSQL_STATS_EXPIRY:
+            return [['information_schema_stats_expiry', '86400']] if self.stats_expiry else []
+        if sql.startswith('CHECKSUM TABLE'):
+            return [['app.%s' % name, value] for name, value in sorted(self.checksums.items())]
+        rows = self.rows() if callable(self.rows) else self.rows
+        return [list(row) for row in rows]
+
+
+def pg_row(name, inserted=0, updated=0, deleted=0, filenode='16384', columns='c1',
+           track_counts='on', epoch='2026-01-01 00:00:00+00 2026-01-01 00:00:00+00'):
+    return ['public', name, str(inserted), str(updated), str(deleted), filenode, columns, track_counts, epoch]
+
+
+def manifest(signals):
+    return {'tables': dict((table, {'artifact': 'tables/%s.sql.gz' % table, 'signal': signal})
+                           for table, signal in signals.items())}
+
+
+class PostgresSignalTest(unittest.TestCase):
+
+    def signals(self, *rows):
+        return incremental.table_signals(FakeClient(POSTGRESQL, rows), settle=0)
+
+    def changed(self, before, after):
+        return incremental.changed_tables(self.signals(*after), [manifest(self.signals(*before))])
+
+    def test_unchanged_table_is_reused(self):
+        rows = [pg_row('app_a', 5, 1), pg_row('app_b', 3)]
+        self.assertEqual(self.changed(rows, rows), set())
+
+    def test_modified_table_is_dumped(self):
+        before = [pg_row('app_a', 5, 1, 0), pg_row('app_b', 3)]
+        for after in ([pg_row('app_a', 6, 1, 0)],                    # insert
+                      [pg_row('app_a', 5, 2, 0)],                    # update
+                      [pg_row('app_a', 5, 1, 1)],                    # delete
+                      [pg_row('app_a', 5, 1, 0, filenode='16999')],  # truncate
+                      [pg_row('app_a', 5, 1, 0, columns='c2')]):     # schema
+            self.assertEqual(self.changed(before, after + [pg_row('app_b', 3)]), set(['public.app_a']))
+
+    def test_reset_counters_dump_every_table(self):
+        before = [pg_row('app_a', 5), pg_row('app_b', 3)]
+        after = [pg_row('app_a', 1), pg_row('app_b', 3)]
+        self.assertEqual(self.changed(before, after), set(['public.app_a', 'public.app_b']))
+
+    def test_stats_reset_or_restart_dump_every_table(self):
+        before = [pg_row('app_a', 5), pg_row('app_b', 3)]
+        # counters back above their old values since the reset
+        after = [pg_row('app_a', 5, epoch='2026-02-01 2026-01-01'), pg_row('app_b', 3, epoch='2026-02-01 2026-01-01')]
+        self.assertEqual(self.changed(before, after), set(['public.app_a', 'public.app_b']))
+
+    def test_track_counts_off(self):
+        rows = [pg_row('app_a', 0, track_counts='off')]
+        self.assertEqual(self.signals(*rows), {'public.app_a': None})
+        self.assertEqual(self.changed(rows, rows), set(['public.app_a']))
+
+    def test_counters_moving_while_read_are_unsettled(self):
+        reads = [[pg_row('app_a', 5), pg_row('app_b', 3)], [pg_row('app_a', 6), pg_row('app_b', 3)]]
+        client = FakeClient(POSTGRESQL, lambda: reads.pop(0))
+        signals = incremental.table_signals(client, settle=0.01)
+        self.assertEqual(signals['public.app_a'], None)
+        self.assertNotEqual(signals['public.app_b'], None)
+
+    def test_excluded(self):
+        signals = incremental.table_signals(FakeClient(POSTGRESQL, [pg_row('app_a'), pg_row('app_b')]),
+                                            exclude=['app_a'], settle=0)
+        self.assertEqual(signals.keys(), ['public.app_b'])
+
+    def test_new_table_and_previous_backups(self):
+        rows = [pg_row('app_a', 5)]
+        signals = self.signals(*rows)
+        self.assertEqual(incremental.changed_tables(signals, [None]), set(['public.app_a']))
+        self.assertEqual(incremental.changed_tables(signals, [manifest({})]), set(['public.app_a']))
+        # a table is reused only if every store has it unchanged
+        self.assertEqual(incremental.changed_tables(signals, [manifest(signals), manifest({})]),
+                         set(['public.app_a']))
+
+
+class MySQLSignalTest(unittest.TestCase):
+
+    def signals(self, rows, **kwargs):
+        client = FakeClient(MYSQL, rows, **kwargs)
+        return incremental.table_signals(client), client
+
+    def test_stats_cache_is_turned_off(self):
+        signals, client = self.signals([['app_a', '2026-01-01', '2026-01-02', '100', 'md5']])
+        self.assertTrue(client.queries[1].startswith('SET SESSION information_schema_stats_expiry = 0;'))
+        self.assertEqual(signals, {'app_a': ['2026-01-01', '2026-01-02', 'md5']})
+        signals, client = self.signals([['app_a', '2026-01-01', '2026-01-02', '100', 'md5']], stats_expiry=False)
+        self.assertTrue(client.queries[1].startswith('SET SESSION group_concat_max_len'))
+
+    def test_recent_update_is_unsettled(self):
+        signals, client = self.signals([['app_a', '2026-01-01', '2026-01-02', '1', 'md5']])
+        self.assertEqual(signals, {'app_a': None})
+        self.assertEqual(incremental.changed_tables(signals, [manifest(signals)]), set(['app_a']))
+
+    def test_modified_table_is_dumped(self):
+        before, client = self.signals([['app_a', '2026-01-01', '2026-01-02', '100', 'md5'],
+                                       ['app_b', '2026-01-01', '2026-01-02', '100', 'md5']])
+        after, client = self.signals([['app_a', '2026-01-01', '2026-01-03', '100', 'md5'],
+                                      ['app_b', '2026-01-01', '2026-01-02', '100', 'md5']])
+        self.assertEqual(incremental.changed_tables(after, [manifest(before)]), set(['app_a']))
+
+    def test_checksum_without_update_time(self):
+        client = FakeClient(MYSQL, [['app_a', '2026-01-01', 'NULL', 'NULL', 'md5']])
+        client.checksums = {'app_a': '1234'}
+        before = incremental.table_signals(client)
+        self.assertEqual(before, {'app_a': ['2026-01-01', 'checksum:1234', 'md5']})
+        client.checksums = {'app_a': '5678'}
+        after = incremental.table_signals(client)
+        self.assertEqual(incremental.changed_tables(after, [manifest(before)]), set(['app_a']))
+        self.assertEqual(incremental.table_signals(client, checksum=False), {'app_a': None})
+
+
+class FakeDump(object):
+
+    def __init__(self, workdir, engine, tables, schema='CREATE;\n', post='INDEX;\n'):
+        self.client = FakeClient(engine, [])
+        self.schema = self.gzip(workdir, 'schema', schema)
+        self.post = self.gzip(workdir, 'post', post)
+        self.extra = None
+        self.prologue = 'BEGIN;\n'
+        self.epilogue = 'END;\n'
+        self.tables = dict((table, self.gzip(workdir, table, data)) for table, data in tables.items())
+
+    def gzip(self, workdir, name, data):
+        path = os.path.join(workdir, name + '.gz')
+        incremental.gzip_file(path, [data])
+        return path
+
+
+class StoreAndAssembleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = LocalStorage(os.path.join(self.directory, 'storage'))
+        self.storage.ensure()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assemble(self, name):
+        out = StringIO()
+        incremental.assemble(self.storage, name, out)
+        return out.getvalue()
+
+    def test_round_trip(self):
+        signals = {'a': ['1'], 'b': ['1']}
+        dump = FakeDump(self.directory, MYSQL, {'a': 'A1;\n', 'b': 'B1;\n'})
+        incremental.store_backup(self.storage, 'backup_1.tables', '1', dump, signals, None)
+        self.assertEqual(self.assemble('backup_1.tables'), 'CREATE;\nBEGIN;\nA1;\nB1;\nEND;\nINDEX;\n')
+
+        previous = incremental.latest_manifest(self.storage)
+        signals = {'a': ['2'], 'b': ['1']}
+        changed = incremental.changed_tables(signals, [previous])
+        self.assertEqual(changed, set(['a']))
+        dump = FakeDump(self.directory, MYSQL, {'a': 'A2;\n'})
+        incremental.store_backup(self.storage, 'backup_2.tables', '2', dump, signals, previous)
+        self.assertEqual(self.assemble('backup_2.tables'), 'CREATE;\nBEGIN;\nA2;\nB1;\nEND;\nINDEX;\n')
+
+        os.remove(self.storage.path('backup_1.tables'))
+        # the first backup's schema, post-data and table a
+        self.assertEqual(incremental.collect_garbage(self.storage), 3)
+        self.assertEqual(self.assemble('backup_2.tables'), 'CREATE;\nBEGIN;\nA2;\nB1;\nEND;\nINDEX;\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from django_backup import plan
+
+
+def plain_run(database_bytes, dump_bytes, compressed_bytes, seconds=10.0):
+    return {'database_bytes': database_bytes,
+            'stages': {'dump': {'bytes': dump_bytes, 'seconds': seconds},
+                       'compress': {'bytes_in': dump_bytes, 'bytes': compressed_bytes, 'seconds': seconds}}}
+
+
+def streamed_run(database_bytes, dump_bytes, compressed_bytes, seconds=10.0):
+    return {'database_bytes': database_bytes,
+            'stages': {'dump': {'streamed': True, 'dump_bytes': dump_bytes, 'bytes': compressed_bytes,
+                                'seconds': seconds}}}
+
+
+class CheckSpaceTest(unittest.TestCase):
+
+    def setUp(self):
+        # without history: a 1000 byte dump compressing to 250 bytes
+        self.estimate = plan.BackupPlan([], database=(1000, 10, 1), compress=True)
+
+    def test_sizes(self):
+        self.assertEqual(self.estimate.dump_bytes, 1000)
+        self.assertEqual(self.estimate.compressed_bytes, 250)
+        self.assertEqual(self.estimate.local_bytes(), 1250)
+        self.assertEqual(self.estimate.local_bytes(stream=True), 250)
+
+    def test_fits(self):
+        self.assertEqual(self.estimate.check_space(2000), 'ok')
+
+    def test_fits_streamed(self):
+        self.assertEqual(self.estimate.check_space(1000), 'stream')
+
+    def test_does_not_fit(self):
+        self.assertEqual(self.estimate.check_space(200), None)
+
+    def test_uncompressed_does_not_stream(self):
+        estimate = plan.BackupPlan([], database=(1000, 10, 1))
+        self.assertEqual(estimate.check_space(1200), 'ok')
+        self.assertEqual(estimate.check_space(1000), None)
+
+    def test_streamed_run(self):
+        estimate = plan.BackupPlan([], database=(1000, 10, 1), compress=True, stream=True)
+        self.assertEqual(estimate.check_space(300), 'ok')
+
+
+class EstimateTest(unittest.TestCase):
+
+    def test_ratios_from_plain_runs(self):
+        runs = [plain_run(1000, 2000, 400), plain_run(1000, 2000, 400)]
+        estimate = plan.BackupPlan(runs, database=(5000, 10, 1), compress=True)
+        self.assertEqual(estimate.dump_bytes, 10000)
+        self.assertEqual(estimate.compressed_bytes, 2000)
+
+    def test_ratios_from_streamed_runs(self):
+        runs = [streamed_run(1000, 3000, 300)]
+        estimate = plan.BackupPlan(runs, database=(1000, 10, 1), compress=True)
+        self.assertEqual(estimate.dump_bytes, 3000)
+        self.assertEqual(estimate.compressed_bytes, 300)
+
+    def test_runs_without_database_size_use_the_default(self):
+        runs = [{'stages': {'dump': {'bytes': 2000, 'seconds': 1.0}}}]
+        estimate = plan.BackupPlan(runs, database=(1000, 10, 1))
+        self.assertEqual(estimate.dump_bytes, 1000)
+
+    def test_without_statistics_the_last_dump(self):
+        runs = [plain_run(1000, 2000, 400), streamed_run(1000, 3000, 300),
+                {'stages': {'dump': {'incremental': True, 'bytes_stored': 10, 'seconds': 1.0}}}]
+        self.assertEqual(plan.BackupPlan(runs).dump_bytes, 3000)
+
+    def test_media(self):
+        runs = [{'stages': {'media': {'bytes': 500, 'source_bytes': 1000, 'seconds': 1.0}}}]
+        self.assertEqual(plan.BackupPlan(runs, media=(10, 4000, 100)).media_bytes, 2000)
+        self.assertEqual(plan.BackupPlan(runs, media=(10, 4000, 100), mode='rsync').media_bytes, 100)
+
+    def test_durations(self):
+        runs = [plain_run(1000, 2000, 400, seconds=2.0)]
+        runs[0]['stages']['upload'] = {'bytes': 400, 'seconds': 5.0, 'sent_bytes': 400, 'send_seconds': 4.0}
+        estimate = plan.BackupPlan(runs, database=(1000, 10, 1), compress=True, upload=True)
+        self.assertEqual(estimate.seconds, {'dump': 2.0, 'compress': 2.0, 'upload': 4.0})
+        self.assertEqual(estimate.total_seconds, 8.0)
+        # streamed dumps include compressing, they don't time the dump
+        estimate = plan.BackupPlan([streamed_run(1000, 2000, 400)], database=(1000, 10, 1))
+        self.assertEqual(estimate.seconds, {})
+
+
+class MediaStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'a', 'b'))
+        for name, size in (('top', 10), ('a/one', 20), ('a/b/two', 30)):
+            f = open(os.path.join(self.root, name), 'wb')
+            f.write('x' * size)
+            f.close()
+        os.symlink('top', os.path.join(self.root, 'link'))
+        old = time.time() - 3600
+        os.utime(os.path.join(self.root, 'a', 'one'), (old, old))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_media_stats(self):
+        self.assertEqual(plan.media_stats([self.root], workers=2), (3, 60, 0))
+        self.assertEqual(plan.media_stats([self.root], workers=2, since=time.time() - 60), (3, 60, 40))
+        self.assertEqual(plan.media_stats([os.path.join(self.root, 'missing')]), (0, 0, 0))
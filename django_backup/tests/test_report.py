@@ -0,0 +1,65 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from django_backup.report import RunReport, read_history
+
+
+class ReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, '.backup_runs')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_stages_are_recorded_in_order(self):
+        report = RunReport(self.path, engine='mysql')
+        with report.stage('dump', streamed=True) as record:
+            record['bytes'] = 2048
+        with report.stage('upload') as record:
+            record['bytes'] = 1024
+            record['sent_bytes'] = 1024
+            record['send_seconds'] = 2.0
+        report.save()
+        runs = read_history(self.path)
+        self.assertEqual(len(runs), 1)
+        run = runs[0]
+        self.assertEqual(run['engine'], 'mysql')
+        self.assertEqual(run['stages']['dump']['bytes'], 2048)
+        self.assertTrue(run['stages']['dump']['streamed'])
+        self.assertTrue('seconds' in run['stages']['upload'])
+        lines = report.summary().splitlines()
+        self.assertEqual([line.split()[0] for line in lines], ['dump', 'upload', 'total'])
+        self.assertTrue('sent at 512.0B/s' in lines[1])
+
+    def test_failed_stage_is_recorded(self):
+        report = RunReport(self.path)
+        try:
+            with report.stage('dump') as record:
+                raise IOError('disk full')
+        except IOError, e:
+            report.fail(e)
+        report.save()
+        self.assertTrue('seconds' in report.data['stages']['dump'])
+        f = open(self.path)
+        try:
+            self.assertEqual(json.loads(f.read())['error'], 'disk full')
+        finally:
+            f.close()
+        # failed runs give no history
+        self.assertEqual(read_history(self.path), [])
+
+    def test_history(self):
+        for i in range(5):
+            report = RunReport(self.path, number=i)
+            report.save()
+        f = open(self.path, 'a')
+        f.write('not json\n')
+        f.close()
+        self.assertEqual([run['number'] for run in read_history(self.path)], range(5))
+        self.assertEqual([run['number'] for run in read_history(self.path, 2)], [3, 4])
+        self.assertEqual(read_history(os.path.join(self.root, 'missing')), [])
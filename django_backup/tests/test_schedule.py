@@ -0,0 +1,61 @@
+import unittest
+from datetime import datetime
+
+from django_backup.schedule import CronSchedule, parse_field
+
+
+class ParseFieldTest(unittest.TestCase):
+
+    def test_fields(self):
+        self.assertEqual(parse_field('*', 0, 5), set(range(6)))
+        self.assertEqual(parse_field('1,3,5', 0, 59), set([1, 3, 5]))
+        self.assertEqual(parse_field('1-4', 0, 59), set([1, 2, 3, 4]))
+        self.assertEqual(parse_field('*/15', 0, 59), set([0, 15, 30, 45]))
+        self.assertEqual(parse_field('10-20/5', 0, 59), set([10, 15, 20]))
+        self.assertEqual(parse_field('50/5', 0, 59), set([50, 55]))
+
+    def test_invalid_fields(self):
+        for spec in ('60', '5-1', '*/0', 'x', '1-', ''):
+            self.assertRaises(ValueError, parse_field, spec, 0, 59)
+
+    def test_invalid_expressions(self):
+        for expression in ('* * * *', '* * * * * *', '0 24 * * *', '0 0 32 * *', '0 0 * 13 *', '0 0 * * 8'):
+            self.assertRaises(ValueError, CronSchedule, expression)
+
+
+class NextRunTest(unittest.TestCase):
+
+    def next_after(self, expression, after):
+        return CronSchedule(expression).next_after(after)
+
+    def test_every_minute_is_strictly_after(self):
+        self.assertEqual(self.next_after('* * * * *', datetime(2020, 1, 1, 10, 0, 0)),
+                         datetime(2020, 1, 1, 10, 1))
+        self.assertEqual(self.next_after('* * * * *', datetime(2020, 1, 1, 10, 0, 59, 999)),
+                         datetime(2020, 1, 1, 10, 1))
+
+    def test_steps_and_hours(self):
+        self.assertEqual(self.next_after('*/15 * * * *', datetime(2020, 1, 1, 10, 16)),
+                         datetime(2020, 1, 1, 10, 30))
+        self.assertEqual(self.next_after('30 2 * * *', datetime(2020, 1, 1, 2, 30)),
+                         datetime(2020, 1, 2, 2, 30))
+        self.assertEqual(self.next_after('0 1-5 * * *', datetime(2020, 1, 1, 5, 0)),
+                         datetime(2020, 1, 2, 1, 0))
+
+    def test_month_and_year_rollover(self):
+        self.assertEqual(self.next_after('0 0 1 * *', datetime(2020, 12, 15)), datetime(2021, 1, 1))
+        self.assertEqual(self.next_after('0 0 29 2 *', datetime(2020, 3, 1)), datetime(2024, 2, 29))
+
+    def test_weekdays(self):
+        # 2020-01-01 is a wednesday
+        self.assertEqual(self.next_after('0 3 * * 0', datetime(2020, 1, 1)), datetime(2020, 1, 5, 3))
+        self.assertEqual(self.next_after('0 3 * * 7', datetime(2020, 1, 1)), datetime(2020, 1, 5, 3))
+        self.assertEqual(self.next_after('0 3 * * 1-5', datetime(2020, 1, 3, 4)), datetime(2020, 1, 6, 3))
+
+    def test_day_or_weekday(self):
+        # both restricted: either one matches, like cron
+        self.assertEqual(self.next_after('0 0 15 * 1', datetime(2020, 1, 1)), datetime(2020, 1, 6))
+        self.assertEqual(self.next_after('0 0 2 * 1', datetime(2020, 1, 1)), datetime(2020, 1, 2))
+
+    def test_never_matches(self):
+        self.assertRaises(ValueError, self.next_after, '0 0 31 2 *', datetime(2020, 1, 1))
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from django_backup.snapshots import SnapshotIndex, remove_tree
+
+FLAG = '.good'
+
+
+class SnapshotIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backup_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.backup_dir)
+
+    def snapshot(self, name, files, link_dest=None):
+        path = os.path.join(self.backup_dir, name)
+        os.mkdir(path)
+        for filename, size in files.items():
+            target = os.path.join(path, filename)
+            if link_dest and os.path.exists(os.path.join(self.backup_dir, link_dest, filename)):
+                os.link(os.path.join(self.backup_dir, link_dest, filename), target)
+            else:
+                f = open(target, 'wb')
+                f.write('x' * size)
+                f.close()
+        open(os.path.join(path, FLAG), 'w').close()
+        return name
+
+    def test_unique_and_shared_bytes(self):
+        a = self.snapshot('dir_1', {'shared': 100, 'old': 10})
+        b = self.snapshot('dir_2', {'shared': 100, 'new': 20}, link_dest=a)
+        index = SnapshotIndex(self.backup_dir, FLAG)
+        index.refresh([a, b])
+        usage = index.usage()
+        self.assertEqual(usage[a], (110, 10))
+        self.assertEqual(usage[b], (120, 20))
+        self.assertEqual(index.reclaimable([a]), 10)
+        self.assertEqual(index.reclaimable([a, b]), 130)
+
+    def test_nlink_follows_snapshot_changes(self):
+        a = self.snapshot('dir_1', {'shared': 100})
+        b = self.snapshot('dir_2', {'shared': 100}, link_dest=a)
+        index = SnapshotIndex(self.backup_dir, FLAG)
+        index.refresh([a, b])
+        # a third snapshot linking the file, then the first one pruned: the
+        # cached entry of dir_2 still says 2 links
+        c = self.snapshot('dir_3', {'shared': 100}, link_dest=b)
+        remove_tree(os.path.join(self.backup_dir, a))
+        index = SnapshotIndex(self.backup_dir, FLAG)
+        self.assertEqual(index.refresh([b, c]), [c])
+        self.assertEqual(index.reclaimable([b]), 0)
+        self.assertEqual(index.reclaimable([b, c]), 100)
+        remove_tree(os.path.join(self.backup_dir, c))
+        index.refresh([b])
+        self.assertEqual(index.usage()[b], (100, 100))
+
+    def test_link_outside_the_snapshots_is_kept(self):
+        a = self.snapshot('dir_1', {'shared': 100})
+        os.link(os.path.join(self.backup_dir, a, 'shared'), os.path.join(self.backup_dir, 'elsewhere'))
+        index = SnapshotIndex(self.backup_dir, FLAG)
+        index.refresh([a])
+        self.assertEqual(index.reclaimable([a]), 0)
+
+    def test_changed_snapshot_drops_its_old_links(self):
+        a = self.snapshot('dir_1', {'shared': 100})
+        b = self.snapshot('dir_2', {'shared': 100}, link_dest=a)
+        index = SnapshotIndex(self.backup_dir, FLAG)
+        index.refresh([a, b])
+        self.assertEqual(index.reclaimable([a]), 0)
+        os.remove(os.path.join(self.backup_dir, b, FLAG))
+        os.remove(os.path.join(self.backup_dir, b, 'shared'))
+        self.assertEqual(index.refresh([a, b]), [b])
+        self.assertEqual(index.reclaimable([a]), 100)
+        self.assertEqual(index.usage()[b], (0, 0))
+
+    def test_answers_without_touching_the_snapshots(self):
+        a = self.snapshot('dir_1', {'shared': 100, 'old': 10})
+        b = self.snapshot('dir_2', {'shared': 100}, link_dest=a)
+        SnapshotIndex(self.backup_dir, FLAG).refresh([a, b])
+        index = SnapshotIndex(self.backup_dir, FLAG)
+
+        def lstat(path):
+            raise AssertionError('lstat(%s)' % path)
+        original = os.lstat
+        os.lstat = lstat
+        try:
+            self.assertEqual(index.usage(), {a: (110, 10), b: (100, 0)})
+            self.assertEqual(index.reclaimable([a, b]), 110)
+        finally:
+            os.lstat = original
+
+
+if __name__ == '__main__':
+    unittest.main()
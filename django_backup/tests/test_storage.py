@@ -0,0 +1,287 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+import uuid
+from datetime import datetime, timedelta, tzinfo
+
+from django_backup import storage as storage_module
+from django_backup.storage import LocalStorage, SFTPStorage, S3Reader, S3Storage, epoch
+
+try:
+    from moto import mock_s3
+except (ImportError, SyntaxError):
+    # moto is Python 3 only in recent releases
+    mock_s3 = None
+
+
+class FakeSFTP(object):
+    '''
+    the parts of a pysftp connection and its paramiko client used by
+    SFTPStorage, on a local directory.
+    '''
+
+    def __init__(self):
+        self.renamed = []
+
+    def open(self, path, mode='rb'):
+        return open(path, mode)
+
+    def posix_rename(self, source, target):
+        self.renamed.append((source, target))
+        os.rename(source, target)
+
+    def mkdir(self, path):
+        try:
+            os.mkdir(path)
+        except OSError, e:
+            raise IOError(*e.args)
+
+    def execute(self, command):
+        subprocess.check_call(command, shell=True)
+
+    def listdir_attr(self, path):
+        entries = []
+        for name in os.listdir(path):
+            attr = os.stat(os.path.join(path, name))
+            entries.append(type('SFTPAttributes', (object,), dict(
+                filename=name, st_size=attr.st_size, st_mtime=attr.st_mtime, st_mode=attr.st_mode)))
+        return entries
+
+
+class StorageTestMixin(object):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source')
+        with open(self.source, 'wb') as f:
+            f.write('data' * 1000)
+        self.root = os.path.join(self.directory, 'storage')
+        self.storage = self.get_storage()
+        self.storage.ensure()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def files(self):
+        return sorted(os.listdir(self.root))
+
+    def test_put_and_get(self):
+        self.storage.put_stream('a/backup_1.gz', open(self.source, 'rb'))
+        self.assertEqual(self.storage.get_stream('a/backup_1.gz').read(), 'data' * 1000)
+
+    def test_writer_stores_on_close(self):
+        writer = self.storage.open_writer('backup_1.gz')
+        writer.write('partial')
+        self.assertEqual(self.files(), ['backup_1.gz.part'])
+        writer.close()
+        self.assertEqual(self.files(), ['backup_1.gz'])
+
+    def test_writer_abort_leaves_nothing(self):
+        self.storage.put_stream('backup_1.gz', open(self.source, 'rb'))
+        writer = self.storage.open_writer('backup_1.gz')
+        writer.write('partial')
+        writer.abort()
+        self.assertEqual(self.files(), ['backup_1.gz'])
+        self.assertEqual(self.storage.get_stream('backup_1.gz').read(), 'data' * 1000)
+
+    def test_list_leaves_out_partial_uploads(self):
+        self.storage.put_stream('backup_1.gz', open(self.source, 'rb'))
+        writer = self.storage.open_writer('backup_2.gz')
+        writer.write('partial')
+        self.assertEqual(self.storage.listdir(), ['backup_1.gz'])
+        writer.abort()
+
+    def test_writer_replaces(self):
+        self.storage.put_stream('backup_1.gz', open(self.source, 'rb'))
+        writer = self.storage.open_writer('backup_1.gz')
+        writer.write('new')
+        writer.close()
+        self.assertEqual(self.storage.get_stream('backup_1.gz').read(), 'new')
+
+
+class LocalStorageTest(StorageTestMixin, unittest.TestCase):
+
+    def get_storage(self):
+        return LocalStorage(self.root)
+
+    def test_list(self):
+        self.storage.put_stream('backup_1.gz', open(self.source, 'rb'))
+        self.storage.put_stream('dir_1/file', open(self.source, 'rb'))
+        entries = dict((entry.name, entry) for entry in self.storage.list())
+        self.assertEqual(sorted(entries), ['backup_1.gz', 'dir_1'])
+        self.assertEqual(entries['backup_1.gz'].size, 4000)
+        self.assertTrue(isinstance(entries['backup_1.gz'].mtime, float))
+        self.assertTrue(entries['dir_1'].is_dir)
+        self.assertTrue(self.storage.exists('dir_1/file'))
+        self.storage.delete_batch(['dir_1'])
+        self.assertEqual(self.storage.listdir(), ['backup_1.gz'])
+
+    def test_list_dangling_symlink(self):
+        os.symlink('dir_1', os.path.join(self.root, 'current'))
+        entries = self.storage.list()
+        self.assertEqual([(entry.name, entry.is_dir) for entry in entries], [('current', False)])
+
+
+class SFTPStorageTest(StorageTestMixin, unittest.TestCase):
+
+    def get_storage(self):
+        storage = SFTPStorage('backup.example.com', directory=self.root)
+        storage.connection = FakeSFTP()
+        storage.connection.sftp_client = storage.connection
+        return storage
+
+    def test_for_worker(self):
+        self.assertTrue(self.storage.for_worker(0) is self.storage)
+        worker = self.storage.for_worker(3)
+        self.assertEqual((worker.server, worker.directory, worker.slot), ('backup.example.com', self.root, 3))
+        self.assertTrue(worker.connection is None)
+
+    def test_writer_renames_on_close(self):
+        writer = self.storage.open_writer('backup_1.gz')
+        writer.write('data')
+        writer.close()
+        path = os.path.join(self.root, 'backup_1.gz')
+        self.assertEqual(self.storage.connection.renamed, [(path + '.part', path)])
+
+
+class S3StorageTest(StorageTestMixin, unittest.TestCase):
+    '''
+    runs against moto when it is installed, or against the S3 compatible
+    server (e.g. MinIO) at BACKUP_TEST_S3_ENDPOINT, with
+    BACKUP_TEST_S3_ACCESS_KEY and BACKUP_TEST_S3_SECRET_KEY.
+    '''
+
+    def setUp(self):
+        if storage_module.boto3 is None:
+            self.skipTest('boto3 is not installed')
+        self.endpoint = os.environ.get('BACKUP_TEST_S3_ENDPOINT')
+        if not self.endpoint and mock_s3 is None:
+            self.skipTest('neither moto nor BACKUP_TEST_S3_ENDPOINT is available')
+        self.mock = None
+        if not self.endpoint:
+            self.mock = mock_s3()
+            self.mock.start()
+        self.bucket = 'django-backup-test-%s' % uuid.uuid4().hex[:12]
+        StorageTestMixin.setUp(self)
+
+    def tearDown(self):
+        try:
+            self.storage.delete_batch([''])
+            self.storage.client.delete_bucket(Bucket=self.bucket)
+            self.storage.close()
+        finally:
+            if self.mock is not None:
+                self.mock.stop()
+            StorageTestMixin.tearDown(self)
+
+    def get_storage(self):
+        return S3Storage(self.bucket, prefix='site', endpoint_url=self.endpoint, region='us-east-1',
+                         access_key=os.environ.get('BACKUP_TEST_S3_ACCESS_KEY', 'testing'),
+                         secret_key=os.environ.get('BACKUP_TEST_S3_SECRET_KEY', 'testing'),
+                         part_size=5 * 1024 * 1024, workers=2)
+
+    def files(self):
+        return sorted(self.storage.listdir())
+
+    def test_writer_stores_on_close(self):
+        # multipart uploads only show up once completed
+        writer = self.storage.open_writer('backup_1.gz')
+        writer.write('partial')
+        self.assertEqual(self.files(), [])
+        writer.close()
+        self.assertEqual(self.files(), ['backup_1.gz'])
+
+    def test_multipart(self):
+        data = os.urandom(1024) * (11 * 1024)
+        writer = self.storage.open_writer('backup_1.gz')
+        for i in range(0, len(data), 1024 * 1024):
+            writer.write(data[i:i + 1024 * 1024])
+        writer.close()
+        self.assertEqual(self.storage.get_stream('backup_1.gz').read(), data)
+        self.assertEqual(self.storage.read_range('backup_1.gz', 5, 10), data[5:15])
+
+    def test_list(self):
+        self.storage.put_stream('backup_1.gz', open(self.source, 'rb'))
+        self.storage.put_stream('dir_1/file', open(self.source, 'rb'))
+        entries = dict((entry.name, entry) for entry in self.storage.list())
+        self.assertEqual(sorted(entries), ['backup_1.gz', 'dir_1'])
+        self.assertEqual(entries['backup_1.gz'].size, 4000)
+        self.assertTrue(isinstance(entries['backup_1.gz'].mtime, float))
+        self.assertTrue(abs(entries['backup_1.gz'].mtime - time.time()) < 3600)
+        self.assertTrue(entries['dir_1'].is_dir)
+        self.storage.delete_batch(['dir_1'])
+        self.assertEqual(self.storage.listdir(), ['backup_1.gz'])
+
+
+class FakeResult(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class FakeS3(object):
+    '''
+    serves the ranges S3Reader asks for from a string.
+    '''
+
+    def __init__(self, data, part_size):
+        self.data = data
+        self.part_size = part_size
+        self.workers = 2
+        self.pool = self
+        self.ranges = []
+
+    def apply_async(self, function, args):
+        return FakeResult(function(*args))
+
+    def get_range(self, key, start, length):
+        self.ranges.append((start, length))
+        return self.data[start:start + length]
+
+
+class S3ReaderTest(unittest.TestCase):
+
+    def test_reads(self):
+        data = os.urandom(10000)
+        storage = FakeS3(data, 1000)
+        reader = S3Reader(storage, 'key', len(data))
+        chunks = []
+        for size in [5, 995, 1, 1500, 0, 3000]:
+            chunks.append(reader.read(size))
+            self.assertEqual(len(chunks[-1]), size)
+        chunks.append(reader.read())
+        self.assertEqual(''.join(chunks), data)
+        self.assertEqual(reader.read(10), '')
+        self.assertEqual([start for start, length in storage.ranges], range(0, 10000, 1000))
+
+    def test_short_reads_stay_in_the_buffer(self):
+        data = os.urandom(4096)
+        reader = S3Reader(FakeS3(data, 4096), 'key', len(data))
+        self.assertEqual(''.join(iter(lambda: reader.read(5), '')), data)
+        # the buffer is the ranged GET as it came, only the offset moves
+        self.assertEqual((len(reader.buffer), reader.offset), (4096, 4096))
+
+
+class UTC(tzinfo):
+
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+    def dst(self, dt):
+        return timedelta(0)
+
+
+class EpochTest(unittest.TestCase):
+
+    def test_epoch(self):
+        self.assertEqual(epoch(datetime(1970, 1, 2, 0, 0, 1, 500000, tzinfo=UTC())), 86401.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -167,6 +167,72 @@ BACKUP_FTP_USERNAME = None
 BACKUP_FTP_PASSWORD = None
 BACKUP_FTP_DIRECTORY = None
 
+# Where remote backups are stored, see django_backup/storage.py. When None
+# the BACKUP_FTP_* settings are used. S3 storage needs boto3, and can be
+# pointed at a local MinIO or moto server with 'endpoint_url'.
+BACKUP_STORAGE = None
+# BACKUP_STORAGE = {
+#     'backend': 's3',
+#     'bucket': 'backups',
+#     'endpoint_url': 'http://localhost:9000',
+# }
+
+# 32 byte key used by `backup --encrypt`, hex or base64 encoded, or the
+# bytes themselves after raw:, e.g. the output of `openssl rand -hex 32`.
+# Encryption needs the cryptography package.
+BACKUP_ENCRYPTION_KEY = None
+BACKUP_ENCRYPTION_KEY_FILE = None
+
+# Extra destinations for `backup --fanout`, see django_backup/fanout.py.
+BACKUP_DESTINATIONS = [
+    # {'type': 'local', 'directory': '/mnt/backup'},
+]
+
+# Jobs run by `manage.py backupd`, keyed by name. Options are passed to the
+# backup command as with call_command().
+BACKUP_DAEMON_JOBS = {
+    # 'nightly': {
+    #     'schedule': '30 2 * * *',
+    #     'options': {'compress': True, 'ftp': True, 'clean_db': True},
+    # },
+}
+BACKUP_DAEMON_SOCKET = None
+
+# Every backup run appends its stage timings and sizes here, one JSON line
+# per run. Defaults to .backup_runs in BACKUP_LOCAL_DIRECTORY.
+BACKUP_REPORT_FILE = None
+
+# Sessions used by `restore --fast` to load PostgreSQL data and build
+# indexes, and INSERT statements per commit for MySQL.
+BACKUP_RESTORE_WORKERS = 4
+BACKUP_RESTORE_BATCH = 64
+
+# `backup --preflight` warns when a run is expected to take longer than
+# this many seconds, from the history in BACKUP_REPORT_FILE.
+BACKUP_MAX_DURATION = None
+
+# `backup --incremental` checksums the MySQL tables that keep no UPDATE_TIME
+# to tell whether they changed; turn off to dump such tables every time.
+BACKUP_INCREMENTAL_CHECKSUM = True
+
+# `restore --drill` restores into these instead of the database and
+# MEDIA_ROOT in use, <database>_drill and a temporary directory by default,
+# and compares the tables with the checks `backup --checks` recorded. The
+# media go to a restore_drill directory below BACKUP_DRILL_MEDIA_ROOT, which
+# must not overlap MEDIA_ROOT. A backup without checks fails the drill
+# unless --allow-unchecked is given.
+BACKUP_DRILL_DATABASE = None
+BACKUP_DRILL_MEDIA_ROOT = None
+# parallel sessions computing table checksums
+BACKUP_DRILL_WORKERS = 4
+# drill history, .restore_drills in BACKUP_LOCAL_DIRECTORY when None
+BACKUP_DRILL_REPORT_FILE = None
+
+# threads listing the media directories and reading small files ahead of
+# the archive writer, and how many bytes they may read ahead.
+BACKUP_ARCHIVE_WORKERS = 8
+BACKUP_ARCHIVE_PREFETCH_BYTES = 64 * 1024 * 1024
+
 
 # local_settings.py can be used to override environment-specific settings
 # like database and email that differ between development and production.